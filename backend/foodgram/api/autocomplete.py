@@ -0,0 +1,195 @@
+"""
+Ingredient autocomplete from a memory-mapped index file.
+
+The file holds the whole catalog sorted by the UTF-8 bytes of the
+case-folded name, so a prefix query is two binary searches and a
+substring query is a scan of one contiguous block of names. Every
+worker maps the same file read-only, so the operating system keeps a
+single copy in the page cache.
+
+Layout (little-endian, every section 8-byte aligned):
+
+    header    magic, format, ingredients version stamp, count, sizes
+    offsets   count + 1 int64, start of each name in the names block
+    ids       count int64
+    labels    count + 1 int64, start of each "name<US>unit" label
+    names     case-folded names, each followed by a newline
+    labels    display names and units
+
+The file records the 'ingredients' version stamp it was built from
+(api/cache.py). A worker that sees a newer stamp rebuilds the file under
+a lock, or maps the one another worker has just rebuilt.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from bisect import bisect_right
+
+from django.conf import settings
+
+from core.models import Ingredient
+from .cache import get_version
+
+MAGIC = b'FGAC'
+FORMAT = 1
+HEADER = struct.Struct('<4sI32sQQQ')
+INT = struct.Struct('<q')
+SEPARATOR = b'\n'
+LABEL_SEPARATOR = '\x1f'
+
+_index = None
+_lock = threading.Lock()
+
+
+def fold(text):
+    return text.strip().casefold()
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+def build(path, version):
+    """Write the index of the current catalog to path atomically."""
+    rows = sorted(
+        ((fold(name).encode('utf-8'), pk, name, unit)
+         for pk, name, unit in Ingredient.objects.values_list(
+             'id', 'name', 'measurement_unit')),
+        key=lambda row: (row[0], row[1]))
+    names = bytearray()
+    labels = bytearray()
+    offsets = []
+    label_offsets = []
+    for key, _, name, unit in rows:
+        offsets.append(len(names))
+        names += key + SEPARATOR
+        label_offsets.append(len(labels))
+        labels += f'{name}{LABEL_SEPARATOR}{unit}'.encode('utf-8')
+    offsets.append(len(names))
+    label_offsets.append(len(labels))
+
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.index-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(
+                MAGIC, FORMAT, version.encode('ascii').ljust(32)[:32],
+                len(rows), len(names), len(labels)))
+            for values in (offsets, [row[1] for row in rows],
+                           label_offsets):
+                f.write(struct.pack(f'<{len(values)}q', *values))
+            f.write(names)
+            f.write(b'\0' * (_align(len(names)) - len(names)))
+            f.write(labels)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class AutocompleteIndex:
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, file_format, version, self.count, names_size,
+         labels_size) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or file_format != FORMAT:
+            raise ValueError(f'{path} is not an ingredient index')
+        self.version = version.rstrip(b' ').decode('ascii')
+        view = memoryview(self.map)
+        start = _align(HEADER.size)
+        sizes = (self.count + 1, self.count, self.count + 1)
+        sections = []
+        for size in sizes:
+            sections.append(view[start:start + size * INT.size].cast('q'))
+            start += size * INT.size
+        self.offsets, self.ids, self.label_offsets = sections
+        self.names_start = start
+        self.names_end = start + names_size
+        self.labels_start = start + _align(names_size)
+
+    def key(self, number):
+        start = self.names_start + self.offsets[number]
+        end = self.names_start + self.offsets[number + 1] - 1
+        return self.map[start:end]
+
+    def entry(self, number):
+        start = self.labels_start + self.label_offsets[number]
+        end = self.labels_start + self.label_offsets[number + 1]
+        name, unit = self.map[start:end].decode('utf-8').split(
+            LABEL_SEPARATOR)
+        return {'id': self.ids[number], 'name': name,
+                'measurement_unit': unit}
+
+    def _lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def prefix_range(self, prefix):
+        # No UTF-8 sequence contains 0xFF, so it bounds every extension.
+        return (self._lower_bound(prefix),
+                self._lower_bound(prefix + b'\xff'))
+
+    def search(self, query, limit):
+        """Prefix matches first, then substring matches, by name."""
+        needle = fold(query).encode('utf-8')
+        if not needle or SEPARATOR in needle:
+            return []
+        first, last = self.prefix_range(needle)
+        numbers = list(range(first, min(last, first + limit)))
+        position = self.names_start
+        while len(numbers) < limit:
+            position = self.map.find(needle, position, self.names_end)
+            if position < 0:
+                break
+            number = bisect_right(
+                self.offsets, position - self.names_start) - 1
+            if not first <= number < last:
+                numbers.append(number)
+            position = self.names_start + self.offsets[number + 1]
+        return [self.entry(number) for number in numbers]
+
+
+def _open(path):
+    try:
+        return AutocompleteIndex(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def get_index():
+    """The index for the current catalog version, rebuilt if stale."""
+    global _index
+    version = get_version('ingredients')
+    index = _index
+    if index is not None and index.version == version:
+        return index
+    with _lock:
+        path = settings.INGREDIENT_INDEX_PATH
+        index = _open(path)
+        if index is None or index.version != version:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(f'{path}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                index = _open(path)
+                if index is None or index.version != version:
+                    build(path, version)
+                    index = AutocompleteIndex(path)
+        _index = index
+    return index
+
+
+def search(query, limit):
+    return get_index().search(query, limit)
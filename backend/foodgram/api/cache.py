@@ -0,0 +1,134 @@
+"""
+Collection version stamps and the response cache for anonymous recipe
+list and detail requests.
+
+Cached entries are keyed on the recipes generation plus the normalized
+query string. Any change to recipes, their ingredients or tags bumps the
+generation (see api/signals.py), which orphans every cached response at
+once; orphans then expire through RECIPE_CACHE_TIMEOUT. The same stamps
+back the ETags of api/conditional.py.
+"""
+import hashlib
+import uuid
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+HITS_KEY = 'recipes:cache:hits'
+MISSES_KEY = 'recipes:cache:misses'
+
+
+def get_version(name):
+    """
+    Version stamp of a collection ('recipes', 'tags', 'ingredients',
+    'viewer:<user id>'). Stamps are random tokens rather than counters,
+    so a process whose cache lost a stamp can never reissue an old one.
+    """
+    key = f'{name}:version'
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name):
+    cache.set(f'{name}:version', uuid.uuid4().hex, timeout=None)
+
+
+def bump_version_on_commit(name):
+    transaction.on_commit(lambda: bump_version(name))
+
+
+def get_generation():
+    return get_version('recipes')
+
+
+def bump_generation():
+    bump_version('recipes')
+
+
+def invalidate_on_commit():
+    transaction.on_commit(bump_generation)
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def get_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'generation': get_generation(),
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
+
+
+def make_query_string(request):
+    """Query string with parameters and their values sorted."""
+    params = sorted(
+        (key, sorted(request.query_params.getlist(key)))
+        for key in request.query_params
+    )
+    return urlencode(params, doseq=True)
+
+
+def make_key(request, generation):
+    query = make_query_string(request)
+    digest = hashlib.md5(
+        f'{request.path}?{query}'.encode('utf-8')).hexdigest()
+    return f'recipes:response:{generation}:{digest}'
+
+
+def is_cacheable(request):
+    return request.method == 'GET' and not request.user.is_authenticated
+
+
+def cached_data(request, build):
+    """
+    Return (data, hit) for an anonymous request, calling build() to
+    produce the response data on a miss.
+    """
+    key = make_key(request, get_generation())
+    data = cache.get(key)
+    if data is not None:
+        _count(HITS_KEY)
+        return data, True
+    _count(MISSES_KEY)
+    data = build()
+    cache.set(key, data, settings.RECIPE_CACHE_TIMEOUT)
+    return data, False
+
+
+class AnonymousCacheMixin:
+    """Serves anonymous list and retrieve requests from the cache."""
+
+    def cached_response(self, request, view_method, *args, **kwargs):
+        if not is_cacheable(request):
+            return view_method(request, *args, **kwargs)
+        data, hit = cached_data(
+            request, lambda: view_method(request, *args, **kwargs).data)
+        response = Response(data)
+        response['X-Cache'] = 'HIT' if hit else 'MISS'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, super().retrieve, *args, **kwargs)
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Backends that keep entries inside one process.
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """Version stamps (api/cache.py) need a cache shared by all workers."""
+    backend = settings.CACHES['default']['BACKEND']
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Warning(
+        f'Кэш {backend} не разделяется между процессами.',
+        hint=('Реестр тегов, автодополнение и кэш ответов не увидят '
+              'изменений из других воркеров. Укажите CACHE_BACKEND '
+              'с общим хранилищем (файлы, memcached).'),
+        id='api.W001',
+    )]
@@ -0,0 +1,70 @@
+"""
+Conditional GET (ETag / Last-Modified) for read-only viewset actions.
+
+ETags are built from collection version stamps (api/cache.py), so a
+matching If-None-Match is answered with 304 before any query or
+serializer runs.
+"""
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from .cache import get_version, make_query_string
+
+
+class ConditionalGetMixin:
+    """
+    Adds ETag and Last-Modified validators to list and retrieve.
+    Subclasses name the version stamps their output depends on.
+    """
+    conditional_versions = ()
+    conditional_per_viewer = False
+
+    def get_etag(self, request):
+        parts = [get_version(name) for name in self.conditional_versions]
+        if self.conditional_per_viewer:
+            parts.append(
+                get_version(f'viewer:{request.user.pk}')
+                if request.user.is_authenticated else 'anonymous')
+        parts += [
+            request.accepted_renderer.format,
+            request.path,
+            make_query_string(request),
+        ]
+        digest = hashlib.md5(':'.join(parts).encode('utf-8')).hexdigest()
+        return f'W/"{digest}"'
+
+    def get_last_modified(self, request):
+        """Last modification as a datetime, or None if unknown."""
+        return None
+
+    def conditional_response(self, request, view_method, *args, **kwargs):
+        etag = self.get_etag(request)
+        last_modified = None
+        if 'HTTP_IF_NONE_MATCH' not in request.META:
+            last_modified = self.get_last_modified(request)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = view_method(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if last_modified is None:
+                last_modified = self.get_last_modified(request)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        if self.conditional_per_viewer:
+            patch_vary_headers(response, ('Authorization',))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(
+            request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            request, super().retrieve, *args, **kwargs)
@@ -0,0 +1,131 @@
+"""
+Shopping list PDF export jobs.
+
+Rendering is CPU-bound, so large carts are rendered in a process pool
+(PDF_EXPORT_WORKERS processes per web worker) instead of the request
+thread. A job is named by the content hash of its cart (api/pdfgen.py),
+and its PDF lands in the shared PDF cache, so any web worker can answer
+for a finished job, and identical carts share one render. Who asked
+for which job, and whether it failed, is kept in ShoppingListExport
+rows, so any worker, also after a restart, answers the job's owners
+and nobody else. A job left pending for STATE_TIMEOUT seconds counts
+as failed (its worker died) and is started again on the next request.
+Carts of at most PDF_EXPORT_INLINE_ROWS lines are rendered inline.
+"""
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from core.models import ShoppingListExport
+from .pdfgen import ShoppingListRenderer, cart_path, get_renderer, touch
+from .shopping import iter_cart_totals
+
+logger = logging.getLogger(__name__)
+
+READY = ShoppingListExport.READY
+PENDING = ShoppingListExport.PENDING
+FAILED = ShoppingListExport.FAILED
+STATE_TIMEOUT = 10 * 60
+
+_executor = None
+_pending = None
+_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _render(background, rows, path):
+    # Runs in a pool process.
+    ShoppingListRenderer(background).write(rows, path)
+
+
+def _get_executor():
+    global _executor, _pending
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.PDF_EXPORT_WORKERS)
+            _pending = threading.BoundedSemaphore(
+                settings.PDF_EXPORT_MAX_PENDING)
+    return _executor
+
+
+def _finished(digest, future):
+    # Runs in a thread of the executor; a finished job is marked by its
+    # stored PDF, so only failures are written down.
+    _pending.release()
+    error = future.exception()
+    if error is None:
+        return
+    logger.error(
+        'PDF export %s failed', digest, exc_info=(
+            type(error), error, error.__traceback__))
+    try:
+        ShoppingListExport.objects.filter(
+            digest=digest, state=PENDING).update(state=FAILED)
+    finally:
+        connection.close()
+
+
+def _stale_before():
+    return timezone.now() - timedelta(seconds=STATE_TIMEOUT)
+
+
+def _record(user, digest, state):
+    ShoppingListExport.objects.update_or_create(
+        user=user, digest=digest, defaults={'state': state})
+
+
+def start(user):
+    """
+    Start exporting the user's cart, returns the job id and its state:
+    READY when the PDF is already stored or was rendered inline.
+    """
+    renderer = get_renderer()
+    rows = list(iter_cart_totals(user))
+    digest = renderer.cart_digest(rows)
+    path = cart_path(digest)
+    if touch(path):
+        _record(user, digest, READY)
+        return digest, READY
+    if (settings.PDF_EXPORT_WORKERS <= 0
+            or len(rows) <= settings.PDF_EXPORT_INLINE_ROWS):
+        renderer.write(rows, path)
+        _record(user, digest, READY)
+        return digest, READY
+    running = ShoppingListExport.objects.filter(
+        digest=digest, state=PENDING, updated_at__gte=_stale_before())
+    if running.exists():
+        _record(user, digest, PENDING)
+        return digest, PENDING
+    executor = _get_executor()
+    if not _pending.acquire(blocking=False):
+        raise QueueFull
+    _record(user, digest, PENDING)
+    future = executor.submit(_render, renderer.background, rows, path)
+    future.add_done_callback(lambda future: _finished(digest, future))
+    return digest, PENDING
+
+
+def get_state(user, digest):
+    """READY, PENDING, FAILED, or None for a job the user never started."""
+    job = ShoppingListExport.objects.filter(
+        user=user, digest=digest).first()
+    if job is None:
+        return None
+    if touch(cart_path(digest)):
+        return READY
+    if job.state == READY:
+        # The stored PDF has since been pruned.
+        return None
+    if job.state == PENDING and job.updated_at < _stale_before():
+        return FAILED
+    return job.state
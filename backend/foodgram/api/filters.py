@@ -1,5 +1,14 @@
 import django_filters
-from core.models import Ingredient
+from django import forms
+from django.db.models import Exists, OuterRef
+from django_filters.widgets import BooleanWidget, QueryArrayWidget
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.settings import api_settings
+
+from core.models import FavoriteRecipe, Ingredient, Recipe, ShoppingList
+from .fuzzy import get_fuzzy_backend, is_fuzzy
+from .search import get_search_backend
+from .tags import get_registry
 
 
 class IngredientFilter(django_filters.FilterSet):
@@ -10,3 +19,74 @@ class IngredientFilter(django_filters.FilterSet):
     class Meta:
         model = Ingredient
         fields = ['name', ]
+
+
+class SlugListField(forms.Field):
+    widget = QueryArrayWidget
+
+    def to_python(self, value):
+        return value or []
+
+
+class SlugListFilter(django_filters.Filter):
+    """Accepts ?tags=a&tags=b as well as ?tags=a,b."""
+    field_class = SlugListField
+
+
+class RecipeFilter(django_filters.FilterSet):
+    """
+    Membership filters are correlated EXISTS subqueries instead of joins,
+    so a recipe never fans out into several rows and no DISTINCT is needed.
+    """
+    tags = SlugListFilter(method='filter_tags')
+    author = django_filters.NumberFilter(field_name='author')
+    is_favorited = django_filters.BooleanFilter(
+        method='filter_is_favorited', widget=BooleanWidget)
+    is_in_shopping_cart = django_filters.BooleanFilter(
+        method='filter_is_in_shopping_cart', widget=BooleanWidget)
+
+    class Meta:
+        model = Recipe
+        fields = ['tags', 'author', 'is_favorited', 'is_in_shopping_cart']
+
+    def filter_tags(self, queryset, name, value):
+        if not value:
+            return queryset
+        return queryset.filter(Exists(
+            Recipe.tags.through.objects.filter(
+                recipe=OuterRef('pk'),
+                tag_id__in=get_registry().ids_for_slugs(value))))
+
+    def filter_by_user_membership(self, queryset, value, subquery):
+        user = self.request.user if self.request else None
+        if user is None or not user.is_authenticated:
+            return queryset.none() if value else queryset
+        if value:
+            return queryset.filter(Exists(subquery(user)))
+        return queryset.filter(~Exists(subquery(user)))
+
+    def filter_is_favorited(self, queryset, name, value):
+        return self.filter_by_user_membership(
+            queryset, value, lambda user: FavoriteRecipe.objects.filter(
+                user=user, recipe=OuterRef('pk')))
+
+    def filter_is_in_shopping_cart(self, queryset, name, value):
+        return self.filter_by_user_membership(
+            queryset, value, lambda user: ShoppingList.objects.filter(
+                user=user, recipes=OuterRef('pk')))
+
+
+class RecipeSearchFilter(BaseFilterBackend):
+    """
+    Full-text recipe search ranked by relevance, see api/search.py, or
+    typo-tolerant name search with ?fuzzy=1, see api/fuzzy.py.
+    """
+    search_param = api_settings.SEARCH_PARAM
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        if is_fuzzy(request):
+            return get_fuzzy_backend().search(queryset, query)
+        return get_search_backend().search(queryset, query)
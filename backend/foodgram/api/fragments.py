@@ -0,0 +1,77 @@
+"""
+Per-recipe cache of the viewer-independent part of RecipeSerializer
+output (author card, tags, ingredients, name, image, text, time).
+
+Fragments are stored under the recipe id and a catalog version stamp
+(api/cache.py). A single recipe is dropped when it, its ingredients,
+tags or its author change; changes to shared rows (tags, ingredients)
+bump the catalog version and orphan every fragment at once.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+
+from core.models import Recipe
+from . import cache as cache_versions
+
+NAMESPACE = 'recipes:fragments'
+# Bump whenever RecipeCardSerializer output changes shape.
+SCHEMA = 2
+
+
+def get_version():
+    return cache_versions.get_version(NAMESPACE)
+
+
+def fragment_key(recipe_id, version):
+    return f'recipes:fragment:{SCHEMA}:{version}:{recipe_id}'
+
+
+def get_fragments(recipe_ids):
+    version = get_version()
+    keys = {fragment_key(recipe_id, version): recipe_id
+            for recipe_id in recipe_ids}
+    return {
+        keys[key]: fragment
+        for key, fragment in cache.get_many(list(keys)).items()
+    }
+
+
+def set_fragments(fragments):
+    version = get_version()
+    cache.set_many(
+        {fragment_key(recipe_id, version): fragment
+         for recipe_id, fragment in fragments.items()},
+        settings.RECIPE_FRAGMENT_TIMEOUT)
+
+
+def prefetch_for_fragments(recipes):
+    """
+    Load ingredient amounts and the tag ids of recipes; tags themselves
+    come from the in-memory registry (api/tags.py).
+    """
+    prefetch_related_objects(recipes, 'ingredient_amounts__ingredient')
+    tag_ids = {recipe.pk: [] for recipe in recipes}
+    for recipe_id, tag_id in Recipe.tags.through.objects.filter(
+            recipe_id__in=tag_ids).order_by('tag_id').values_list(
+                'recipe_id', 'tag_id'):
+        tag_ids[recipe_id].append(tag_id)
+    for recipe in recipes:
+        recipe.tag_ids = tag_ids[recipe.pk]
+
+
+def _delete(recipe_ids):
+    version = get_version()
+    cache.delete_many(
+        [fragment_key(recipe_id, version) for recipe_id in recipe_ids])
+
+
+def invalidate_recipes(recipe_ids):
+    recipe_ids = list(recipe_ids)
+    if recipe_ids:
+        transaction.on_commit(lambda: _delete(recipe_ids))
+
+
+def invalidate_all():
+    cache_versions.bump_version_on_commit(NAMESPACE)
@@ -0,0 +1,171 @@
+"""
+Typo-tolerant ingredient and recipe name search by trigram similarity.
+
+Ranking follows pg_trgm's similarity(): every alphanumeric word of the
+lowercased text is padded with two spaces in front and one behind and
+cut into trigrams, and two texts score the number of trigrams they
+share divided by the number of distinct trigrams of both. Postgres
+answers with the % operator over GIN trigram indexes (migration 0006);
+on SQLite the same score is computed from an in-process inverted index
+of trigrams, rebuilt when the collection's version stamp changes.
+"""
+import re
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models import Case, CharField, FloatField, Value, When
+
+from core.models import Ingredient, Recipe
+from .cache import get_version
+
+WORD = re.compile(r'[^\W_]+')
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+def is_fuzzy(request):
+    return request.query_params.get('fuzzy', '').lower() in TRUE_VALUES
+
+
+def trigrams(text):
+    """The set of pg_trgm trigrams of text."""
+    result = set()
+    for word in WORD.findall(text.lower()):
+        padded = f'  {word} '
+        result.update(
+            padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def similarity(first, second):
+    first, second = trigrams(first), trigrams(second)
+    if not first or not second:
+        return 0.0
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared)
+
+
+class TrigramIndex:
+    """Inverted index from trigram to the ids of the texts containing it."""
+
+    def __init__(self, rows):
+        self.postings = {}
+        self.sizes = {}
+        self.texts = {}
+        for pk, text in rows:
+            grams = trigrams(text)
+            self.texts[pk] = text
+            self.sizes[pk] = len(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(pk)
+
+    def search(self, query, threshold):
+        """{id: similarity} of texts at least threshold similar to query."""
+        grams = trigrams(query)
+        if not grams:
+            return {}
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        ranks = {}
+        for pk, count in shared.items():
+            rank = count / (len(grams) + self.sizes[pk] - count)
+            if rank >= threshold:
+                ranks[pk] = rank
+        return ranks
+
+
+class FallbackFuzzyBackend:
+    """In-process trigram indexes, used on SQLite."""
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get_index(self, name, model):
+        version = get_version(name)
+        cached = self._indexes.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self._lock:
+            cached = self._indexes.get(name)
+            if cached is None or cached[0] != version:
+                index = TrigramIndex(
+                    model.objects.values_list('id', 'name').iterator())
+                cached = self._indexes[name] = (version, index)
+        return cached[1]
+
+    def ingredients(self, query, limit):
+        index = self.get_index('ingredients', Ingredient)
+        ranks = index.search(query, settings.FUZZY_SEARCH_THRESHOLD)
+        best = sorted(
+            ranks, key=lambda pk: (-ranks[pk], index.texts[pk], pk))[:limit]
+        rows = {row['id']: row for row in Ingredient.objects.filter(
+            id__in=best).values('id', 'name', 'measurement_unit')}
+        return [rows[pk] for pk in best if pk in rows]
+
+    def search(self, queryset, query):
+        ranks = self.get_index('recipes', Recipe).search(
+            query, settings.FUZZY_SEARCH_THRESHOLD)
+        if ranks:
+            # Rank only what the other filters let through, then keep
+            # the best matches, so the id list stays bounded.
+            allowed = set(queryset.order_by().values_list('id', flat=True))
+            ranks = {pk: rank for pk, rank in ranks.items() if pk in allowed}
+        best = sorted(ranks.items(), key=lambda item: (-item[1], -item[0]))
+        ranks = dict(best[:settings.FUZZY_SEARCH_MAX_CANDIDATES])
+        if not ranks:
+            return queryset.none()
+        return queryset.filter(id__in=ranks).annotate(
+            search_rank=Case(
+                *[When(id=pk, then=Value(rank))
+                  for pk, rank in ranks.items()],
+                output_field=FloatField())
+        ).order_by('-search_rank', '-id')
+
+
+class PostgresFuzzyBackend:
+    """pg_trgm similarity with the % operator over GIN trigram indexes."""
+
+    def __init__(self):
+        from django.contrib.postgres.lookups import TrigramSimilar
+        CharField.register_lookup(TrigramSimilar)
+        connection_created.connect(self.set_threshold, weak=False)
+        if connection.connection is not None:
+            self.set_threshold(connection=connection)
+
+    def set_threshold(self, connection, **kwargs):
+        if connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SET pg_trgm.similarity_threshold = %s',
+                [settings.FUZZY_SEARCH_THRESHOLD])
+
+    def _ranked(self, queryset, query):
+        from django.contrib.postgres.search import TrigramSimilarity
+        return queryset.filter(name__trigram_similar=query).annotate(
+            search_rank=TrigramSimilarity('name', query))
+
+    def ingredients(self, query, limit):
+        return list(self._ranked(Ingredient.objects.all(), query).order_by(
+            '-search_rank', 'name', 'id'
+        ).values('id', 'name', 'measurement_unit')[:limit])
+
+    def search(self, queryset, query):
+        return self._ranked(queryset, query).order_by('-search_rank', '-id')
+
+
+_backends = {}
+
+
+def get_fuzzy_backend():
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == 'postgresql':
+            _backends[vendor] = PostgresFuzzyBackend()
+        else:
+            _backends[vendor] = FallbackFuzzyBackend()
+    return _backends[vendor]
@@ -0,0 +1,177 @@
+"""
+Resized variants of recipe images (thumbnail, card, full) in WebP and
+JPEG.
+
+Variants are generated after the recipe is committed, on a small thread
+pool (IMAGE_VARIANT_WORKERS, 0 generates inline). Finished variants are
+recorded in Recipe.image_variants together with the image they were made
+from, so a replaced image is never served with stale variants. Jobs that
+do not fit the pending limit are dropped and left to the
+generate_image_variants command.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from core.models import Recipe
+from .cache import invalidate_on_commit
+from .fragments import invalidate_recipes
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = {
+    'thumbnail': (100, 100),
+    'card': (480, 480),
+    'full': (1280, 1280),
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_executor = None
+_pending = None
+_lock = threading.Lock()
+
+
+def variant_name(source, variant, extension):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return f'images/variants/{stem}/{variant}.{extension}'
+
+
+def is_ready(recipe):
+    return bool(recipe.image) and (
+        recipe.image_variants.get('source') == recipe.image.name)
+
+
+def variant_urls(recipe):
+    """Relative variant URLs by size and format, empty until generated."""
+    if not is_ready(recipe):
+        return {}
+    return {
+        variant: {
+            extension: default_storage.url(name)
+            for extension, name in formats.items()
+        }
+        for variant, formats in recipe.image_variants['files'].items()
+    }
+
+
+def _flatten(image):
+    """RGB copy of the image, with transparency composed onto white."""
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def delete_variants(source):
+    for variant in VARIANTS:
+        for extension in FORMATS:
+            default_storage.delete(variant_name(source, variant, extension))
+
+
+def render_variants(source):
+    """Write every variant of a stored image and return their names."""
+    storage = Recipe._meta.get_field('image').storage
+    with storage.open(source) as f, Image.open(f) as original:
+        image = _flatten(original)
+    files = {}
+    for variant, size in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail(size, Image.LANCZOS)
+        files[variant] = {}
+        for extension, (image_format, options) in FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, image_format, **options)
+            name = variant_name(source, variant, extension)
+            default_storage.delete(name)
+            files[variant][extension] = default_storage.save(
+                name, ContentFile(buffer.getvalue()))
+    return files
+
+
+def generate_variants(recipe_id, source):
+    """
+    Generate the variants of one recipe image and record them, unless the
+    recipe image has been replaced in the meantime.
+    """
+    if not Recipe.objects.filter(pk=recipe_id, image=source).exists():
+        return False
+    try:
+        files = render_variants(source)
+    except (OSError, ValueError) as error:
+        logger.warning(
+            'Cannot generate variants of %s for recipe %s: %s',
+            source, recipe_id, error)
+        return False
+    updated = Recipe.objects.filter(pk=recipe_id, image=source).update(
+        image_variants={'source': source, 'files': files},
+        updated_at=timezone.now())
+    if not updated:
+        return False
+    # Variants are named after their source, which may be shared, so old
+    # ones are only deleted with the source itself (api/media.py).
+    # The queryset update sends no signals.
+    invalidate_recipes([recipe_id])
+    invalidate_on_commit()
+    return True
+
+
+def _run(recipe_id, source):
+    try:
+        generate_variants(recipe_id, source)
+    except Exception:
+        logger.exception('Variant generation failed for recipe %s', recipe_id)
+    finally:
+        _pending.release()
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor, _pending
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_VARIANT_WORKERS,
+                thread_name_prefix='image-variants')
+            _pending = threading.BoundedSemaphore(
+                settings.IMAGE_VARIANT_MAX_PENDING)
+    return _executor
+
+
+def submit(recipe_id, source):
+    if settings.IMAGE_VARIANT_WORKERS <= 0:
+        generate_variants(recipe_id, source)
+        return
+    executor = _get_executor()
+    if not _pending.acquire(blocking=False):
+        logger.warning(
+            'Variant queue is full, skipping recipe %s', recipe_id)
+        return
+    executor.submit(_run, recipe_id, source)
+
+
+def schedule_variants(recipes):
+    """Generate variants of recipes whose image changed, after commit."""
+    jobs = [(recipe.pk, recipe.image.name)
+            for recipe in recipes if recipe.image and not is_ready(recipe)]
+
+    def submit_all():
+        for recipe_id, source in jobs:
+            submit(recipe_id, source)
+
+    if jobs:
+        transaction.on_commit(submit_all)
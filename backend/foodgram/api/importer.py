@@ -0,0 +1,281 @@
+"""
+Bulk recipe import from NDJSON, one recipe per line:
+
+    {"name": "...", "text": "...", "cooking_time": 30,
+     "image": "soups/borscht.jpg", "tags": ["breakfast", 3],
+     "ingredients": [{"id": 12, "amount": 200},
+                     {"name": "соль", "measurement_unit": "г",
+                      "amount": 5}]}
+
+Lines are read lazily and handled in chunks. Each chunk resolves its
+tags (by id or slug) from the tag registry and its ingredients (by id or
+name and unit) with one query, and is written with bulk_create in its
+own transaction, so a bad line or a failed chunk is reported without
+stopping the run.
+Images are copied from paths under IMPORT_IMAGE_ROOT.
+"""
+import json
+import os
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.files import File
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+from PIL import Image, UnidentifiedImageError
+
+from core.models import Ingredient, IngredientAmount, Recipe
+from .cache import invalidate_on_commit
+from .images import schedule_variants
+from .media import acquire, discard_unreferenced
+from .search import schedule_reindex
+from .tags import get_registry
+
+CHUNK_SIZE = 500
+
+
+class RecipeImportError(ValueError):
+    pass
+
+
+class ChunkReport:
+
+    def __init__(self, number):
+        self.number = number
+        self.created = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        return self.created / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'chunk': self.number,
+            'created': self.created,
+            'failed': len(self.errors),
+            'seconds': round(self.elapsed, 3),
+            'recipes_per_second': round(self.rate, 1),
+            'errors': [
+                {'line': line, 'error': error} for line, error in self.errors
+            ],
+        }
+
+
+def iter_chunks(lines, size):
+    """Yield lists of (line number, text) without reading ahead."""
+    numbered = (
+        (number, line) for number, line in enumerate(lines, start=1)
+        if line.strip()
+    )
+    while True:
+        chunk = list(islice(numbered, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _positive_int(value, field):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise RecipeImportError(f'{field} must be a positive integer')
+    return value
+
+
+def parse_line(text):
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    try:
+        data = json.loads(text)
+    except ValueError as error:
+        raise RecipeImportError(f'invalid JSON: {error}')
+    if not isinstance(data, dict):
+        raise RecipeImportError('expected a JSON object')
+    for field in ('name', 'text', 'image'):
+        if not isinstance(data.get(field), str) or not data[field].strip():
+            raise RecipeImportError(f'{field} is required')
+    if len(data['name']) > Recipe._meta.get_field('name').max_length:
+        raise RecipeImportError('name is too long')
+    _positive_int(data.get('cooking_time'), 'cooking_time')
+    tags = data.get('tags')
+    if not isinstance(tags, list) or not tags:
+        raise RecipeImportError('tags must be a non-empty list')
+    for tag in tags:
+        if isinstance(tag, bool) or not isinstance(tag, (int, str)):
+            raise RecipeImportError('tags must be ids or slugs')
+    ingredients = data.get('ingredients')
+    if not isinstance(ingredients, list) or not ingredients:
+        raise RecipeImportError('ingredients must be a non-empty list')
+    for item in ingredients:
+        if not isinstance(item, dict):
+            raise RecipeImportError('ingredients must be objects')
+        _positive_int(item.get('amount'), 'amount')
+        if 'id' in item:
+            _positive_int(item['id'], 'id')
+        elif not all(
+                isinstance(item.get(field), str) and item[field].strip()
+                for field in ('name', 'measurement_unit')):
+            raise RecipeImportError(
+                'ingredients need an id or a name and measurement_unit')
+    return data
+
+
+def ingredient_key(item):
+    if 'id' in item:
+        return item['id']
+    return (item['name'].strip(), item['measurement_unit'].strip())
+
+
+class RecipeImporter:
+
+    def __init__(self, author, image_root=None, chunk_size=CHUNK_SIZE):
+        self.author = author
+        self.image_root = os.path.realpath(
+            image_root or settings.IMPORT_IMAGE_ROOT)
+        self.chunk_size = chunk_size
+
+    def run(self, lines):
+        """Import the lines and yield a ChunkReport per chunk."""
+        for number, chunk in enumerate(
+                iter_chunks(lines, self.chunk_size), start=1):
+            yield self.import_chunk(number, chunk)
+
+    def import_chunk(self, number, chunk):
+        report = ChunkReport(number)
+        records = []
+        for line, text in chunk:
+            try:
+                records.append((line, parse_line(text)))
+            except RecipeImportError as error:
+                report.errors.append((line, str(error)))
+
+        records = self.resolve(records, report)
+        records = self.copy_images(records, report)
+        if records:
+            try:
+                report.created = self.write(records)
+            except DatabaseError as error:
+                discard_unreferenced(
+                    [data['image_name'] for _, data in records])
+                for line, data in records:
+                    report.errors.append((line, f'database error: {error}'))
+        report.errors.sort()
+        report.elapsed = time.perf_counter() - report.started
+        return report
+
+    def resolve(self, records, report):
+        """Replace tag and ingredient references with ids."""
+        if not records:
+            return []
+        tags = {}
+        for tag in get_registry().tags:
+            tags[tag.pk] = tags[tag.slug] = tag.pk
+
+        keys = {ingredient_key(item)
+                for _, data in records for item in data['ingredients']}
+        ids = [key for key in keys if not isinstance(key, tuple)]
+        names = {key[0] for key in keys if isinstance(key, tuple)}
+        ingredients = {}
+        if ids or names:
+            for pk, name, unit in Ingredient.objects.filter(
+                    Q(id__in=ids) | Q(name__in=names)
+            ).values_list('id', 'name', 'measurement_unit'):
+                ingredients[pk] = pk
+                ingredients[(name, unit)] = pk
+
+        resolved = []
+        for line, data in records:
+            try:
+                data['tag_ids'] = list(dict.fromkeys(
+                    self.lookup(tags, ref, 'tag') for ref in data['tags']))
+                amounts = {}
+                for item in data['ingredients']:
+                    pk = self.lookup(
+                        ingredients, ingredient_key(item), 'ingredient')
+                    if pk in amounts:
+                        raise RecipeImportError(
+                            f'ingredient {pk} is listed more than once')
+                    amounts[pk] = item['amount']
+                data['amounts'] = amounts
+            except RecipeImportError as error:
+                report.errors.append((line, str(error)))
+            else:
+                resolved.append((line, data))
+        return resolved
+
+    def lookup(self, known, ref, kind):
+        try:
+            return known[ref]
+        except (KeyError, TypeError):
+            raise RecipeImportError(f'unknown {kind} {ref!r}')
+
+    def copy_images(self, records, report):
+        copied = []
+        for line, data in records:
+            try:
+                data['image_name'] = self.copy_image(data['image'])
+            except RecipeImportError as error:
+                report.errors.append((line, str(error)))
+            else:
+                copied.append((line, data))
+        return copied
+
+    def copy_image(self, relative_path):
+        path = os.path.realpath(os.path.join(self.image_root, relative_path))
+        if os.path.commonpath([path, self.image_root]) != self.image_root:
+            raise RecipeImportError(
+                f'image {relative_path} is outside the root')
+        try:
+            with Image.open(path) as image:
+                image.verify()
+        except (OSError, UnidentifiedImageError):
+            raise RecipeImportError(f'image {relative_path} is not readable')
+        field = Recipe._meta.get_field('image')
+        with open(path, 'rb') as f:
+            return field.storage.save(
+                field.generate_filename(None, os.path.basename(path)),
+                File(f))
+
+    @transaction.atomic
+    def write(self, records):
+        recipes = [
+            Recipe(
+                author=self.author,
+                name=data['name'].strip(),
+                text=data['text'],
+                cooking_time=data['cooking_time'],
+                image=data['image_name'])
+            for _, data in records
+        ]
+        if connection.features.can_return_rows_from_bulk_insert:
+            Recipe.objects.bulk_create(recipes)
+        else:
+            # SQLite does not return the new ids. Its first INSERT takes
+            # the database write lock, held until this transaction ends,
+            # so the newest ids are the rows written here, in order.
+            Recipe.objects.bulk_create(recipes)
+            new_ids = list(Recipe.objects.order_by('-id').values_list(
+                'id', flat=True)[:len(recipes)])
+            for recipe, pk in zip(recipes, reversed(new_ids)):
+                recipe.pk = pk
+
+        IngredientAmount.objects.bulk_create([
+            IngredientAmount(
+                recipe_id=recipe.pk, ingredient_id=ingredient_id,
+                amount=amount)
+            for recipe, (_, data) in zip(recipes, records)
+            for ingredient_id, amount in data['amounts'].items()
+        ])
+        Recipe.tags.through.objects.bulk_create([
+            Recipe.tags.through(recipe_id=recipe.pk, tag_id=tag_id)
+            for recipe, (_, data) in zip(recipes, records)
+            for tag_id in data['tag_ids']
+        ])
+        # bulk_create sends no signals, so index and invalidate here.
+        schedule_reindex([recipe.pk for recipe in recipes])
+        schedule_variants(recipes)
+        acquire(recipe.image.name for recipe in recipes)
+        invalidate_on_commit()
+        return len(recipes)
@@ -0,0 +1,206 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api.cache import bump_generation
+from api.fragments import invalidate_all
+from core.models import Ingredient, Recipe, Tag, User
+
+# cold: response and fragment caches are orphaned before every request,
+# warm: they are left as the previous requests filled them.
+MODES = ('cold', 'warm')
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the main API endpoints against the current database '
+        '(see seed_perf) and store p50/p95 latency and query counts as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=30,
+            help='Requests per scenario')
+        parser.add_argument(
+            '--warmup', type=int, default=3,
+            help='Unmeasured requests per scenario')
+        parser.add_argument(
+            '--user', default='perf0@foodgram.ru',
+            help='Email of the user the authenticated scenarios run as')
+        parser.add_argument(
+            '--output', default='bench_results.json',
+            help='Where to write the results')
+        parser.add_argument(
+            '--compare',
+            help='Earlier results file to print the difference against')
+        parser.add_argument(
+            '--only', action='append', default=[],
+            help='Run only the named scenario, can be repeated')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email=options['user']).first()
+        if user is None:
+            raise CommandError(
+                f"User {options['user']} not found, run seed_perf first")
+        token, _ = Token.objects.get_or_create(user=user)
+        anonymous = Client(SERVER_NAME='localhost',
+                           raise_request_exception=False)
+        client = Client(SERVER_NAME='localhost',
+                        raise_request_exception=False,
+                        HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        rng = random.Random(options['seed'])
+        scenarios = self.get_scenarios(rng, user)
+        if options['only']:
+            scenarios = [s for s in scenarios if s[0] in options['only']]
+
+        results = {
+            'commit': self.get_commit(),
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'iterations': options['iterations'],
+            'recipes': Recipe.objects.count(),
+            'scenarios': {},
+        }
+        for name, authenticated, method, urls in scenarios:
+            http = client if authenticated else anonymous
+            results['scenarios'][name] = self.run_scenario(
+                http, method, urls, options['iterations'], options['warmup'])
+            self.report(name, results['scenarios'][name])
+
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        self.stdout.write(
+            self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def get_scenarios(self, rng, user):
+        recipe_ids = list(
+            Recipe.objects.order_by('-id').values_list('id', flat=True)[:500])
+        tags = list(Tag.objects.values_list('slug', flat=True))
+        names = list(Ingredient.objects.values_list('name', flat=True)[:500])
+        if not recipe_ids or not names:
+            raise CommandError('No recipes or ingredients, run seed_perf')
+        author_ids = list(Recipe.objects.filter(
+            id__in=recipe_ids).values_list('author_id', flat=True))
+
+        def tag_query():
+            return '&'.join(
+                f'tags={slug}'
+                for slug in rng.sample(tags, k=min(2, len(tags))))
+
+        return [
+            ('recipe_list', True, 'get', lambda: (
+                f'/recipes/?page={rng.randint(1, 20)}')),
+            ('recipe_list_anonymous', False, 'get', lambda: (
+                f'/recipes/?page={rng.randint(1, 20)}')),
+            ('recipe_list_deep_page', True, 'get', lambda: (
+                f'/recipes/?page={rng.randint(100, 150)}')),
+            ('recipe_list_tags', True, 'get', lambda: (
+                f'/recipes/?{tag_query()}')),
+            ('recipe_list_author', True, 'get', lambda: (
+                f'/recipes/?author={rng.choice(author_ids)}')),
+            ('recipe_list_favorited', True, 'get', lambda: (
+                '/recipes/?is_favorited=1')),
+            ('recipe_list_in_cart', True, 'get', lambda: (
+                '/recipes/?is_in_shopping_cart=1')),
+            ('recipe_detail', True, 'get', lambda: (
+                f'/recipes/{rng.choice(recipe_ids)}/')),
+            ('subscriptions', True, 'get', lambda: (
+                '/users/subscriptions/?page=1')),
+            ('ingredient_autocomplete', True, 'get', lambda: (
+                f'/ingredients/?name={rng.choice(names)[:3]}')),
+            ('download_shopping_cart', True, 'get', lambda: (
+                '/recipes/download_shopping_cart/')),
+        ]
+
+    def run_scenario(self, http, method, urls, iterations, warmup):
+        return {
+            mode: self.measure(
+                http, method, urls, iterations, warmup, mode == 'cold')
+            for mode in MODES
+        }
+
+    def measure(self, http, method, urls, iterations, warmup, cold):
+        latencies = []
+        queries = []
+        errors = 0
+        for number in range(warmup + iterations):
+            url = urls()
+            if cold:
+                # Only the cached responses go; version stamps and the
+                # per-process indexes built on them stay warm.
+                bump_generation()
+                invalidate_all()
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = getattr(http, method)(url)
+                elapsed = time.perf_counter() - started
+            if number < warmup:
+                continue
+            if response.status_code >= 400:
+                errors += 1
+            latencies.append(elapsed * 1000)
+            queries.append(len(captured))
+        return {
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'mean_ms': round(statistics.mean(latencies), 2),
+            'queries_p50': percentile(queries, 0.5),
+            'queries_max': max(queries),
+            'errors': errors,
+        }
+
+    def report(self, name, result):
+        for mode in MODES:
+            self.stdout.write(
+                f"{name:<26} {mode:<4} "
+                f"p50 {result[mode]['p50_ms']:>8.2f} ms  "
+                f"p95 {result[mode]['p95_ms']:>8.2f} ms  "
+                f"queries {result[mode]['queries_p50']:>4}  "
+                f"errors {result[mode]['errors']}")
+
+    def compare(self, path, results):
+        with open(path, encoding='utf-8') as f:
+            previous = json.load(f)
+        self.stdout.write(
+            f"\nCompared with {previous.get('commit') or path}:")
+        for name, result in results['scenarios'].items():
+            for mode in MODES:
+                before = previous['scenarios'].get(name, {}).get(mode)
+                if before is None:
+                    continue
+                after = result[mode]
+                p50 = after['p50_ms'] - before['p50_ms']
+                p95 = after['p95_ms'] - before['p95_ms']
+                queries = after['queries_p50'] - before['queries_p50']
+                self.stdout.write(
+                    f"{name:<26} {mode:<4} "
+                    f"p50 {p50:>+8.2f} ms  p95 {p95:>+8.2f} ms  "
+                    f"queries {queries:>+4}")
+
+    def get_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,78 @@
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from PIL import Image as PILImage
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+
+from api.pdfgen import PAGE_SIZE, ShoppingListRenderer, prepare_background
+
+
+class LegacyRenderer(ShoppingListRenderer):
+    """Renders as the view did before: stylesheet per PDF, resize per page."""
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+
+    def draw_background(self, canvas, doc):
+        canvas.saveState()
+        image = PILImage.open(self.source)
+        image = image.resize(PAGE_SIZE, PILImage.LANCZOS)
+        canvas.drawImage(ImageReader(image), 0, 0, A4[0], A4[1])
+        canvas.restoreState()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure shopping list PDF render time with the old per-request '
+        'setup and with the prepared renderer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations', type=int, default=20,
+            help='PDFs rendered per variant')
+        parser.add_argument(
+            '--rows', type=int, default=40,
+            help='Ingredient lines per PDF')
+        parser.add_argument(
+            '--background',
+            help='Background image (default: a generated 300 dpi A4 JPEG)')
+
+    def handle(self, *args, **options):
+        rows = [
+            {'name': f'ингредиент {number}', 'measurement_unit': 'г',
+             'amount': number + 1}
+            for number in range(options['rows'])
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            source = options['background']
+            if source is None:
+                source = os.path.join(directory, 'layer.jpg')
+                PILImage.new('RGB', (2480, 3508), '#F5E6CC').save(source)
+            variants = (
+                ('before', lambda: LegacyRenderer(source)),
+                ('after', self.prepared(source)),
+            )
+            results = {}
+            for name, factory in variants:
+                factory().render(rows)
+                timings = []
+                for _ in range(options['iterations']):
+                    started = time.perf_counter()
+                    factory().render(rows)
+                    timings.append(time.perf_counter() - started)
+                results[name] = statistics.median(timings)
+                self.stdout.write(
+                    f'{name:>6}: {results[name] * 1000:.1f} ms per PDF '
+                    f'(median of {len(timings)})')
+        self.stdout.write(self.style.SUCCESS(
+            f"{results['before'] / results['after']:.1f}x faster"))
+
+    def prepared(self, source):
+        renderer = ShoppingListRenderer(prepare_background(source))
+        return lambda: renderer
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from api.shopping import Drift, rebuild_totals
+from core.models import ShoppingCartTotal, ShoppingList
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild shopping cart totals from the recipes in every cart and '
+        'report rows that had drifted'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report drift, do not rewrite the totals')
+
+    def handle(self, *args, **options):
+        user_ids = sorted(
+            set(ShoppingList.objects.values_list('user_id', flat=True))
+            | set(ShoppingCartTotal.objects.values_list(
+                'user_id', flat=True).distinct()))
+        drift = Drift(0, 0, 0)
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            batch = rebuild_totals(
+                user_ids[start:start + BATCH_SIZE], options['dry_run'])
+            drift = Drift(*map(sum, zip(drift, batch)))
+        self.stdout.write(
+            f'{len(user_ids)} carts checked: {drift.missing} missing, '
+            f'{drift.wrong} wrong, {drift.extra} extra rows')
+        if not any(drift):
+            return
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Totals have drifted'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Totals rebuilt'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Recipe
+from api.images import generate_variants, is_ready
+
+
+class Command(BaseCommand):
+    help = 'Generate thumbnail, card and full variants of recipe images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Regenerate variants that already exist')
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='').only(
+            'id', 'image', 'image_variants').order_by('id')
+        generated = failed = 0
+        for recipe in recipes.iterator(chunk_size=500):
+            if is_ready(recipe) and not options['all']:
+                continue
+            if generate_variants(recipe.pk, recipe.image.name):
+                generated += 1
+            else:
+                failed += 1
+                self.stderr.write(
+                    f'Recipe {recipe.pk}: cannot read {recipe.image.name}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated variants for {generated} recipes, {failed} failed'))
@@ -0,0 +1,55 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import User
+from api.importer import CHUNK_SIZE, RecipeImporter
+
+
+class Command(BaseCommand):
+    help = 'Import recipes from an NDJSON file (one recipe per line)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='NDJSON file to import, "-" reads standard input')
+        parser.add_argument(
+            '--author', required=True,
+            help='Email of the user the recipes are created for')
+        parser.add_argument(
+            '--image-root',
+            help='Directory image paths are relative to '
+                 '(default IMPORT_IMAGE_ROOT)')
+        parser.add_argument(
+            '--chunk-size', type=int, default=CHUNK_SIZE,
+            help='Recipes validated and inserted per transaction')
+
+    def handle(self, *args, **options):
+        author = User.objects.filter(email=options['author']).first()
+        if author is None:
+            raise CommandError(f"User {options['author']} not found")
+        importer = RecipeImporter(
+            author, options['image_root'], options['chunk_size'])
+
+        if options['path'] == '-':
+            stream = sys.stdin
+        else:
+            try:
+                stream = open(options['path'], encoding='utf-8')
+            except OSError as error:
+                raise CommandError(error)
+
+        created = failed = 0
+        with stream:
+            for report in importer.run(stream):
+                created += report.created
+                failed += len(report.errors)
+                self.stdout.write(
+                    f'chunk {report.number}: {report.created} created, '
+                    f'{len(report.errors)} failed in '
+                    f'{report.elapsed:.2f}s ({report.rate:.0f} recipes/s)')
+                for line, error in report.errors:
+                    self.stderr.write(f'  line {line}: {error}')
+
+        style = self.style.SUCCESS if not failed else self.style.WARNING
+        self.stdout.write(
+            style(f'Imported {created} recipes, {failed} lines failed'))
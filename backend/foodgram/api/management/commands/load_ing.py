@@ -1,19 +1,186 @@
-from django.core.management.base import BaseCommand
-from core.models import Ingredient
+import csv
+import io
 import json
+import os
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import Ingredient, Recipe
+from api.cache import bump_version_on_commit, invalidate_on_commit
+from api.fragments import invalidate_all
+from api.search import schedule_reindex
+
+READ_SIZE = 64 * 1024
+BATCH_SIZE = 1000
+
+
+def normalize(text):
+    return ' '.join(str(text).split())
+
+
+def iter_csv(stream):
+    for row in csv.reader(stream):
+        if not row or row == ['name', 'measurement_unit']:
+            continue
+        yield row[0], row[1] if len(row) > 1 else ''
+
+
+def iter_json(stream):
+    """Objects of a top-level JSON array, decoded as the file is read."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != '[':
+                raise ValueError('expected a JSON array of ingredients')
+            started = True
+            position += 1
+            continue
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = stream.read(READ_SIZE)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        position = end
+        yield item['name'], item['measurement_unit']
+
+
+READERS = {'csv': iter_csv, 'json': iter_json}
 
 
 class Command(BaseCommand):
-    help = 'Load ingredients from JSON file'
+    help = (
+        'Load ingredients from CSV or JSON files, inserting new ones and '
+        'leaving the rest of the catalog in place, so it can be rerun'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*',
+            help='CSV (name,measurement_unit) or JSON files, '
+                 '"-" reads standard input (default: '
+                 'settings.INGREDIENTS_DATA_PATH)')
+        parser.add_argument(
+            '--format', choices=sorted(READERS),
+            help='Input format (default from the file extension, json for '
+                 'standard input)')
+
+    def read(self, path, input_format):
+        if input_format is None:
+            extension = os.path.splitext(path)[1].lstrip('.').lower()
+            input_format = extension if extension in READERS else 'json'
+        if path == '-':
+            yield from READERS[input_format](sys.stdin)
+            return
+        try:
+            stream = open(path, encoding='utf-8', newline='')
+        except OSError as error:
+            raise CommandError(error)
+        with stream:
+            yield from READERS[input_format](stream)
 
     def handle(self, *args, **options):
-        with open('ingredients.json', encoding='utf-8') as f:
-            data = json.load(f)
+        rows = {}
+        skipped = 0
+        for path in options['paths'] or [settings.INGREDIENTS_DATA_PATH]:
+            try:
+                for name, unit in self.read(path, options['format']):
+                    key = (normalize(name), normalize(unit))
+                    if not all(key) or len(key[0]) > 100 or len(key[1]) > 50:
+                        skipped += 1
+                        continue
+                    rows[key] = None
+            except (ValueError, KeyError, TypeError) as error:
+                raise CommandError(f'{path}: {error!r}')
+
+        with transaction.atomic():
+            inserted, updated, unchanged = self.load(rows)
+            if inserted or updated:
+                bump_version_on_commit('ingredients')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{inserted} inserted, {updated} updated, {unchanged} unchanged, '
+            f'{skipped} skipped'))
+
+    def load(self, rows):
+        """Upsert rows keyed on the normalized name and unit."""
+        existing = {}
+        changed = []
+        for ingredient in Ingredient.objects.only(
+                'id', 'name', 'measurement_unit').iterator():
+            key = (normalize(ingredient.name),
+                   normalize(ingredient.measurement_unit))
+            stored = (ingredient.name, ingredient.measurement_unit)
+            # Prefer the row already stored in normalized form.
+            if key not in existing or stored == key:
+                existing[key] = ingredient
+        unchanged = 0
+        for key in rows:
+            ingredient = existing.get(key)
+            if ingredient is None:
+                continue
+            if (ingredient.name, ingredient.measurement_unit) == key:
+                unchanged += 1
+            else:
+                ingredient.name, ingredient.measurement_unit = key
+                changed.append(ingredient)
+        Ingredient.objects.bulk_update(
+            changed, ['name', 'measurement_unit'], batch_size=BATCH_SIZE)
+        if changed:
+            # bulk_update sends no signals: date, re-index and invalidate
+            # the recipes that show the renamed ingredients here.
+            recipe_ids = list(Recipe.objects.filter(
+                ingredients__in=changed
+            ).values_list('id', flat=True).distinct())
+            Recipe.objects.filter(id__in=recipe_ids).update(
+                updated_at=timezone.now())
+            schedule_reindex(recipe_ids)
+            invalidate_all()
+            invalidate_on_commit()
 
-        for item in data:
-            ingredient = Ingredient(
-                name=item['name'], measurement_unit=item['measurement_unit'])
-            ingredient.save()
+        new = [key for key in rows if key not in existing]
+        if connection.vendor == 'postgresql':
+            inserted = self.copy(new)
+        else:
+            before = Ingredient.objects.count()
+            Ingredient.objects.bulk_create(
+                [Ingredient(name=name, measurement_unit=unit)
+                 for name, unit in new],
+                batch_size=BATCH_SIZE, ignore_conflicts=True)
+            inserted = Ingredient.objects.count() - before
+        return inserted, len(changed), unchanged
 
-        self.stdout.write(
-            self.style.SUCCESS('Ingredients loaded successfully'))
+    def copy(self, rows):
+        """COPY rows into a temporary table and insert the missing ones."""
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE ingredient_load '
+                '(name varchar(100), measurement_unit varchar(50)) '
+                'ON COMMIT DROP')
+            cursor.copy_expert(
+                'COPY ingredient_load FROM STDIN WITH (FORMAT csv)', buffer)
+            cursor.execute(
+                f'INSERT INTO {Ingredient._meta.db_table} '
+                '(name, measurement_unit) '
+                'SELECT name, measurement_unit FROM ingredient_load '
+                'ON CONFLICT (name, measurement_unit) DO NOTHING')
+            return cursor.rowcount
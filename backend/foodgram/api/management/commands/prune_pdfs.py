@@ -0,0 +1,35 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.pdfgen import cart_path, prune_carts
+from core.models import ShoppingListExport
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete rendered shopping list PDFs not downloaded for a while, '
+        'and the export jobs whose PDF is gone'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=float, default=settings.PDF_CACHE_MAX_AGE_DAYS,
+            help='Delete PDFs unused for this many days')
+
+    def handle(self, *args, **options):
+        max_age = timedelta(days=options['days'])
+        deleted = prune_carts(max_age.total_seconds())
+        old = ShoppingListExport.objects.filter(
+            updated_at__lt=timezone.now() - max_age)
+        gone = [
+            digest for digest in old.values_list(
+                'digest', flat=True).distinct()
+            if not os.path.exists(cart_path(digest))
+        ]
+        jobs, _ = old.filter(digest__in=gone).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {deleted} PDFs and {jobs} export jobs'))
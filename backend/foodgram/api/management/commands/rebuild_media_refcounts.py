@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from core.models import Recipe, StoredFile
+from api.media import collect
+
+
+class Command(BaseCommand):
+    help = (
+        'Recount how many recipes use each stored image, adopting images '
+        'saved before deduplicated storage'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--collect', action='store_true',
+            help='Delete tracked files that no recipe uses any more')
+
+    def handle(self, *args, **options):
+        counts = dict(
+            Recipe.objects.exclude(image='').values('image').annotate(
+                references=Count('id')).values_list('image', 'references'))
+        with transaction.atomic():
+            tracked = dict(
+                StoredFile.objects.values_list('name', 'references'))
+            StoredFile.objects.all().delete()
+            StoredFile.objects.bulk_create(
+                [StoredFile(name=name, references=0)
+                 for name in tracked if name not in counts]
+                + [StoredFile(name=name, references=references)
+                   for name, references in counts.items()],
+                batch_size=1000)
+
+        changed = sum(
+            1 for name in set(tracked) | set(counts)
+            if tracked.get(name) != counts.get(name))
+        orphans = [name for name in tracked if name not in counts]
+        self.stdout.write(
+            f'{len(counts)} files in use, {changed} counts corrected, '
+            f'{len(orphans)} unused')
+        if options['collect'] and orphans:
+            collect(orphans)
+            self.stdout.write(
+                self.style.SUCCESS(f'Deleted {len(orphans)} unused files'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Recipe
+from api.search import reindex
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for recipes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing', action='store_true',
+            help='Only index recipes that have no search document yet')
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of recipes indexed per batch')
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.order_by('id')
+        if options['missing']:
+            recipes = recipes.filter(search_document__isnull=True)
+        recipe_ids = list(recipes.values_list('id', flat=True))
+        batch_size = options['batch_size']
+
+        indexed = 0
+        for start in range(0, len(recipe_ids), batch_size):
+            indexed += reindex(recipe_ids[start:start + batch_size])
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Indexed {indexed} recipes'))
@@ -0,0 +1,216 @@
+import io
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from PIL import Image
+
+from api.cache import bump_generation, bump_version
+from api.fragments import invalidate_all
+from api.media import acquire
+from api.search import reindex
+from api.shopping import refresh_totals
+from core.models import (
+    FavoriteRecipe,
+    Ingredient,
+    IngredientAmount,
+    Recipe,
+    ShoppingList,
+    Subscription,
+    Tag,
+    User,
+)
+
+PREFIX = 'perf'
+PASSWORD = 'perf-password'
+BATCH_SIZE = 1000
+WORDS = (
+    'суп', 'каша', 'салат', 'пирог', 'рагу', 'омлет', 'запеканка', 'блины',
+    'плов', 'борщ', 'котлеты', 'паста', 'жаркое', 'соус', 'десерт', 'кекс',
+)
+ADJECTIVES = (
+    'домашний', 'быстрый', 'овощной', 'сырный', 'острый', 'сладкий',
+    'летний', 'зимний', 'праздничный', 'легкий', 'грибной', 'рыбный',
+)
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users, recipes and lists for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=5000)
+        parser.add_argument('--tags', type=int, default=6)
+        parser.add_argument(
+            '--ingredients-per-recipe', type=int, default=8)
+        parser.add_argument(
+            '--favorites-per-user', type=int, default=30)
+        parser.add_argument(
+            '--subscriptions-per-user', type=int, default=10)
+        parser.add_argument(
+            '--cart-per-user', type=int, default=5)
+        parser.add_argument(
+            '--seed', type=int, default=42,
+            help='Random seed, the same seed gives the same data set')
+        parser.add_argument(
+            '--flush', action='store_true',
+            help='Delete data from a previous seed_perf run first')
+        parser.add_argument(
+            '--no-index', action='store_true',
+            help='Skip building search documents for the new recipes')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        if options['flush']:
+            self.flush()
+
+        with transaction.atomic():
+            users = self.create_users(options['users'])
+            tags = self.create_tags(options['tags'])
+            ingredients = self.get_ingredients()
+            recipes = self.create_recipes(
+                rng, options['recipes'], users, tags, ingredients,
+                options['ingredients_per_recipe'])
+            self.create_favorites(
+                rng, users, recipes, options['favorites_per_user'])
+            self.create_subscriptions(
+                rng, users, options['subscriptions_per_user'])
+            self.create_shopping_lists(
+                rng, users, recipes, options['cart_per_user'])
+
+        if not options['no_index']:
+            for start in range(0, len(recipes), BATCH_SIZE):
+                reindex(recipes[start:start + BATCH_SIZE])
+        # Bulk inserts bypass the signals that keep caches in sync.
+        for name in ('tags', 'ingredients'):
+            bump_version(name)
+        bump_generation()
+        invalidate_all()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(users)} users, {len(tags)} tags and '
+            f'{len(recipes)} recipes (seed {options["seed"]}). '
+            f'Users log in as {PREFIX}0@foodgram.ru / {PASSWORD}'))
+
+    def flush(self):
+        users = User.objects.filter(username__startswith=f'{PREFIX}-user-')
+        deleted, _ = users.delete()
+        Tag.objects.filter(slug__startswith=f'{PREFIX}-tag-').delete()
+        self.stdout.write(f'Deleted {deleted} rows of previous perf data')
+
+    def create_users(self, count):
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(
+                username=f'{PREFIX}-user-{number}',
+                email=f'{PREFIX}{number}@foodgram.ru',
+                first_name='Повар',
+                last_name=str(number),
+                password=password)
+            for number in range(count)
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+        return list(User.objects.filter(
+            username__startswith=f'{PREFIX}-user-'
+        ).order_by('id').values_list('id', flat=True))
+
+    def create_tags(self, count):
+        Tag.objects.bulk_create([
+            Tag(
+                name=f'Тег {number}',
+                color=f'#{number * 40 % 256:02X}{number * 90 % 256:02X}80',
+                slug=f'{PREFIX}-tag-{number}')
+            for number in range(count)
+        ], ignore_conflicts=True)
+        return list(Tag.objects.filter(
+            slug__startswith=f'{PREFIX}-tag-'
+        ).order_by('id').values_list('id', flat=True))
+
+    def get_ingredients(self):
+        ingredients = list(
+            Ingredient.objects.order_by('id').values_list('id', flat=True))
+        if not ingredients:
+            Ingredient.objects.bulk_create([
+                Ingredient(name=f'ингредиент {number}', measurement_unit='г')
+                for number in range(500)
+            ])
+            ingredients = list(Ingredient.objects.order_by(
+                'id').values_list('id', flat=True))
+        return ingredients
+
+    def store_image(self):
+        """One image shared by every recipe, as identical uploads are."""
+        content = io.BytesIO()
+        Image.new('RGB', (640, 480), '#D9A066').save(content, 'PNG')
+        storage = Recipe._meta.get_field('image').storage
+        return storage.save(
+            f'images/{PREFIX}.png', ContentFile(content.getvalue()))
+
+    def create_recipes(self, rng, count, users, tags, ingredients,
+                       ingredients_per_recipe):
+        first_new_id = (Recipe.objects.order_by(
+            '-id').values_list('id', flat=True).first() or 0) + 1
+        image = self.store_image()
+        Recipe.objects.bulk_create([
+            Recipe(
+                author_id=rng.choice(users),
+                name=f'{rng.choice(ADJECTIVES)} {rng.choice(WORDS)} '
+                     f'{number}'.capitalize(),
+                text=' '.join(rng.choices(ADJECTIVES + WORDS, k=40)),
+                cooking_time=rng.randint(5, 180),
+                image=image)
+            for number in range(count)
+        ], batch_size=BATCH_SIZE)
+        recipes = list(Recipe.objects.filter(
+            id__gte=first_new_id).order_by('id').values_list('id', flat=True))
+        acquire([image] * len(recipes))
+
+        tag_links = []
+        amounts = []
+        for recipe_id in recipes:
+            tag_count = rng.randint(1, min(3, len(tags)))
+            for tag_id in rng.sample(tags, k=tag_count):
+                tag_links.append(Recipe.tags.through(
+                    recipe_id=recipe_id, tag_id=tag_id))
+            for ingredient_id in rng.sample(
+                    ingredients, k=min(ingredients_per_recipe,
+                                       len(ingredients))):
+                amounts.append(IngredientAmount(
+                    recipe_id=recipe_id,
+                    ingredient_id=ingredient_id,
+                    amount=rng.randint(1, 500)))
+        Recipe.tags.through.objects.bulk_create(
+            tag_links, batch_size=BATCH_SIZE)
+        IngredientAmount.objects.bulk_create(amounts, batch_size=BATCH_SIZE)
+        return recipes
+
+    def create_favorites(self, rng, users, recipes, per_user):
+        FavoriteRecipe.objects.bulk_create([
+            FavoriteRecipe(user_id=user_id, recipe_id=recipe_id)
+            for user_id in users
+            for recipe_id in rng.sample(recipes, k=min(per_user, len(recipes)))
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    def create_subscriptions(self, rng, users, per_user):
+        Subscription.objects.bulk_create([
+            Subscription(subscriber_id=user_id, subscribed_to_id=author_id)
+            for user_id in users
+            for author_id in rng.sample(users, k=min(per_user, len(users)))
+            if author_id != user_id
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    def create_shopping_lists(self, rng, users, recipes, per_user):
+        ShoppingList.objects.bulk_create(
+            [ShoppingList(user_id=user_id) for user_id in users],
+            batch_size=BATCH_SIZE, ignore_conflicts=True)
+        shopping_lists = ShoppingList.objects.filter(
+            user_id__in=users).order_by('id').values_list('id', flat=True)
+        ShoppingList.recipes.through.objects.bulk_create([
+            ShoppingList.recipes.through(
+                shoppinglist_id=shopping_list_id, recipe_id=recipe_id)
+            for shopping_list_id in shopping_lists
+            for recipe_id in rng.sample(recipes, k=min(per_user, len(recipes)))
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+        for start in range(0, len(users), BATCH_SIZE):
+            refresh_totals(users[start:start + BATCH_SIZE])
@@ -0,0 +1,78 @@
+"""
+Reference counting for recipe images in content-addressed storage.
+
+Several recipes can point at the same stored file, so a file is only
+deleted, together with its variants, once the last reference to it is
+released. Names without a StoredFile row (files stored before
+deduplication) are never deleted here; rebuild_media_refcounts adopts
+them. collect() and acquire() lock the StoredFile row, so a file is
+never deleted while a new reference to it is being added.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+
+from core.models import Recipe, StoredFile
+from .images import delete_variants
+
+
+def _by_name(counts, sign=1):
+    return Case(
+        *[When(name=name, then=Value(sign * count))
+          for name, count in counts.items()],
+        default=Value(0), output_field=IntegerField())
+
+
+def acquire(names):
+    """Add a reference to each name, once per occurrence."""
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return
+    with transaction.atomic():
+        # Wait for a collect() of the same files to finish, and keep it
+        # from deleting them until the new references are committed.
+        list(StoredFile.objects.select_for_update().filter(
+            name__in=counts).order_by('name').values_list('pk', flat=True))
+        StoredFile.objects.bulk_create(
+            [StoredFile(name=name) for name in counts],
+            ignore_conflicts=True)
+        StoredFile.objects.filter(name__in=counts).update(
+            references=F('references') + _by_name(counts))
+
+
+def release(names):
+    """Drop a reference to each name and delete unused files on commit."""
+    counts = Counter(name for name in names if name)
+    if not counts:
+        return
+    StoredFile.objects.filter(name__in=counts).update(
+        references=Greatest(F('references') + _by_name(counts, -1), 0))
+    transaction.on_commit(lambda: collect(counts))
+
+
+def collect(names):
+    """Delete the given files if nothing references them any more."""
+    storage = Recipe._meta.get_field('image').storage
+    for name in names:
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(
+                name=name).first()
+            if stored is None or stored.references:
+                continue
+            stored.delete()
+            storage.delete(name)
+            delete_variants(name)
+
+
+def discard_unreferenced(names):
+    """Delete freshly stored files that no row ended up referencing."""
+    storage = Recipe._meta.get_field('image').storage
+    names = set(names)
+    used = set(StoredFile.objects.filter(
+        name__in=names).values_list('name', flat=True))
+    used.update(Recipe.objects.filter(
+        image__in=names).values_list('image', flat=True))
+    for name in names - used:
+        storage.delete(name)
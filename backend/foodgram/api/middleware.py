@@ -0,0 +1,223 @@
+"""
+Per-request profiling: DB query count and time, serializer time and
+render time, reported as Server-Timing headers and structured log lines.
+Serializer time is the time spent building Serializer.data outside the
+database. It is measured by ProfiledSerializerMixin, whose
+get_serializer() hands generic views a proxy that times .data, so only
+views using the mixin report it; serializer classes are never patched.
+
+Only a sample of requests (REQUEST_PROFILING_SAMPLE_RATE) is profiled;
+the rest pass straight through. Within a profiled request, repeated
+identical SQL shapes are reported as N+1 suspects together with the view
+and the serializer field that issued them.
+"""
+import contextvars
+import json
+import logging
+import random
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection
+from rest_framework import serializers
+from rest_framework.views import APIView
+
+logger = logging.getLogger(__name__)
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+PLACEHOLDER_LIST_RE = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+NUMBER_RE = re.compile(r'\b\d+\b')
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+STACK_DEPTH = 60
+
+
+def sql_shape(sql):
+    """SQL with literals and IN lists collapsed, so repeats compare equal."""
+    sql = PLACEHOLDER_LIST_RE.sub('(%s, ...)', sql)
+    sql = STRING_RE.sub('?', sql)
+    return NUMBER_RE.sub('?', sql)
+
+
+def find_query_site():
+    """
+    Name the serializer field, serializer method or view method that
+    issued the current query, e.g. 'RecipeSerializer.get_is_favorited'.
+    """
+    frame = sys._getframe(2)
+    serializer_site = view_site = None
+    for _ in range(STACK_DEPTH):
+        if frame is None:
+            break
+        owner = frame.f_locals.get('self')
+        name = frame.f_code.co_name
+        if isinstance(owner, serializers.Serializer):
+            method_fields = {
+                field.method_name for field in owner.fields.values()
+                if isinstance(field, serializers.SerializerMethodField)
+            }
+            if name in method_fields:
+                return f'{type(owner).__name__}.{name}'
+            field = frame.f_locals.get('field')
+            if name == 'to_representation' and field is not None:
+                return f'{type(owner).__name__}.{field.field_name}'
+            serializer_site = serializer_site or (
+                f'{type(owner).__name__}.{name}')
+        elif isinstance(owner, serializers.BaseSerializer):
+            serializer_site = serializer_site or (
+                f'{type(owner).__name__}.{name}')
+        elif isinstance(owner, APIView) and view_site is None:
+            view_site = f'{type(owner).__name__}.{name}'
+        frame = frame.f_back
+    return serializer_site or view_site
+
+
+class RequestProfile:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.render_started = None
+        self.render_time = 0.0
+        self.shapes = Counter()
+        self.sites = defaultdict(set)
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapper hook"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            shape = sql_shape(sql)
+            self.shapes[shape] += 1
+            # The stack is only walked for shapes that already repeat.
+            if self.shapes[shape] > 1:
+                site = find_query_site()
+                if site:
+                    self.sites[shape].add(site)
+
+    def add_serializer_time(self, elapsed, db_time):
+        self.serializer_time += elapsed - db_time
+
+    def start_render(self):
+        self.render_started = time.perf_counter()
+
+    def finish_render(self, response):
+        if self.render_started is not None:
+            self.render_time = time.perf_counter() - self.render_started
+
+    def repeated_queries(self, threshold):
+        return [
+            (shape, count, sorted(self.sites[shape]))
+            for shape, count in self.shapes.most_common()
+            if count >= threshold
+        ]
+
+
+class TimedSerializer:
+    """Serializer proxy adding the time spent in .data to a profile."""
+
+    def __init__(self, serializer, profile):
+        self._serializer = serializer
+        self._profile = profile
+
+    @property
+    def data(self):
+        started = time.perf_counter()
+        db_time = self._profile.db_time
+        try:
+            return self._serializer.data
+        finally:
+            self._profile.add_serializer_time(
+                time.perf_counter() - started,
+                self._profile.db_time - db_time)
+
+    def __getattr__(self, name):
+        return getattr(self._serializer, name)
+
+
+class ProfiledSerializerMixin:
+    """Reports the serializer time of a generic view's requests."""
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        profile = _current_profile.get()
+        if profile is None:
+            return serializer
+        return TimedSerializer(serializer, profile)
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    view = getattr(match.func, 'cls', match.func)
+    return f'{view.__module__}.{view.__name__}'
+
+
+class RequestProfilingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.REQUEST_PROFILING_SAMPLE_RATE
+        self.threshold = settings.REQUEST_PROFILING_N_PLUS_ONE_THRESHOLD
+
+    def __call__(self, request):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        try:
+            with connection.execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        total = time.perf_counter() - profile.started
+        self.report(request, response, profile, total)
+        return response
+
+    def process_template_response(self, request, response):
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.start_render()
+            response.add_post_render_callback(profile.finish_render)
+        return response
+
+    def report(self, request, response, profile, total):
+        response['Server-Timing'] = ', '.join((
+            f'db;dur={profile.db_time * 1000:.1f};'
+            f'desc="{profile.queries} queries"',
+            f'serializer;dur={profile.serializer_time * 1000:.1f}',
+            f'render;dur={profile.render_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ))
+        view = _view_name(request)
+        logger.info(json.dumps({
+            'event': 'request',
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'queries': profile.queries,
+            'db_ms': round(profile.db_time * 1000, 2),
+            'serializer_ms': round(profile.serializer_time * 1000, 2),
+            'render_ms': round(profile.render_time * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+        }))
+        for shape, count, sites in profile.repeated_queries(self.threshold):
+            logger.warning(json.dumps({
+                'event': 'n_plus_one',
+                'path': request.path,
+                'view': view,
+                'count': count,
+                'sites': sites,
+                'sql': shape,
+            }, ensure_ascii=False))
@@ -1,4 +1,5 @@
-from rest_framework.pagination import (LimitOffsetPagination,
+from rest_framework.pagination import (CursorPagination,
+                                       LimitOffsetPagination,
                                        PageNumberPagination)
 
 
@@ -19,3 +20,50 @@ class CustomPagination(
                 self, data)
         else:
             return PageNumberPagination.get_paginated_response(self, data)
+
+
+class RecipeCursorPagination(CursorPagination):
+    """
+    Keyset pagination on recipe id, no COUNT and no OFFSET scan.
+    Ordering is limited to id / -id so the cursor stays unique; it
+    defaults to id like RecipeViewSet. Searches keep their relevance
+    order, with ties on the rank broken by id.
+    """
+    ordering = 'id'
+    ordering_param = 'ordering'
+
+    def get_ordering(self, request, queryset, view):
+        if 'search_rank' in queryset.query.annotations:
+            return ('-search_rank', '-id')
+        ordering = request.query_params.get(self.ordering_param)
+        if ordering in ('id', '-id'):
+            return (ordering,)
+        return (self.ordering,)
+
+
+class RecipePagination(PageNumberPagination):
+    """
+    Page numbers by default, cursor mode when the request carries
+    a `cursor` query parameter (an empty one starts from the top).
+    """
+    cursor_pagination_class = RecipeCursorPagination
+    cursor_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if self.cursor_pagination_class.cursor_query_param in \
+                request.query_params:
+            self.cursor_paginator = self.cursor_pagination_class()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
@@ -1,125 +1,216 @@
+"""
+Shopping list PDF.
+
+Everything a PDF needs apart from the ingredient lines is prepared once
+per process: the font is registered at import, the paragraph style and
+frame geometry live on ShoppingListRenderer, and the MEDIA_ROOT/layer.jpg
+background is scaled to A4 once and kept as a JPEG under PDF_CACHE_DIR,
+which reportlab embeds as is. A request only lays out its text.
+
+Rendered PDFs are kept under PDF_CACHE_DIR/carts, named by a hash of the
+aggregated cart and the renderer version, so downloading an unchanged
+cart again costs the totals query and a hash. Files are written to a
+temporary name and renamed into place, so concurrent requests never see
+a partial file, and are sent by nginx when PDF_ACCEL_REDIRECT_PREFIX is
+set. Every download touches the file, so its mtime is the time it was
+last used; prune_carts (the prune_pdfs command) deletes the files unused
+for PDF_CACHE_MAX_AGE_DAYS.
+"""
+import hashlib
 import os
-from reportlab.lib.units import inch
-from django.http import HttpResponse
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from io import BytesIO
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from django.template.loader import get_template
+from xml.sax.saxutils import escape
+
 from django.conf import settings
-from django.http import HttpResponse
-from django.views.decorators.csrf import csrf_exempt
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import inch
-from reportlab.platypus import Paragraph
-from reportlab.lib.fonts import addMapping
-from rest_framework.decorators import api_view
+from django.http import FileResponse, HttpResponse
 from PIL import Image as PILImage
 from reportlab.lib.colors import HexColor
+from reportlab.lib.fonts import addMapping
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
-from reportlab.platypus import Frame
-from reportlab.platypus import PageTemplate
-from reportlab.platypus import BaseDocTemplate
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import Paragraph
-
-from core.models import (
-    Recipe,
-    IngredientAmount,
-    ShoppingList
-)
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate, Paragraph
 
 dejavu_sans_ttf = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
 pdfmetrics.registerFont(TTFont("DejaVuSans", dejavu_sans_ttf))
 addMapping('DejaVuSans', 0, 0, 'DejaVuSans')
-INCH = 1
-LEFT_MARGIN = 1.2 * INCH
-TOP_MARGIN = 2 * INCH
-FRAME_WIDTH = 10 * INCH
-FRAME_HEIGHT = 9 * INCH
+LEFT_MARGIN = 1.2 * inch
+TOP_MARGIN = 2 * inch
+BOTTOM_MARGIN = 1 * inch
+FRAME_WIDTH = A4[0] - 2 * LEFT_MARGIN
+FRAME_HEIGHT = A4[1] - TOP_MARGIN - BOTTOM_MARGIN
 FONT_SIZE = 20
 LEADING = 52
 TEXT_COLOR = HexColor("#000000")
-
-
-@api_view(['POST', 'GET'])
-@csrf_exempt
-def download_shopping_cart_t(request):
-    print("download_shopping_cart function was called")
-    if not request.user.is_authenticated:
-        return HttpResponse('Unauthorized', status=401)
-
-    user = request.user
-    favorite_rec = ShoppingList.objects.filter(user=user)
-    recipes = Recipe.objects.filter(shopping_lists__in=favorite_rec)
-    ingredients = IngredientAmount.objects.select_related(
-        'ingredient').filter(recipe__in=recipes)
-
-    shopping_cart = {}
-    for ingredient in ingredients:
-        name = ingredient.ingredient.name
-        if name in shopping_cart:
-            shopping_cart[name]['amount'] += ingredient.amount
-        else:
-            shopping_cart[name] = {
-                'measurement_unit': ingredient.ingredient.measurement_unit,
-                'amount': ingredient.amount
-            }
-
-    buffer = BytesIO()
-    doc = BaseDocTemplate(buffer, pagesize=A4)
-
-    styles = getSampleStyleSheet()
-    styles['Normal'].fontName = 'DejaVuSans'
-    styles['Normal'].fontSize = FONT_SIZE
-    styles['Normal'].textColor = TEXT_COLOR
-    styles['Normal'].leading = LEADING 
-
-    frame_margin_left = LEFT_MARGIN
-    frame_margin_top = TOP_MARGIN
-    frame_width = FRAME_WIDTH
-    frame_height = FRAME_HEIGHT
-
-    class BackgroundPageTemplate(PageTemplate):
-        def beforeDrawPage(self, canvas, doc):
-            draw_background_image(canvas, doc)
-
-    def draw_background_image(canvas, doc):
+SQUARE = "<font name='DejaVuSans' size=35>☐</font>"
+BACKGROUND_NAME = 'layer.jpg'
+PAGE_SIZE = tuple(map(int, A4))
+# Bump whenever the layout changes, so cached PDFs are rendered again.
+TEMPLATE_VERSION = 1
+
+_renderer = None
+_lock = threading.Lock()
+
+
+@contextmanager
+def atomic_file(path):
+    """Open a temporary file next to path and move it there on success."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def prepare_background(source):
+    """
+    Scale the background to the page once and store it as a JPEG named
+    after the source file's path, size and modification time.
+    """
+    stat = os.stat(source)
+    digest = hashlib.sha1(
+        f'{source}:{stat.st_size}:{stat.st_mtime_ns}:{PAGE_SIZE}'.encode()
+    ).hexdigest()
+    path = os.path.join(settings.PDF_CACHE_DIR, f'background-{digest}.jpg')
+    if os.path.exists(path):
+        return path
+    with PILImage.open(source) as image:
+        scaled = image.convert('RGB').resize(PAGE_SIZE, PILImage.LANCZOS)
+    with atomic_file(path) as f:
+        scaled.save(f, 'JPEG', quality=90)
+    return path
+
+
+class ShoppingListRenderer:
+    """Lays out shopping list rows over a prepared background."""
+
+    def __init__(self, background=None):
+        self.background = background
+        self.version = f'{TEMPLATE_VERSION}:{background}'
+        self.style = ParagraphStyle(
+            'ShoppingList',
+            parent=getSampleStyleSheet()['Normal'],
+            fontName='DejaVuSans',
+            fontSize=FONT_SIZE,
+            textColor=TEXT_COLOR,
+            leading=LEADING)
+
+    def draw_background(self, canvas, doc):
+        if self.background is None:
+            return
         canvas.saveState()
-        file_name = 'layer.jpg'
-        img_path = os.path.join(settings.MEDIA_ROOT, file_name)
-        im = PILImage.open(img_path)
-        im = im.resize(tuple(map(int, A4)), PILImage.ANTIALIAS)
-        pdf_img = ImageReader(im)
-        canvas.drawImage(pdf_img, 0, 0, A4[0], A4[1])
+        canvas.drawImage(self.background, 0, 0, A4[0], A4[1])
         canvas.restoreState()
 
-    frame = Frame(
-        frame_margin_left,
-        A4[1] - frame_margin_top - frame_height,
-        frame_width,
-        frame_height)
-    doc.addPageTemplates([BackgroundPageTemplate(frames=frame)])
-
-    square = "<font name='DejaVuSans' size=35>☐</font>"
-    ingredients_text = "<br/>".join(
-        f"{name}: {data['amount']} {data['measurement_unit']} {square}"
-        for name, data in shopping_cart.items()
-    )
-    ingredients_p = Paragraph(ingredients_text, styles["Normal"])
-
-    story = [ingredients_p]
-
-    doc.build(story)
-
-    buffer.seek(0)
-
-    file_name = f"{user.username}_shopping_cart.pdf"
-    file_content = buffer.getvalue()
-    file_path = os.path.join(settings.MEDIA_ROOT, file_name)
-    with open(file_path, 'wb') as f:
-        f.write(file_content)
-
-    response = HttpResponse(file_content, content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
-    return response
+    def render(self, rows):
+        """PDF bytes for {'name', 'measurement_unit', 'amount'} rows."""
+        buffer = BytesIO()
+        doc = BaseDocTemplate(buffer, pagesize=A4)
+        frame = Frame(
+            LEFT_MARGIN, BOTTOM_MARGIN, FRAME_WIDTH, FRAME_HEIGHT)
+        doc.addPageTemplates(
+            [PageTemplate(frames=frame, onPage=self.draw_background)])
+        text = "<br/>".join(
+            f"{escape(row['name'])}: {row['amount']} "
+            f"{escape(row['measurement_unit'])} {SQUARE}"
+            for row in rows)
+        doc.build([Paragraph(text, self.style)])
+        return buffer.getvalue()
+
+    def cart_digest(self, rows):
+        digest = hashlib.sha256(self.version.encode())
+        for row in rows:
+            digest.update(
+                f"{row['name']}\x1f{row['measurement_unit']}\x1f"
+                f"{row['amount']}\n".encode())
+        return digest.hexdigest()
+
+    def write(self, rows, path):
+        content = self.render(rows)
+        with atomic_file(path) as f:
+            f.write(content)
+
+    def cached_pdf(self, rows):
+        """Path of the PDF for rows, rendered only if not stored yet."""
+        rows = list(rows)
+        path = cart_path(self.cart_digest(rows))
+        if not touch(path):
+            self.write(rows, path)
+        return path
+
+
+def cart_path(digest):
+    return os.path.join(
+        settings.PDF_CACHE_DIR, 'carts', digest[:2], f'{digest}.pdf')
+
+
+def touch(path):
+    """Mark a stored PDF as used now, False if it is not stored."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def prune_carts(max_age):
+    """Delete cart PDFs unused for max_age seconds, returns how many."""
+    cutoff = time.time() - max_age
+    deleted = 0
+    for directory, _, names in os.walk(
+            os.path.join(settings.PDF_CACHE_DIR, 'carts')):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                continue
+    return deleted
+
+
+def get_renderer():
+    """The renderer for the current background, prepared once."""
+    global _renderer
+    source = os.path.join(settings.MEDIA_ROOT, BACKGROUND_NAME)
+    try:
+        stat = os.stat(source)
+        key = (source, stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        key = None
+    renderer = _renderer
+    if renderer is not None and renderer[0] == key:
+        return renderer[1]
+    with _lock:
+        if _renderer is None or _renderer[0] != key:
+            background = prepare_background(source) if key else None
+            _renderer = (key, ShoppingListRenderer(background))
+        return _renderer[1]
+
+
+def pdf_response(path, file_name):
+    """Send a stored PDF, through nginx if X-Accel-Redirect is set up."""
+    prefix = settings.PDF_ACCEL_REDIRECT_PREFIX
+    if prefix:
+        response = HttpResponse(content_type='application/pdf')
+        response['X-Accel-Redirect'] = prefix + os.path.relpath(
+            path, settings.PDF_CACHE_DIR).replace(os.sep, '/')
+        response['Content-Disposition'] = (
+            f'attachment; filename="{file_name}"')
+        return response
+    return FileResponse(
+        open(path, 'rb'), as_attachment=True, filename=file_name,
+        content_type='application/pdf')
@@ -0,0 +1,318 @@
+"""
+Full-text recipe search.
+
+Every recipe has a RecipeSearchDocument built from its name, ingredient
+names and text. On PostgreSQL the document carries a weighted `tsvector`
+(russian config) behind a GIN index; on other databases the stemmed
+lexemes are stored as text and ranked in process with the same weights.
+"""
+import re
+import threading
+
+from django.db import connection, transaction
+from django.db.models import Case, F, FloatField, Value, When
+
+from core.models import (
+    Ingredient,
+    IngredientAmount,
+    Recipe,
+    RecipeSearchDocument,
+    SearchVectorTextField,
+)
+
+SEARCH_CONFIG = 'russian'
+
+# Same defaults as ts_rank: A (name), B (ingredients), C (text).
+WEIGHTS = (1.0, 0.4, 0.2)
+
+WORD_RE = re.compile(r'\w+')
+
+STOP_WORDS = frozenset((
+    'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а',
+    'то', 'все', 'она', 'так', 'его', 'но', 'да', 'ты', 'к', 'у', 'же',
+    'вы', 'за', 'бы', 'по', 'только', 'ее', 'мне', 'было', 'вот', 'от',
+    'меня', 'еще', 'нет', 'о', 'из', 'ему', 'теперь', 'когда', 'даже',
+    'ну', 'ли', 'если', 'уже', 'или', 'ни', 'быть', 'был', 'него', 'до',
+    'вас', 'там', 'потом', 'себя', 'ничего', 'ей', 'может', 'они', 'тут',
+    'где', 'есть', 'надо', 'ней', 'для', 'мы', 'тебя', 'их', 'чем',
+    'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз', 'тоже', 'себе',
+    'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того', 'потому', 'этого',
+    'какой', 'совсем', 'ним', 'здесь', 'этом', 'один', 'почти', 'мой',
+    'тем', 'чтобы', 'нее', 'были', 'куда', 'зачем', 'всех', 'можно',
+    'при', 'об', 'другой', 'хоть', 'после', 'над', 'больше', 'тот',
+    'через', 'эти', 'нас', 'про', 'всего', 'них', 'какая', 'много',
+    'разве', 'три', 'эту', 'моя', 'впрочем', 'хорошо', 'свою', 'этой',
+    'перед', 'иногда', 'лучше', 'чуть', 'том', 'нельзя', 'такой', 'им',
+    'более', 'всегда', 'конечно', 'всю', 'между',
+))
+
+# Russian Snowball stemmer endings. Entries of the *_AFTER_A groups only
+# match when preceded by "а" or "я".
+VOWELS = 'аеиоуыэюя'
+PERFECTIVE_GERUND_AFTER_A = ('вшись', 'вши', 'в')
+PERFECTIVE_GERUND = ('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв')
+ADJECTIVE = (
+    'ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое',
+    'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'их', 'ых', 'ую',
+    'юю', 'ая', 'яя', 'ою', 'ею',
+)
+PARTICIPLE_AFTER_A = ('ем', 'нн', 'вш', 'ющ', 'щ')
+PARTICIPLE = ('ивш', 'ывш', 'ующ')
+REFLEXIVE = ('ся', 'сь')
+VERB_AFTER_A = (
+    'ете', 'йте', 'ешь', 'нно', 'ла', 'на', 'ли', 'ем', 'ло', 'но', 'ет',
+    'ют', 'ны', 'ть', 'й', 'л', 'н',
+)
+VERB = (
+    'ейте', 'уйте', 'ила', 'ыла', 'ена', 'ите', 'или', 'ыли', 'ило',
+    'ыло', 'ено', 'ует', 'уют', 'ены', 'ить', 'ыть', 'ишь', 'ей', 'уй',
+    'ил', 'ыл', 'им', 'ым', 'ен', 'ят', 'ит', 'ыт', 'ую', 'ю',
+)
+NOUN = (
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ев', 'ов', 'ие',
+    'ье', 'еи', 'ии', 'ей', 'ой', 'ий', 'ям', 'ем', 'ам', 'ом', 'ах',
+    'ях', 'ию', 'ью', 'ия', 'ья', 'а', 'е', 'и', 'й', 'о', 'у', 'ы', 'ь',
+    'ю', 'я',
+)
+SUPERLATIVE = ('ейше', 'ейш')
+DERIVATIONAL = ('ость', 'ост')
+
+
+def _regions(word):
+    """Return the start of RV and R2 for a word."""
+    rv = r1 = r2 = len(word)
+    for i, char in enumerate(word):
+        if char in VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i - 1] in VOWELS and word[i] not in VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in VOWELS and word[i] not in VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def _strip(word, endings, endings_after_a=()):
+    """Remove the longest matching ending, return None if none matches."""
+    candidates = [e for e in endings if word.endswith(e)]
+    candidates += [
+        e for e in endings_after_a
+        if word.endswith(e) and word[:-len(e)][-1:] in ('а', 'я')
+    ]
+    if not candidates:
+        return None
+    return word[:-len(max(candidates, key=len))]
+
+
+def stem(word):
+    """Russian Snowball stemmer; non-cyrillic words are returned as is."""
+    word = word.lower().replace('ё', 'е')
+    if not re.search('[а-я]', word):
+        return word
+    rv, r2 = _regions(word)
+    head, tail = word[:rv], word[rv:]
+
+    stripped = _strip(tail, PERFECTIVE_GERUND, PERFECTIVE_GERUND_AFTER_A)
+    if stripped is not None:
+        tail = stripped
+    else:
+        tail = _strip(tail, REFLEXIVE) or tail
+        stripped = _strip(tail, ADJECTIVE)
+        if stripped is not None:
+            tail = _strip(
+                stripped, PARTICIPLE, PARTICIPLE_AFTER_A) or stripped
+        else:
+            stripped = _strip(tail, VERB, VERB_AFTER_A)
+            if stripped is None:
+                stripped = _strip(tail, NOUN)
+            if stripped is not None:
+                tail = stripped
+
+    if tail.endswith('и'):
+        tail = tail[:-1]
+
+    r2_tail = max(r2 - rv, 0)
+    stripped = _strip(tail[r2_tail:], DERIVATIONAL)
+    if stripped is not None:
+        tail = tail[:r2_tail] + stripped
+
+    if tail.endswith('нн'):
+        tail = tail[:-1]
+    else:
+        stripped = _strip(tail, SUPERLATIVE)
+        if stripped is not None:
+            tail = stripped[:-1] if stripped.endswith('нн') else stripped
+        elif tail.endswith('ь'):
+            tail = tail[:-1]
+    return head + tail
+
+
+def analyze(text):
+    """Split text into stemmed lexemes, dropping stop words."""
+    return [
+        stem(word) for word in WORD_RE.findall(text.lower())
+        if word not in STOP_WORDS
+    ]
+
+
+def build_document(name, text, ingredient_names):
+    """One line of lexemes per weight class: name, ingredients, text."""
+    return '\n'.join((
+        ' '.join(analyze(name)),
+        ' '.join(analyze(' '.join(ingredient_names))),
+        ' '.join(analyze(text)),
+    ))
+
+
+def rank_document(document, terms):
+    """
+    Rank a stored document against query lexemes the way ts_rank does
+    without normalization: every term must match, weighted by field.
+    """
+    fields = [line.split() for line in document.split('\n')]
+    rank = 0.0
+    for term in terms:
+        term_rank = sum(
+            weight * tokens.count(term)
+            for weight, tokens in zip(WEIGHTS, fields)
+        )
+        if not term_rank:
+            return 0.0
+        rank += term_rank
+    return rank
+
+
+class FallbackSearchBackend:
+    """In-process ranking over stored lexemes, used on SQLite."""
+
+    def update_vectors(self, recipe_ids):
+        pass
+
+    def search(self, queryset, query):
+        terms = analyze(query)
+        if not terms:
+            return queryset.none()
+        documents = RecipeSearchDocument.objects.filter(
+            recipe_id__in=queryset.values('id'))
+        for term in set(terms):
+            documents = documents.filter(document__contains=term)
+        ranks = {}
+        for recipe_id, document in documents.values_list(
+                'recipe_id', 'document'):
+            rank = rank_document(document, terms)
+            if rank:
+                ranks[recipe_id] = rank
+        if not ranks:
+            return queryset.none()
+        return queryset.filter(id__in=ranks).annotate(
+            search_rank=Case(
+                *[When(id=recipe_id, then=Value(rank))
+                  for recipe_id, rank in ranks.items()],
+                output_field=FloatField())
+        ).order_by('-search_rank', '-id')
+
+
+class PostgresSearchBackend:
+    """tsvector + GIN index search with ts_rank ordering."""
+
+    def __init__(self):
+        from django.contrib.postgres.search import SearchVectorExact
+        SearchVectorTextField.register_lookup(SearchVectorExact)
+
+    def update_vectors(self, recipe_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {RecipeSearchDocument._meta.db_table} AS d
+                SET vector =
+                    setweight(to_tsvector(%s, r.name), 'A') ||
+                    setweight(to_tsvector(%s, coalesce((
+                        SELECT string_agg(i.name, ' ')
+                        FROM {IngredientAmount._meta.db_table} AS ia
+                        JOIN {Ingredient._meta.db_table} AS i
+                            ON i.id = ia.ingredient_id
+                        WHERE ia.recipe_id = r.id), '')), 'B') ||
+                    setweight(to_tsvector(%s, r.text), 'C')
+                FROM {Recipe._meta.db_table} AS r
+                WHERE r.id = d.recipe_id AND d.recipe_id = ANY(%s)
+                """,
+                [SEARCH_CONFIG] * 3 + [list(recipe_ids)])
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchQuery, SearchRank
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        return queryset.annotate(
+            search_rank=SearchRank(
+                F('search_document__vector'), search_query)
+        ).filter(
+            search_document__vector=search_query
+        ).order_by('-search_rank', '-id')
+
+
+_backends = {}
+
+
+def get_search_backend():
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == 'postgresql':
+            _backends[vendor] = PostgresSearchBackend()
+        else:
+            _backends[vendor] = FallbackSearchBackend()
+    return _backends[vendor]
+
+
+def reindex(recipe_ids):
+    """Rebuild search documents for the given recipes."""
+    recipes = Recipe.objects.filter(
+        id__in=set(recipe_ids)).prefetch_related('ingredients')
+    documents = [
+        RecipeSearchDocument(
+            recipe_id=recipe.id,
+            document=build_document(
+                recipe.name,
+                recipe.text,
+                [ingredient.name for ingredient in recipe.ingredients.all()]))
+        for recipe in recipes
+    ]
+    if not documents:
+        return 0
+    indexed = set(RecipeSearchDocument.objects.filter(
+        recipe_id__in=[d.recipe_id for d in documents]
+    ).values_list('recipe_id', flat=True))
+    RecipeSearchDocument.objects.bulk_update(
+        [d for d in documents if d.recipe_id in indexed], ['document'])
+    RecipeSearchDocument.objects.bulk_create(
+        [d for d in documents if d.recipe_id not in indexed])
+    get_search_backend().update_vectors([d.recipe_id for d in documents])
+    return len(documents)
+
+
+# Recipe ids waiting for the current transaction of this thread to
+# commit.
+_state = threading.local()
+
+
+def _drain():
+    recipe_ids = getattr(_state, 'pending', None)
+    if recipe_ids:
+        _state.pending = None
+        reindex(recipe_ids)
+
+
+def schedule_reindex(recipe_ids):
+    """
+    Reindex recipes once the current transaction commits, so a recipe
+    saved together with its ingredients is indexed a single time.
+    Every call registers a drain; the first to run after the commit
+    reindexes all ids collected so far and the rest find nothing left.
+    Ids left over by a rolled back transaction go with the next batch.
+    """
+    if getattr(_state, 'pending', None) is None:
+        _state.pending = set()
+    _state.pending.update(recipe_ids)
+    transaction.on_commit(_drain)
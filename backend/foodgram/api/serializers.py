@@ -1,5 +1,5 @@
-import base64
-from django.core.files.base import ContentFile
+from collections import OrderedDict
+from django.db import models, transaction
 from rest_framework import serializers
 from core.models import Recipe, Ingredient, Tag, IngredientAmount
 from core.models import User, Subscription
@@ -12,6 +12,11 @@ from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework.authtoken.serializers import AuthTokenSerializer
 from core.models import Subscription, User
 from django.db.models import Q
+from .fragments import get_fragments, prefetch_for_fragments, set_fragments
+from .images import variant_urls
+from .shopping import refresh_recipe_totals
+from .tags import get_registry
+from .uploads import check_image, decode_data_uri
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -43,15 +48,48 @@ class UserSerializer(serializers.ModelSerializer):
 class Base64ImageField(serializers.ImageField):
     """
     A custom image field serializer handle image data encoded as base64 string.
+    Data URIs are decoded into a temporary file, and size and pixel limits
+    are checked before the image itself is decoded (see api/uploads.py).
     """
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name=f'temp.{ext}')
+            data = decode_data_uri(data)
+        if hasattr(data, 'size') and hasattr(data, 'read'):
+            check_image(data)
         return super().to_internal_value(data)
 
 
+class BulkManyRelatedField(serializers.ManyRelatedField):
+    """
+    ManyRelatedField that looks all submitted primary keys up in a single
+    query instead of one query per key.
+    """
+    def lookup(self, pks):
+        return self.child_relation.get_queryset().in_bulk(pks)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        try:
+            pks = list(dict.fromkeys(int(pk) for pk in data))
+        except (TypeError, ValueError):
+            self.child_relation.fail('incorrect_type', data_type='list')
+        objects = self.lookup(pks)
+        for pk in pks:
+            if pk not in objects:
+                self.child_relation.fail('does_not_exist', pk_value=pk)
+        return [objects[pk] for pk in pks]
+
+
+class TagListField(BulkManyRelatedField):
+    """Tag ids validated against the in-memory tag registry."""
+
+    def lookup(self, pks):
+        return get_registry().in_bulk(pks)
+
+
 class IngredientSerializer(serializers.ModelSerializer):
     class Meta:
         model = Ingredient
@@ -80,13 +118,66 @@ class TagSerializer(serializers.ModelSerializer):
 
 class RecipeIngredientAmountSerializer(serializers.Serializer):
     id = serializers.IntegerField()
-    amount = serializers.IntegerField()
+    amount = serializers.IntegerField(min_value=1)
 
     class Meta:
         model = IngredientAmount
         fields = '__all__'
 
 
+class AuthorCardSerializer(UserSerializer):
+    """Author data shared by every viewer, without is_subscribed"""
+
+    is_subscribed = None
+
+    class Meta(UserSerializer.Meta):
+        fields = ('email', 'id', 'username', 'first_name', 'last_name')
+
+
+class RecipeCardSerializer(serializers.ModelSerializer):
+    """
+    Viewer-independent part of RecipeSerializer output, cached per recipe
+    by api/fragments.py. Serialized without a request, so image is a
+    relative URL.
+    """
+    author = AuthorCardSerializer(
+        read_only=True)
+    ingredients = IngAmounToRecipeSerializer(
+        many=True, read_only=True, source='ingredient_amounts')
+    tags = serializers.SerializerMethodField()
+    image = serializers.ImageField(
+        read_only=True)
+    image_variants = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Recipe
+        fields = ['id', 'tags', 'author', 'ingredients', 'name', 'image',
+                  'image_variants', 'text', 'cooking_time']
+
+    def get_tags(self, obj):
+        # Tag ids are attached by prefetch_for_fragments.
+        tag_ids = getattr(obj, 'tag_ids', None)
+        if tag_ids is None:
+            tag_ids = sorted(tag.pk for tag in obj.tags.all())
+        return get_registry().serialize(tag_ids)
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj)
+
+
+class RecipeListSerializer(serializers.ListSerializer):
+    """Loads the cached fragments of a whole page at once"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        recipes = list(iterable)
+        fragments = self.child.get_fragments(recipes)
+        return [
+            self.child.merge_viewer_state(fragments[recipe.pk], recipe)
+            for recipe in recipes
+        ]
+
+
 class RecipeSerializer(serializers.ModelSerializer):
     author = UserSerializer(
         read_only=True)
@@ -96,6 +187,8 @@ class RecipeSerializer(serializers.ModelSerializer):
         many=True, read_only=False)
     image = Base64ImageField(
         required=False)
+    image_variants = serializers.JSONField(
+        read_only=True)
     is_favorited = serializers.SerializerMethodField(
         default=False)
     is_in_shopping_cart = serializers.SerializerMethodField(
@@ -104,106 +197,180 @@ class RecipeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Recipe
         fields = ['id', 'tags', 'author', 'ingredients', 'is_favorited',
-                  'is_in_shopping_cart', 'name', 'image',
+                  'is_in_shopping_cart', 'name', 'image', 'image_variants',
                   'text', 'cooking_time']
+        list_serializer_class = RecipeListSerializer
 
-    def to_internal_value(self, data):
-        if data.get('image') and isinstance(data['image'], str) \
-                and data['image'].startswith('data:image'):
-            data['image'] = Base64ImageField().to_internal_value(data['image'])
-        return super().to_internal_value(data)
+    def to_representation(self, instance):
+        fragments = self.get_fragments([instance])
+        return self.merge_viewer_state(fragments[instance.pk], instance)
+
+    def get_fragments(self, recipes):
+        """
+        Return cached card fragments by recipe id, serializing and caching
+        the missing ones.
+        """
+        fragments = get_fragments([recipe.pk for recipe in recipes])
+        missing = [recipe for recipe in recipes if recipe.pk not in fragments]
+        if missing:
+            prefetch_for_fragments(missing)
+            built = {
+                recipe.pk: data for recipe, data in zip(
+                    missing, RecipeCardSerializer(missing, many=True).data)
+            }
+            set_fragments(built)
+            fragments.update(built)
+        return fragments
+
+    def merge_viewer_state(self, fragment, instance):
+        request = self.context.get('request')
+        data = OrderedDict()
+        for field_name in self.fields:
+            if field_name == 'is_favorited':
+                data[field_name] = self.get_is_favorited(instance)
+            elif field_name == 'is_in_shopping_cart':
+                data[field_name] = self.get_is_in_shopping_cart(instance)
+            elif field_name == 'author':
+                data[field_name] = OrderedDict(
+                    fragment['author'],
+                    is_subscribed=self.get_author_is_subscribed(instance))
+            elif field_name == 'image' and request and fragment['image']:
+                data[field_name] = request.build_absolute_uri(
+                    fragment['image'])
+            elif field_name == 'image_variants' and request:
+                data[field_name] = {
+                    variant: {
+                        extension: request.build_absolute_uri(url)
+                        for extension, url in formats.items()
+                    }
+                    for variant, formats in fragment[field_name].items()
+                }
+            else:
+                data[field_name] = fragment[field_name]
+        return data
 
     def get_is_favorited(self, obj):
+        # Annotated by Recipe.objects.with_viewer_state() on list/retrieve.
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.favoriterecipe_set.filter(user=request.user).exists()
         return False
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.shopping_lists.filter(user=request.user).exists()
         return False
 
+    def get_author_is_subscribed(self, obj):
+        if hasattr(obj, 'author_is_subscribed'):
+            return obj.author_is_subscribed
+        return UserSerializer(
+            context=self.context).get_is_subscribed(obj.author)
+
 
 class PostRecipeSerializer(serializers.ModelSerializer):
     ingredients = RecipeIngredientAmountSerializer(
         many=True)
     image = Base64ImageField(
         required=False)
-    tags = serializers.PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(), many=True)
+    tags = TagListField(
+        child_relation=serializers.PrimaryKeyRelatedField(
+            queryset=Tag.objects.all()))
 
     class Meta:
         model = Recipe
         fields = ['id', 'name', 'ingredients', 'text',
                   'tags', 'image', 'cooking_time']
 
+    def validate_ingredients(self, value):
+        """Check every ingredient id with one query."""
+        amounts = {}
+        for item in value:
+            if item['id'] in amounts:
+                raise serializers.ValidationError(
+                    f"Ingredient {item['id']} is listed more than once")
+            amounts[item['id']] = item['amount']
+        found = set(Ingredient.objects.filter(
+            id__in=amounts).values_list('id', flat=True))
+        missing = [pk for pk in amounts if pk not in found]
+        if missing:
+            raise serializers.ValidationError(
+                f"Ingredient with ID {missing[0]} does not exist")
+        return amounts
+
+    @transaction.atomic
     def create(self, validated_data):
-        ingredients_data = self.initial_data['ingredients']
-        tags_data = self.initial_data['tags']
-        validated_data.pop('tags')
-        validated_data.pop('ingredients')
+        amounts = validated_data.pop('ingredients')
+        tags = validated_data.pop('tags')
+        # The recipe post_save handlers re-index and invalidate on commit,
+        # after the bulk-created ingredient rows below are in place.
         recipe = Recipe.objects.create(**validated_data)
-        for ingredient_data in ingredients_data:
-            ingredient = Ingredient.objects.get(id=ingredient_data['id'])
-            IngredientAmount.objects.create(
-                recipe=recipe,
-                ingredient=ingredient,
-                amount=ingredient_data['amount'])
-            recipe.save()
-            recipe.ingredients.add(ingredient)
-        for tag_data in tags_data:
-            try:
-                tag = Tag.objects.get(id=tag_data)
-                recipe.tags.add(tag)
-            except Tag.DoesNotExist:
-                raise serializers.ValidationError(
-                    f"Tag with slug {tag_data} does not exist")
+        IngredientAmount.objects.bulk_create([
+            IngredientAmount(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount)
+            for ingredient_id, amount in amounts.items()
+        ])
+        recipe.tags.add(*tags)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        instance.name = validated_data.get(
-            'name', instance.name)
-        instance.text = validated_data.get(
-            'text', instance.text)
-        instance.cooking_time = validated_data.get(
-            'cooking_time', instance.cooking_time)
-        instance.image = validated_data.get(
-            'image', instance.image)
-
-        # Update the tags for the recipe
-        tags_data = validated_data.pop('tags')
-        instance.tags.clear()
-        for tag_data in tags_data:
-            try:
-                tag = Tag.objects.get(id=tag_data.id)
-                instance.tags.add(tag)
-            except Tag.DoesNotExist:
-                raise serializers.ValidationError(
-                    f"Tag with ID {tag_data.id} does not exist")
-
-        # Update the ingredients for the recipe
-        ingredients_data = validated_data.pop('ingredients')
-        ingredient_amounts = instance.ingredient_amounts.all()
-        for ingredient_amount in ingredient_amounts:
-            ingredient_amount.delete()
-
-        for ingredient_data in ingredients_data:
-            ingredient = Ingredient.objects.get(id=ingredient_data['id'])
-            IngredientAmount.objects.create(
-                recipe=instance,
-                ingredient=ingredient,
-                amount=ingredient_data['amount'])
-
+        amounts = validated_data.pop('ingredients', None)
+        tags = validated_data.pop('tags', None)
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        if tags is not None:
+            instance.tags.set(tags)
+        if amounts is not None:
+            self.update_amounts(instance, amounts)
+        # Bulk writes send no signals: this save re-indexes the recipe and
+        # invalidates its cached responses (see api/signals.py).
         instance.save()
         return instance
 
+    def update_amounts(self, recipe, amounts):
+        """
+        Write only the ingredient rows that were added, changed or
+        removed.
+        """
+        changed = []
+        removed = []
+        touched = set(amounts)
+        for row in recipe.ingredient_amounts.all():
+            amount = amounts.pop(row.ingredient_id, None)
+            if amount is None:
+                removed.append(row.pk)
+            elif amount != row.amount:
+                row.amount = amount
+                changed.append(row)
+            else:
+                touched.discard(row.ingredient_id)
+        if removed:
+            # Deleted rows send post_delete, which updates the carts.
+            IngredientAmount.objects.filter(pk__in=removed).delete()
+        if changed:
+            IngredientAmount.objects.bulk_update(changed, ['amount'])
+        if amounts:
+            IngredientAmount.objects.bulk_create([
+                IngredientAmount(
+                    recipe=recipe, ingredient_id=ingredient_id,
+                    amount=amount)
+                for ingredient_id, amount in amounts.items()
+            ])
+        # Bulk writes send no signals, so update the carts with the recipe.
+        refresh_recipe_totals([recipe.pk], touched)
+
 
 class RecipeForSubsSerializer(RecipeSerializer):
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
+        list_serializer_class = RecipeListSerializer
 
 # came from users
 
@@ -0,0 +1,201 @@
+"""
+Shopping list totals.
+
+The amount of every ingredient over the recipes in a user's shopping
+cart is kept in ShoppingCartTotal, one row per user and ingredient, so
+reading a cart is one indexed scan instead of summing IngredientAmount
+rows of all its recipes. Ingredients are unique per name and measurement
+unit, so "соль, г" and "соль, ч. л." stay separate lines.
+
+Whenever a cart or a recipe's ingredients change, only the affected
+(user, ingredient) rows are recomputed from the source tables
+(refresh_totals), from api/signals.py or from the code that writes in
+bulk. check_cart_totals rebuilds the table and reports any drift.
+Exports read the rows as a stream instead of loading the cart into
+memory.
+"""
+import csv
+import json
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import F, Sum
+
+from core.models import IngredientAmount, ShoppingCartTotal, ShoppingList
+
+CHUNK_SIZE = 2000
+# Lines joined into one piece of a streamed export.
+LINES_PER_PIECE = 100
+CSV_HEADER = ('name', 'measurement_unit', 'amount')
+
+Drift = namedtuple('Drift', 'missing wrong extra')
+
+
+def cart_totals(user):
+    """
+    Queryset of {'name', 'measurement_unit', 'amount'} rows for the
+    user's cart, ordered by name and unit.
+    """
+    return ShoppingCartTotal.objects.filter(user=user).values(
+        'amount',
+        name=F('ingredient__name'),
+        measurement_unit=F('ingredient__measurement_unit'),
+    ).order_by('name', 'measurement_unit')
+
+
+def source_totals(user_ids, ingredient_ids=None):
+    """
+    (user id, ingredient id, amount) rows summed from the recipes in the
+    users' carts, optionally only for the given ingredients.
+    """
+    amounts = IngredientAmount.objects.filter(
+        recipe__shopping_lists__user__in=user_ids)
+    if ingredient_ids is not None:
+        amounts = amounts.filter(ingredient_id__in=ingredient_ids)
+    return amounts.values_list(
+        'recipe__shopping_lists__user', 'ingredient'
+    ).annotate(Sum('amount')).order_by()
+
+
+def lock_carts(user_ids):
+    """
+    Lock the users' shopping lists, in id order, until the transaction
+    ends, so refreshes of the same cart run one after another instead of
+    clashing on the (user, ingredient) rows they rewrite.
+    """
+    list(ShoppingList.objects.select_for_update().filter(
+        user_id__in=user_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def refresh_totals(user_ids, ingredient_ids=None):
+    """
+    Recompute the stored totals of the users, only for the given
+    ingredients if they are passed.
+    """
+    user_ids = set(user_ids)
+    if ingredient_ids is not None:
+        ingredient_ids = set(ingredient_ids)
+        if not ingredient_ids:
+            return
+    if not user_ids:
+        return
+    stored = ShoppingCartTotal.objects.filter(user_id__in=user_ids)
+    if ingredient_ids is not None:
+        stored = stored.filter(ingredient_id__in=ingredient_ids)
+    with transaction.atomic():
+        lock_carts(user_ids)
+        totals = [
+            ShoppingCartTotal(
+                user_id=user_id, ingredient_id=ingredient_id, amount=amount)
+            for user_id, ingredient_id, amount in source_totals(
+                user_ids, ingredient_ids)
+        ]
+        stored.delete()
+        ShoppingCartTotal.objects.bulk_create(totals)
+
+
+def clear_totals(user_ids):
+    ShoppingCartTotal.objects.filter(user_id__in=user_ids).delete()
+
+
+def cart_user_ids(recipe_ids):
+    """Ids of the users with any of the recipes in their cart."""
+    return list(ShoppingList.objects.filter(
+        recipes__in=recipe_ids).values_list('user_id', flat=True).distinct())
+
+
+def recipe_ingredient_ids(recipe_ids):
+    return list(IngredientAmount.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('ingredient_id', flat=True).distinct())
+
+
+def refresh_recipe_totals(recipe_ids, ingredient_ids):
+    """Recompute the given ingredients in every cart with the recipes."""
+    ingredient_ids = set(ingredient_ids)
+    if ingredient_ids:
+        refresh_totals(cart_user_ids(recipe_ids), ingredient_ids)
+
+
+def rebuild_totals(user_ids, dry_run=False):
+    """
+    Compare the users' stored totals with their source and rewrite them
+    if they differ, unless dry_run is set. Returns the Drift found.
+    """
+    with transaction.atomic():
+        lock_carts(user_ids)
+        source = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in source_totals(user_ids)
+        }
+        stored = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in
+            ShoppingCartTotal.objects.filter(user_id__in=user_ids).values_list(
+                'user_id', 'ingredient_id', 'amount')
+        }
+        drift = Drift(
+            missing=len(source.keys() - stored.keys()),
+            wrong=sum(1 for key, amount in stored.items()
+                      if key in source and source[key] != amount),
+            extra=len(stored.keys() - source.keys()))
+        if any(drift) and not dry_run:
+            clear_totals(user_ids)
+            ShoppingCartTotal.objects.bulk_create(
+                ShoppingCartTotal(
+                    user_id=user_id, ingredient_id=ingredient_id,
+                    amount=amount)
+                for (user_id, ingredient_id), amount in source.items())
+    return drift
+
+
+def iter_cart_totals(user, chunk_size=CHUNK_SIZE):
+    """Stream the cart totals without caching the whole result."""
+    return cart_totals(user).iterator(chunk_size=chunk_size)
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def text_lines(rows):
+    for row in rows:
+        yield f"{row['name']}: {row['amount']} {row['measurement_unit']}\n"
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    for row in rows:
+        yield writer.writerow([row[field] for field in CSV_HEADER])
+
+
+def json_lines(rows):
+    separator = '[\n'
+    for row in rows:
+        yield separator + json.dumps(
+            {field: row[field] for field in CSV_HEADER}, ensure_ascii=False)
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+
+# format: (lines, content type, file extension)
+EXPORT_FORMATS = {
+    'txt': (text_lines, 'text/plain; charset=utf-8', 'txt'),
+    'csv': (csv_lines, 'text/csv; charset=utf-8', 'csv'),
+    'json': (json_lines, 'application/json', 'json'),
+}
+
+
+def stream_export(user, export_format):
+    """Encoded pieces of the user's cart totals in the given format."""
+    lines = EXPORT_FORMATS[export_format][0](iter_cart_totals(user))
+    piece = []
+    for line in lines:
+        piece.append(line)
+        if len(piece) >= LINES_PER_PIECE:
+            yield ''.join(piece).encode('utf-8')
+            piece = []
+    if piece:
+        yield ''.join(piece).encode('utf-8')
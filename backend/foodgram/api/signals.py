@@ -0,0 +1,271 @@
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core.models import (
+    FavoriteRecipe,
+    Ingredient,
+    IngredientAmount,
+    Recipe,
+    ShoppingList,
+    Subscription,
+    Tag,
+    User,
+)
+from .cache import bump_version_on_commit, invalidate_on_commit
+from .fragments import invalidate_all, invalidate_recipes
+from .images import schedule_variants
+from .media import acquire, release
+from .search import schedule_reindex
+from .shopping import (
+    cart_user_ids,
+    clear_totals,
+    recipe_ingredient_ids,
+    refresh_recipe_totals,
+    refresh_totals,
+)
+
+
+def is_login(created, update_fields):
+    # Logins only touch last_login, which is not part of any recipe output.
+    return not created and update_fields == frozenset({'last_login'})
+
+
+@receiver(post_save, sender=Recipe)
+def reindex_saved_recipe(sender, instance, **kwargs):
+    schedule_reindex([instance.pk])
+
+
+@receiver(pre_save, sender=Recipe)
+def load_stored_image(sender, instance, update_fields, **kwargs):
+    instance._stored_image = None
+    if instance.pk is not None and (
+            update_fields is None or 'image' in update_fields):
+        instance._stored_image = Recipe.objects.filter(
+            pk=instance.pk).values_list('image', flat=True).first()
+
+
+@receiver(post_save, sender=Recipe)
+def count_image_references(sender, instance, **kwargs):
+    image = instance.image.name
+    stored = instance._stored_image
+    if image != stored and (stored is not None or kwargs['created']):
+        acquire([image])
+        release([stored])
+
+
+@receiver(post_delete, sender=Recipe)
+def release_image_reference(sender, instance, **kwargs):
+    release([instance.image.name])
+
+
+@receiver(post_save, sender=Recipe)
+def generate_image_variants(sender, instance, **kwargs):
+    schedule_variants([instance])
+
+
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+def reindex_recipe_ingredients(sender, instance, **kwargs):
+    schedule_reindex([instance.recipe_id])
+
+
+@receiver(post_save, sender=Ingredient)
+def reindex_ingredient_recipes(sender, instance, created, **kwargs):
+    if not created:
+        schedule_reindex(
+            instance.recipes.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_cache(sender, **kwargs):
+    if kwargs.get('action', 'post_').startswith('post_'):
+        invalidate_on_commit()
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def invalidate_recipe_fragment(sender, instance, **kwargs):
+    invalidate_recipes([instance.pk])
+
+
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+def invalidate_ingredient_amount_fragment(sender, instance, **kwargs):
+    invalidate_recipes([instance.recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags_fragment(sender, instance, action, reverse,
+                                    pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        invalidate_recipes(
+            pk_set if pk_set is not None
+            else instance.recipes_with_tag.values_list('id', flat=True))
+    else:
+        invalidate_recipes([instance.pk])
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+def invalidate_all_fragments(sender, **kwargs):
+    invalidate_all()
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_fragments(sender, instance, created, update_fields,
+                                **kwargs):
+    if created or is_login(created, update_fields):
+        return
+    invalidate_recipes(
+        Recipe.objects.filter(author=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_recipes(sender, instance, created, update_fields,
+                              **kwargs):
+    if created or is_login(created, update_fields):
+        return
+    Recipe.objects.filter(author=instance).update(updated_at=timezone.now())
+    invalidate_on_commit()
+
+
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+def touch_recipe_of_amount(sender, instance, **kwargs):
+    Recipe.objects.filter(
+        pk=instance.recipe_id).update(updated_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def touch_recipe_of_tags(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        recipes = Recipe.objects.filter(pk=instance.pk)
+    elif pk_set is not None:
+        recipes = Recipe.objects.filter(pk__in=pk_set)
+    else:
+        return
+    recipes.update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def bump_tags_version(sender, instance, **kwargs):
+    if instance.pk is not None:
+        Recipe.objects.filter(tags=instance).update(updated_at=timezone.now())
+    bump_version_on_commit('tags')
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def bump_ingredients_version(sender, instance, created=False, **kwargs):
+    if not created:
+        Recipe.objects.filter(
+            ingredients=instance).update(updated_at=timezone.now())
+    bump_version_on_commit('ingredients')
+
+
+@receiver(post_save, sender=FavoriteRecipe)
+@receiver(post_delete, sender=FavoriteRecipe)
+def bump_favorites_viewer_version(sender, instance, **kwargs):
+    bump_version_on_commit(f'viewer:{instance.user_id}')
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def bump_subscriptions_viewer_version(sender, instance, **kwargs):
+    bump_version_on_commit(f'viewer:{instance.subscriber_id}')
+
+
+@receiver(m2m_changed, sender=ShoppingList.recipes.through)
+def bump_shopping_list_viewer_version(sender, instance, action, reverse,
+                                      pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            bump_version_on_commit(f'viewer:{instance.user_id}')
+        return
+    if action == 'pre_clear':
+        user_ids = instance.shopping_lists.values_list('user_id', flat=True)
+    elif action in ('post_add', 'post_remove'):
+        user_ids = ShoppingList.objects.filter(
+            pk__in=pk_set).values_list('user_id', flat=True)
+    else:
+        return
+    for user_id in user_ids:
+        bump_version_on_commit(f'viewer:{user_id}')
+
+
+@receiver(m2m_changed, sender=ShoppingList.recipes.through)
+def update_cart_totals(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a recipe, pk_set holds shopping list ids.
+        if action == 'pre_clear':
+            instance._cart_user_ids = cart_user_ids([instance.pk])
+            return
+        if action == 'post_clear':
+            user_ids = instance._cart_user_ids
+        elif action in ('post_add', 'post_remove'):
+            user_ids = ShoppingList.objects.filter(
+                pk__in=pk_set).values_list('user_id', flat=True)
+        else:
+            return
+        refresh_totals(user_ids, recipe_ingredient_ids([instance.pk]))
+    elif action == 'post_clear':
+        clear_totals([instance.user_id])
+    elif action in ('post_add', 'post_remove'):
+        refresh_totals([instance.user_id], recipe_ingredient_ids(pk_set))
+
+
+@receiver(post_delete, sender=ShoppingList)
+def clear_deleted_cart_totals(sender, instance, **kwargs):
+    clear_totals([instance.user_id])
+
+
+@receiver(pre_save, sender=IngredientAmount)
+def load_stored_ingredient(sender, instance, **kwargs):
+    instance._stored_ingredient_id = None
+    if instance.pk is not None:
+        instance._stored_ingredient_id = IngredientAmount.objects.filter(
+            pk=instance.pk).values_list('ingredient_id', flat=True).first()
+
+
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+def refresh_amount_cart_totals(sender, instance, **kwargs):
+    ingredient_ids = {instance.ingredient_id}
+    stored = getattr(instance, '_stored_ingredient_id', None)
+    if stored is not None:
+        ingredient_ids.add(stored)
+    refresh_recipe_totals([instance.recipe_id], ingredient_ids)
+
+
+@receiver(pre_delete, sender=Recipe)
+def load_recipe_carts(sender, instance, **kwargs):
+    # The cascade removes the cart links and ingredient rows in no fixed
+    # order, so remember what the recipe contributed to.
+    instance._cart_user_ids = cart_user_ids([instance.pk])
+    instance._ingredient_ids = recipe_ingredient_ids([instance.pk])
+
+
+@receiver(post_delete, sender=Recipe)
+def refresh_deleted_recipe_totals(sender, instance, **kwargs):
+    refresh_totals(instance._cart_user_ids, instance._ingredient_ids)
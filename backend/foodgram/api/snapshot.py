@@ -0,0 +1,86 @@
+"""
+Precompressed snapshot of the whole ingredient catalog.
+
+The IngredientSerializer output of every ingredient is rendered once per
+'ingredients' version stamp (api/cache.py) and kept in process memory as
+identity, gzip and, when the brotli package is installed, brotli bodies.
+The SHA-256 of the JSON names the snapshot: it is the ETag, and the
+hashed URL never changes content, so clients may cache it for a year and
+filter the catalog locally.
+"""
+import gzip
+import hashlib
+import json
+import threading
+
+from core.models import Ingredient
+from .cache import get_version
+from .serializers import IngredientSerializer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+class Snapshot:
+
+    def __init__(self, version, content):
+        self.version = version
+        self.digest = hashlib.sha256(content).hexdigest()[:32]
+        self.etag = f'"{self.digest}"'
+        self.bodies = {
+            'identity': content,
+            'gzip': gzip.compress(content, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(
+                content, mode=brotli.MODE_TEXT, quality=11)
+
+    def negotiate(self, accept_encoding):
+        """Smallest available body the client accepts, and its encoding."""
+        accepted = accepted_encodings(accept_encoding)
+        encoding = min(
+            (name for name in self.bodies
+             if name == 'identity' or name in accepted or '*' in accepted),
+            key=lambda name: len(self.bodies[name]))
+        return encoding, self.bodies[encoding]
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def render():
+    data = IngredientSerializer(
+        Ingredient.objects.order_by('name', 'id'), many=True).data
+    return json.dumps(
+        data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def get_snapshot():
+    """The snapshot of the current catalog, rendered if it changed."""
+    global _snapshot
+    version = get_version('ingredients')
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = Snapshot(version, render())
+        return _snapshot
@@ -0,0 +1,55 @@
+"""
+Process-local registry of all tags.
+
+Tags are a handful of rows that almost never change, so every worker
+keeps them in memory, together with their TagSerializer output, and
+answers lookups by id and slug without a query. The registry records
+the 'tags' version stamp (api/cache.py) it was loaded under; a tag saved
+or deleted in any worker bumps the stamp in the shared cache, and every
+worker reloads on its next lookup.
+"""
+import threading
+
+from core.models import Tag
+from .cache import get_version
+
+_registry = None
+_lock = threading.Lock()
+
+
+class TagRegistry:
+
+    def __init__(self, version, tags):
+        from .serializers import TagSerializer
+        self.version = version
+        self.tags = tags
+        self.by_id = {tag.pk: tag for tag in tags}
+        self.by_slug = {tag.slug: tag for tag in tags}
+        self.data = TagSerializer(tags, many=True).data
+        self.data_by_id = {
+            tag.pk: data for tag, data in zip(tags, self.data)}
+
+    def in_bulk(self, pks):
+        return {pk: self.by_id[pk] for pk in pks if pk in self.by_id}
+
+    def ids_for_slugs(self, slugs):
+        return [self.by_slug[slug].pk for slug in slugs
+                if slug in self.by_slug]
+
+    def serialize(self, pks):
+        """TagSerializer output for the given ids, unknown ids skipped."""
+        return [self.data_by_id[pk] for pk in pks if pk in self.data_by_id]
+
+
+def get_registry():
+    """The registry for the current tags version, reloaded if stale."""
+    global _registry
+    version = get_version('tags')
+    registry = _registry
+    if registry is not None and registry.version == version:
+        return registry
+    with _lock:
+        if _registry is None or _registry.version != version:
+            _registry = TagRegistry(
+                version, list(Tag.objects.order_by('id')))
+        return _registry
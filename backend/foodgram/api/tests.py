@@ -1,3 +1,1379 @@
-from django.test import TestCase
+import base64
+import gzip
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework import serializers
+from rest_framework.test import APIClient, APIRequestFactory
+
+from api import exports, fragments, pdfgen, search
+from api.cache import get_version
+from api.checks import check_shared_cache
+from api.filters import RecipeFilter
+from api.fuzzy import similarity
+from api.importer import RecipeImporter
+from api.shopping import iter_cart_totals
+from api.tags import get_registry
+from core.models import (
+    FavoriteRecipe,
+    Ingredient,
+    IngredientAmount,
+    Recipe,
+    RecipeSearchDocument,
+    ShoppingCartTotal,
+    ShoppingList,
+    ShoppingListExport,
+    StoredFile,
+    Subscription,
+    Tag,
+    User,
+)
+
+# Captured before any request, so a later global patch would show up.
+BASE_SERIALIZER_DATA = serializers.BaseSerializer.__dict__['data']
+
+IMAGE = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAf'
+    'FcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==')
+
+# Plan steps that mean the database is de-duplicating rows.
+DEDUPLICATION_STEPS = {
+    'sqlite': ('DISTINCT',),
+    'postgresql': ('Unique', 'HashAggregate'),
+}
+
+
+@override_settings(IMAGE_VARIANT_WORKERS=0, REQUEST_PROFILING_SAMPLE_RATE=0)
+class RecipeAPITestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # A file cache of the test's own, shared with subprocesses.
+        cls.cache_dir = tempfile.TemporaryDirectory()
+        cls.cache_settings = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': cls.cache_dir.name,
+        }})
+        cls.cache_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.cache_settings.disable()
+        cls.cache_dir.cleanup()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='cook', email='cook@foodgram.ru', password='pass')
+        cls.breakfast = Tag.objects.create(
+            name='Завтрак', color='#E26C2D', slug='breakfast')
+        cls.dinner = Tag.objects.create(
+            name='Ужин', color='#8775D2', slug='dinner')
+        cls.milk = Ingredient.objects.create(
+            name='молоко', measurement_unit='мл')
+        cls.recipes = []
+        for number in range(4):
+            recipe = Recipe.objects.create(
+                author=cls.user, name=f'Каша {number}', text='Варить',
+                cooking_time=10, image='images/test.png')
+            recipe.tags.add(cls.breakfast, cls.dinner)
+            IngredientAmount.objects.create(
+                recipe=recipe, ingredient=cls.milk, amount=200)
+            cls.recipes.append(recipe)
+        FavoriteRecipe.objects.create(user=cls.user, recipe=cls.recipes[0])
+        shopping_list = ShoppingList.objects.create(user=cls.user)
+        shopping_list.recipes.add(cls.recipes[1])
+
+    def setUp(self):
+        cache.clear()
+        # The search reindex batch scheduled by setUpTestData waits for a
+        # commit that never comes; start a new one.
+        search._state.pending = None
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # Uploads and image variants go to a directory removed afterwards.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.temp_dir = directory.name
+        settings = override_settings(
+            MEDIA_ROOT=os.path.join(directory.name, 'media'),
+            INGREDIENT_INDEX_PATH=os.path.join(directory.name, 'index.bin'),
+            PDF_CACHE_DIR=os.path.join(directory.name, 'pdf'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        default_storage.save(
+            'images/test.png',
+            ContentFile(base64.b64decode(IMAGE.split(',')[1])))
+
+
+class RecipeFilterTests(RecipeAPITestCase):
+
+    def get_list_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'], [
+            query['sql'] for query in queries.captured_queries
+            if 'core_recipe' in query['sql']
+        ]
+
+    def test_tags_filter_returns_each_recipe_once(self):
+        results, _ = self.get_list_queries(
+            '/recipes/?tags=breakfast&tags=dinner')
+        ids = [recipe['id'] for recipe in results]
+        self.assertEqual(sorted(ids), [r.id for r in self.recipes])
+
+    def test_membership_filters(self):
+        results, _ = self.get_list_queries('/recipes/?is_favorited=1')
+        self.assertEqual([r['id'] for r in results], [self.recipes[0].id])
+        results, _ = self.get_list_queries(
+            '/recipes/?is_in_shopping_cart=1&tags=dinner')
+        self.assertEqual([r['id'] for r in results], [self.recipes[1].id])
+
+    def test_anonymous_favorites_are_empty(self):
+        self.client.force_authenticate(None)
+        results, _ = self.get_list_queries('/recipes/?is_favorited=1')
+        self.assertEqual(results, [])
+
+    def test_list_queries_have_no_distinct(self):
+        _, queries = self.get_list_queries(
+            '/recipes/?tags=breakfast&tags=dinner'
+            '&is_favorited=1&is_in_shopping_cart=0')
+        for sql in queries:
+            self.assertNotIn('DISTINCT', sql.upper())
+
+    def test_query_plan_has_no_deduplication_step(self):
+        request = APIRequestFactory().get('/recipes/')
+        request.user = self.user
+        queryset = RecipeFilter(
+            QueryDict('tags=breakfast&tags=dinner&is_favorited=true'),
+            queryset=Recipe.objects.with_viewer_state(self.user),
+            request=request,
+        ).qs
+        plan = queryset.explain()
+        for step in DEDUPLICATION_STEPS.get(connection.vendor, ()):
+            self.assertNotIn(step, plan)
+
+
+class RecipeViewerStateTests(RecipeAPITestCase):
+
+    def test_list_flags_without_query_per_recipe(self):
+        chef = User.objects.create_user(
+            username='chef', email='chef@foodgram.ru', password='pass')
+        Subscription.objects.create(subscriber=self.user, subscribed_to=chef)
+        soups = [
+            Recipe.objects.create(
+                author=chef, name=f'Суп {number}', text='Варить',
+                cooking_time=10, image='images/test.png')
+            for number in range(2)
+        ]
+        get_registry()
+        # Count, page, ingredient rows, ingredients and tag links: the
+        # viewer flags come with the page query.
+        with self.assertNumQueries(5):
+            response = self.client.get('/recipes/')
+        self.assertEqual(response.status_code, 200)
+        flags = {
+            recipe['id']: (recipe['is_favorited'],
+                           recipe['is_in_shopping_cart'],
+                           recipe['author']['is_subscribed'])
+            for recipe in response.data['results']
+        }
+        self.assertEqual(flags, {
+            self.recipes[0].id: (True, False, False),
+            self.recipes[1].id: (False, True, False),
+            self.recipes[2].id: (False, False, False),
+            self.recipes[3].id: (False, False, False),
+            soups[0].id: (False, False, True),
+            soups[1].id: (False, False, True),
+        })
+
+
+class RecipeCursorPaginationTests(RecipeAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(4, 10):
+            cls.recipes.append(Recipe.objects.create(
+                author=cls.user, name=f'Суп {number}', text='Варить',
+                cooking_time=10, image='images/test.png'))
+
+    def walk(self, **params):
+        ids = []
+        queries = []
+        url, params = '/recipes/', {'cursor': '', **params}
+        while url:
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(url, params)
+            params = None
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            queries += [query['sql'] for query in captured]
+            ids += [recipe['id'] for recipe in response.data['results']]
+            url = response.data['next']
+            if url:
+                self.assertRegex(url, r'[?&]cursor=[\w%-]+')
+                self.assertNotIn('page=', url)
+        return ids, queries
+
+    def test_cursor_pages_without_count(self):
+        ids, queries = self.walk()
+        self.assertEqual(ids, [recipe.id for recipe in self.recipes])
+        for sql in queries:
+            self.assertNotIn('COUNT(', sql)
+
+    def test_previous_link(self):
+        first = self.client.get('/recipes/?cursor=&ordering=-id')
+        second = self.client.get(first.data['next'])
+        self.assertIsNotNone(second.data['previous'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+        self.assertEqual(
+            [recipe['id'] for recipe in first.data['results']],
+            [recipe.id for recipe in reversed(self.recipes)][:6])
+
+    def test_cursor_with_filters(self):
+        ids, _ = self.walk(tags='dinner')
+        self.assertEqual(ids, [recipe.id for recipe in self.recipes[:4]])
+        ids, _ = self.walk(is_in_shopping_cart=1)
+        self.assertEqual(ids, [self.recipes[1].id])
+
+    def test_cursor_keeps_search_relevance(self):
+        for recipe in self.recipes[4:]:
+            recipe.text = 'Подавать с кашей'
+            recipe.save()
+        search.reindex([recipe.id for recipe in self.recipes])
+        ids, _ = self.walk(search='каша')
+        self.assertEqual(
+            ids,
+            [recipe.id for recipe in reversed(self.recipes[:4])]
+            + [recipe.id for recipe in reversed(self.recipes[4:])])
+
+
+class RecipeResponseCacheTests(RecipeAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(None)
+
+    def test_anonymous_list_is_served_from_cache(self):
+        first = self.client.get('/recipes/?tags=dinner&page=1')
+        self.assertEqual(first['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            second = self.client.get('/recipes/?page=1&tags=dinner')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+
+    def test_recipe_change_invalidates_cache(self):
+        url = f'/recipes/{self.recipes[0].id}/'
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipes[0].tags.remove(self.dinner)
+        response = self.client.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.data['tags']), 1)
+
+    def test_authenticated_requests_bypass_cache(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/recipes/')
+        self.assertFalse(response.has_header('X-Cache'))
+
+
+class RecipeFragmentCacheTests(RecipeAPITestCase):
+
+    def test_warm_list_skips_nested_queries(self):
+        self.client.get('/recipes/')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/recipes/')
+        for query in queries.captured_queries:
+            self.assertNotIn('core_ingredientamount', query['sql'])
+            self.assertNotIn('core_recipe_tags', query['sql'])
+
+    def test_viewer_fields_are_not_shared(self):
+        url = f'/recipes/{self.recipes[0].id}/'
+        self.assertTrue(self.client.get(url).data['is_favorited'])
+        other = User.objects.create_user(
+            username='guest', email='guest@foodgram.ru', password='pass')
+        self.client.force_authenticate(other)
+        self.assertFalse(self.client.get(url).data['is_favorited'])
+
+    def test_recipe_change_invalidates_fragment(self):
+        url = f'/recipes/{self.recipes[0].id}/'
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientAmount.objects.filter(
+                recipe=self.recipes[0]).update(amount=300)
+            self.recipes[0].save()
+        ingredients = self.client.get(url).data['ingredients']
+        self.assertEqual(ingredients[0]['amount'], 300)
+
+    def test_evicted_version_is_not_reissued(self):
+        first = fragments.get_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            fragments.invalidate_all()
+        second = fragments.get_version()
+        cache.delete(f'{fragments.NAMESPACE}:version')
+        self.assertNotIn(fragments.get_version(), (first, second))
+
+
+class ConditionalGetTests(RecipeAPITestCase):
+
+    def test_matching_etag_returns_304_without_queries(self):
+        self.client.force_authenticate(None)
+        url = f'/recipes/{self.recipes[0].id}/'
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_viewer_change_updates_list_etag(self):
+        etag = self.client.get('/recipes/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            FavoriteRecipe.objects.create(
+                user=self.user, recipe=self.recipes[1])
+        response = self.client.get('/recipes/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_tag_change_updates_tags_etag(self):
+        etag = self.client.get('/tags/')['ETag']
+        self.assertEqual(
+            self.client.get('/tags/', HTTP_IF_NONE_MATCH=etag).status_code,
+            304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.dinner.name = 'Обед'
+            self.dinner.save()
+        self.assertEqual(
+            self.client.get('/tags/', HTTP_IF_NONE_MATCH=etag).status_code,
+            200)
+
+
+class RecipeSearchTests(RecipeAPITestCase):
+
+    def create_recipe(self, name, text='Варить', ingredient=None):
+        recipe = Recipe.objects.create(
+            author=self.user, name=name, text=text, cooking_time=10,
+            image='images/test.png')
+        if ingredient is not None:
+            IngredientAmount.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=1)
+        return recipe
+
+    def test_stemming(self):
+        for word in ('тыква', 'тыквы', 'тыквой'):
+            self.assertEqual(search.stem(word), 'тыкв')
+        self.assertEqual(search.stem('Печёная'), 'печен')
+        self.assertEqual(search.stem('pumpkin'), 'pumpkin')
+        self.assertEqual(
+            search.analyze('Каша с молоком и тыквой'),
+            ['каш', 'молок', 'тыкв'])
+
+    def test_results_ranked_by_field(self):
+        pumpkin = Ingredient.objects.create(
+            name='тыква', measurement_unit='г')
+        with self.captureOnCommitCallbacks(execute=True):
+            in_text = self.create_recipe('Пирог', 'Подавать с тыквой')
+            in_ingredients = self.create_recipe('Суп', ingredient=pumpkin)
+            in_name = self.create_recipe('Тыква печеная')
+            self.create_recipe('Омлет')
+        response = self.client.get('/recipes/?search=тыквы')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [in_name.id, in_ingredients.id, in_text.id])
+
+    def test_saves_are_reindexed_once_per_transaction(self):
+        pumpkin = Ingredient.objects.create(
+            name='тыква', measurement_unit='г')
+        with mock.patch('api.search.reindex',
+                        wraps=search.reindex) as reindex:
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe = self.create_recipe('Суп')
+                recipe.name = 'Суп-пюре'
+                recipe.save()
+                IngredientAmount.objects.create(
+                    recipe=recipe, ingredient=pumpkin, amount=1)
+        reindex.assert_called_once_with({recipe.id})
+        self.assertEqual(
+            recipe.search_document.document, 'суп пюр\nтыкв\nвар')
+
+        amount = recipe.ingredient_amounts.get()
+        amount.ingredient = self.milk
+        with self.captureOnCommitCallbacks(execute=True):
+            amount.save()
+        recipe.search_document.refresh_from_db()
+        self.assertEqual(
+            recipe.search_document.document, 'суп пюр\nмолок\nвар')
+
+    def test_ids_of_rolled_back_transaction_are_kept(self):
+        first, second = self.recipes[:2]
+        with mock.patch('api.search.reindex') as reindex:
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    search.schedule_reindex([first.id])
+                    raise ValueError
+            with self.captureOnCommitCallbacks(execute=True):
+                search.schedule_reindex([second.id])
+                search.schedule_reindex([second.id])
+        reindex.assert_called_once_with({first.id, second.id})
+
+    def test_reindex_recipes_command(self):
+        RecipeSearchDocument.objects.all().delete()
+        out = io.StringIO()
+        call_command('reindex_recipes', '--batch-size', '3', stdout=out)
+        self.assertIn('Indexed 4 recipes', out.getvalue())
+        self.assertEqual(
+            RecipeSearchDocument.objects.get(
+                recipe=self.recipes[0]).document,
+            'каш 0\nмолок\nвар')
+
+        self.recipes[0].search_document.delete()
+        out = io.StringIO()
+        call_command('reindex_recipes', '--missing', stdout=out)
+        self.assertIn('Indexed 1 recipes', out.getvalue())
+        self.assertEqual(RecipeSearchDocument.objects.count(), 4)
+
+
+class RecipeWriteTests(RecipeAPITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Ingredient.objects.bulk_create([
+            Ingredient(name=f'ингредиент {number}', measurement_unit='г')
+            for number in range(20)
+        ])
+        cls.ingredients = list(Ingredient.objects.exclude(pk=cls.milk.pk))
+
+    def payload(self, ingredients):
+        return {
+            'name': 'Суп', 'text': 'Варить', 'cooking_time': 30,
+            'image': IMAGE, 'tags': [self.breakfast.id, self.dinner.id],
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 10 + number}
+                for number, ingredient in enumerate(ingredients)],
+        }
+
+    def count_create_queries(self, ingredients):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post(
+                '/recipes/', self.payload(ingredients), format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return len(captured)
+
+    def test_create_queries_do_not_grow_with_ingredients(self):
+        get_registry()
+        self.assertEqual(
+            self.count_create_queries(self.ingredients[:2]),
+            self.count_create_queries(self.ingredients))
+
+    def test_create_writes_all_rows(self):
+        self.client.post(
+            '/recipes/', self.payload(self.ingredients), format='json')
+        recipe = Recipe.objects.latest('id')
+        self.assertEqual(recipe.ingredient_amounts.count(), 20)
+        self.assertEqual(recipe.tags.count(), 2)
+
+    def test_unknown_and_duplicate_ingredients_are_rejected(self):
+        for ingredients in ([{'id': 0, 'amount': 1}],
+                            [{'id': self.milk.id, 'amount': 1}] * 2):
+            payload = self.payload([])
+            payload['ingredients'] = ingredients
+            response = self.client.post('/recipes/', payload, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('ingredients', response.data)
+
+    def test_update_only_touches_changed_rows(self):
+        recipe = self.recipes[0]
+        IngredientAmount.objects.bulk_create([
+            IngredientAmount(recipe=recipe, ingredient=ingredient, amount=5)
+            for ingredient in self.ingredients[:3]
+        ])
+        kept = recipe.ingredient_amounts.get(ingredient=self.ingredients[0])
+        ingredients = [
+            {'id': self.milk.id, 'amount': 200},
+            {'id': self.ingredients[0].id, 'amount': 5},
+            {'id': self.ingredients[1].id, 'amount': 50},
+            {'id': self.ingredients[3].id, 'amount': 7},
+        ]
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.patch(
+                f'/recipes/{recipe.id}/',
+                {'ingredients': ingredients, 'tags': [self.breakfast.id]},
+                format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        writes = [query['sql'] for query in captured
+                  if 'core_ingredientamount' in query['sql']
+                  and not query['sql'].startswith('SELECT')]
+        self.assertEqual(len(writes), 3)
+        self.assertEqual(
+            dict(recipe.ingredient_amounts.values_list(
+                'ingredient_id', 'amount')),
+            {self.milk.id: 200, self.ingredients[0].id: 5,
+             self.ingredients[1].id: 50, self.ingredients[3].id: 7})
+        self.assertTrue(IngredientAmount.objects.filter(pk=kept.pk).exists())
+        self.assertEqual(list(recipe.tags.all()), [self.breakfast])
+
+
+class RecipeImportTests(RecipeAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.image_root = os.path.join(self.temp_dir, 'import')
+        os.makedirs(self.image_root)
+        Image.new('RGB', (4, 4)).save(
+            os.path.join(self.image_root, 'soup.png'))
+        settings = override_settings(IMPORT_IMAGE_ROOT=self.image_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def line(self, name, **extra):
+        return json.dumps({
+            'name': name, 'text': 'Варить', 'cooking_time': 20,
+            'image': 'soup.png', 'tags': ['breakfast', self.dinner.id],
+            'ingredients': [
+                {'id': self.milk.id, 'amount': 100},
+                {'name': 'молоко', 'measurement_unit': 'мл', 'amount': 1},
+            ][:1 + extra.pop('by_name', 0)],
+            **extra,
+        }, ensure_ascii=False)
+
+    def test_endpoint_imports_valid_lines_and_reports_errors(self):
+        body = '\n'.join([
+            self.line('Суп'),
+            self.line('Борщ', tags=['lunch']),
+            self.line('Щи', image='../secret.png'),
+            '{not json',
+        ])
+        response = self.client.generic(
+            'POST', '/recipes/import/', body,
+            content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(
+            [error['line'] for error in response.data['chunks'][0]['errors']],
+            [2, 3, 4])
+        recipe = Recipe.objects.get(name='Суп')
+        self.assertEqual(recipe.tags.count(), 2)
+        self.assertEqual(recipe.ingredient_amounts.get().amount, 100)
+
+    def count_import_queries(self, count):
+        lines = [self.line(f'Суп {number}') for number in range(count)]
+        with CaptureQueriesContext(connection) as captured:
+            report, = RecipeImporter(self.user, chunk_size=10).run(lines)
+        self.assertEqual(report.created, count)
+        return len(captured)
+
+    def test_chunk_queries_do_not_grow_with_lines(self):
+        get_registry()
+        self.assertEqual(
+            self.count_import_queries(2), self.count_import_queries(10))
+
+    def test_lines_are_split_into_chunks(self):
+        lines = [
+            self.line(f'Суп {number}', ingredients=[
+                {'id': self.milk.id, 'amount': number + 1}])
+            for number in range(5)
+        ]
+        reports = list(RecipeImporter(self.user, chunk_size=2).run(lines))
+        self.assertEqual([report.created for report in reports], [2, 2, 1])
+        # Every new recipe got its own ingredient rows.
+        self.assertEqual(
+            dict(IngredientAmount.objects.filter(
+                recipe__name__startswith='Суп '
+            ).values_list('recipe__name', 'amount')),
+            {f'Суп {number}': number + 1 for number in range(5)})
+
+    def test_duplicate_ingredient_is_rejected(self):
+        report, = RecipeImporter(self.user).run([self.line('Суп', by_name=1)])
+        self.assertEqual(report.created, 0)
+        self.assertIn('more than once', report.errors[0][1])
+
+
+class ImageVariantTests(RecipeAPITestCase):
+
+    def test_variants_are_generated_after_save(self):
+        payload = {
+            'name': 'Суп', 'text': 'Варить', 'cooking_time': 30,
+            'image': IMAGE, 'tags': [self.breakfast.id],
+            'ingredients': [{'id': self.milk.id, 'amount': 100}],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/recipes/', payload, format='json')
+        recipe_id = response.data['id']
+        variants = self.client.get(
+            f'/recipes/{recipe_id}/').data['image_variants']
+        self.assertEqual(set(variants), {'thumbnail', 'card', 'full'})
+        self.assertTrue(variants['thumbnail']['webp'].startswith('http'))
+        recipe = Recipe.objects.get(pk=recipe_id)
+        name = recipe.image_variants['files']['thumbnail']['jpeg']
+        with default_storage.open(name) as f, Image.open(f) as image:
+            self.assertEqual(image.format, 'JPEG')
+
+    def test_backfill_command(self):
+        recipe = self.recipes[0]
+        call_command('generate_image_variants', stdout=io.StringIO(),
+                     stderr=io.StringIO())
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.image_variants['source'], recipe.image.name)
+        card = self.client.get(f'/recipes/{recipe.id}/').data
+        self.assertEqual(
+            set(card['image_variants']), {'thumbnail', 'card', 'full'})
+
+
+def png(size):
+    buffer = io.BytesIO()
+    Image.new('RGB', size).save(buffer, 'PNG')
+    buffer.seek(0)
+    buffer.name = 'photo.png'
+    return buffer
+
+
+class ImageUploadTests(RecipeAPITestCase):
+
+    def patch_image(self, image):
+        return self.client.patch(
+            f'/recipes/{self.recipes[0].id}/', {'image': image},
+            format='json')
+
+    def test_base64_image_is_decoded(self):
+        data = base64.b64encode(png((8, 8)).getvalue()).decode()
+        response = self.patch_image(f'data:image/png;base64,{data}')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.recipes[0].refresh_from_db()
+        self.assertRegex(
+            self.recipes[0].image.name,
+            r'^images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+
+    @override_settings(RECIPE_IMAGE_MAX_BYTES=16)
+    def test_oversized_base64_is_rejected_before_decoding(self):
+        with mock.patch('api.uploads.base64.b64decode') as b64decode:
+            response = self.patch_image(IMAGE)
+        self.assertEqual(response.status_code, 400)
+        b64decode.assert_not_called()
+
+    @override_settings(RECIPE_IMAGE_MAX_PIXELS=100)
+    def test_pixel_limit(self):
+        data = base64.b64encode(png((11, 10)).getvalue()).decode()
+        response = self.patch_image(f'data:image/png;base64,{data}')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('11x10', str(response.data['image']))
+
+    def test_multipart_upload(self):
+        response = self.client.put(
+            f'/recipes/{self.recipes[0].id}/image/',
+            {'image': png((8, 8))}, format='multipart')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertTrue(response.data['image'].endswith('.png'))
+
+    @override_settings(RECIPE_IMAGE_MAX_BYTES=32)
+    def test_oversized_multipart_upload_is_dropped(self):
+        response = self.client.put(
+            f'/recipes/{self.recipes[0].id}/image/',
+            {'image': png((8, 8))}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+
+    def test_only_author_can_upload(self):
+        other = User.objects.create_user(
+            username='guest', email='guest@foodgram.ru', password='pass')
+        self.client.force_authenticate(other)
+        response = self.client.put(
+            f'/recipes/{self.recipes[0].id}/image/',
+            {'image': png((8, 8))}, format='multipart')
+        self.assertEqual(response.status_code, 403)
+
+
+class DeduplicatedStorageTests(RecipeAPITestCase):
+
+    def upload(self, recipe):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f'/recipes/{recipe.id}/image/',
+                {'image': png((8, 8))}, format='multipart')
+        recipe.refresh_from_db()
+        return recipe.image.name
+
+    def test_same_content_is_stored_once(self):
+        first, second = self.recipes[:2]
+        name = self.upload(first)
+        self.assertEqual(self.upload(second), name)
+        self.assertEqual(StoredFile.objects.get(name=name).references, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(StoredFile.objects.filter(name=name).exists())
+
+    def test_replaced_image_is_released(self):
+        recipe = self.recipes[0]
+        old = self.upload(recipe)
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.image = 'images/test.png'
+            recipe.save()
+        self.assertFalse(default_storage.exists(old))
+
+    def test_file_reused_before_collect_is_kept(self):
+        first, second = self.recipes[:2]
+        name = self.upload(first)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.image = 'images/test.png'
+            first.save()
+            second.image = name
+            second.save()
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(StoredFile.objects.get(name=name).references, 1)
+
+    def test_rebuild_refcounts(self):
+        name = self.upload(self.recipes[0])
+        StoredFile.objects.all().delete()
+        call_command('rebuild_media_refcounts', stdout=io.StringIO())
+        self.assertEqual(StoredFile.objects.get(name=name).references, 1)
+        self.assertEqual(
+            StoredFile.objects.get(name='images/test.png').references, 3)
+
+
+class IngredientAutocompleteTests(RecipeAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for name, unit in (('Молоко сгущенное', 'г'), ('соевое молоко', 'мл'),
+                           ('мука', 'г'), ('Масло', 'г')):
+            Ingredient.objects.create(name=name, measurement_unit=unit)
+
+    def names(self, query, **params):
+        response = self.client.get(
+            '/ingredients/', {'name': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.data]
+
+    def test_prefix_matches_come_before_substring_matches(self):
+        self.assertEqual(
+            self.names('МОЛ'),
+            ['молоко', 'Молоко сгущенное', 'соевое молоко'])
+
+    def test_limit(self):
+        self.assertEqual(self.names('м', limit=2), ['Масло', 'молоко'])
+
+    def test_answers_without_queries(self):
+        self.names('мол')
+        with self.assertNumQueries(0):
+            self.names('мук')
+
+    def test_index_is_rebuilt_when_ingredients_change(self):
+        self.assertEqual(self.names('ман'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name='манка', measurement_unit='г')
+        self.assertEqual(self.names('ман'), ['манка'])
+
+
+class FuzzySearchTests(RecipeAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for name, unit in (('Молоко сгущенное', 'г'), ('малина', 'г')):
+            Ingredient.objects.create(name=name, measurement_unit=unit)
+
+    def test_similarity_matches_pg_trgm(self):
+        self.assertAlmostEqual(similarity('word', 'two words'), 4 / 11)
+        self.assertEqual(similarity('молоко', 'МОЛОКО!'), 1.0)
+
+    def test_ingredients_ranked_by_similarity(self):
+        response = self.client.get(
+            '/ingredients/', {'name': 'малако', 'fuzzy': 1})
+        self.assertEqual(
+            [item['name'] for item in response.data],
+            ['малина', 'молоко'])
+        response = self.client.get('/ingredients/', {'name': 'малако'})
+        self.assertEqual(response.data, [])
+
+    def test_recipe_search_tolerates_typos(self):
+        response = self.client.get('/recipes/?search=кпша 2&fuzzy=1')
+        ids = [recipe['id'] for recipe in response.data['results']]
+        self.assertEqual(ids[0], self.recipes[2].id)
+        self.assertEqual(sorted(ids), [r.id for r in self.recipes])
+        response = self.client.get('/recipes/?search=кпша')
+        self.assertEqual(response.data['results'], [])
+
+    @override_settings(FUZZY_SEARCH_MAX_CANDIDATES=1)
+    def test_candidates_are_cut_after_filters(self):
+        response = self.client.get('/recipes/', {
+            'search': 'кпша 2', 'fuzzy': 1, 'is_in_shopping_cart': 1})
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [self.recipes[1].id])
+
+
+class LoadIngredientsTests(RecipeAPITestCase):
+
+    def write(self, name, content):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def load(self, *paths):
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('load_ing', *paths, stdout=out)
+        return out.getvalue().strip()
+
+    def test_rerun_is_idempotent(self):
+        json_path = self.write('ingredients.json', json.dumps([
+            {'name': 'молоко', 'measurement_unit': 'мл'},
+            {'name': 'соль', 'measurement_unit': 'г'},
+        ], ensure_ascii=False))
+        csv_path = self.write(
+            'ingredients.csv', 'соль,г\n"перец, черный",г\n,г\n')
+        with mock.patch('api.management.commands.load_ing.READ_SIZE', 7):
+            self.assertEqual(
+                self.load(json_path, csv_path),
+                '2 inserted, 0 updated, 1 unchanged, 1 skipped')
+        self.assertEqual(
+            self.load(json_path, csv_path),
+            '0 inserted, 0 updated, 3 unchanged, 1 skipped')
+        self.assertEqual(Ingredient.objects.filter(name='соль').count(), 1)
+        self.assertTrue(Ingredient.objects.filter(
+            name='перец, черный').exists())
+
+    def test_whitespace_is_normalized(self):
+        sugar = Ingredient.objects.create(
+            name=' сахар  песок', measurement_unit='г')
+        recipe = self.recipes[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientAmount.objects.create(
+                recipe=recipe, ingredient=sugar, amount=5)
+        url = f'/recipes/{recipe.id}/'
+        self.client.get(url)
+        anonymous = APIClient()
+        anonymous.get(url)
+
+        path = self.write('ingredients.csv', 'сахар песок,г\n')
+        self.assertEqual(
+            self.load(path), '0 inserted, 1 updated, 0 unchanged, 0 skipped')
+        self.assertTrue(Ingredient.objects.filter(
+            name='сахар песок', measurement_unit='г').exists())
+        for client in (self.client, anonymous):
+            names = [item['name']
+                     for item in client.get(url).data['ingredients']]
+            self.assertIn('сахар песок', names)
+        self.assertEqual(
+            RecipeSearchDocument.objects.get(recipe=recipe).document,
+            'каш 0\nмолок сахар песок\nвар')
+
+    def test_default_file(self):
+        path = self.write('catalog.json', json.dumps(
+            [{'name': 'соль', 'measurement_unit': 'г'}], ensure_ascii=False))
+        with override_settings(INGREDIENTS_DATA_PATH=path):
+            self.assertEqual(
+                self.load(), '1 inserted, 0 updated, 0 unchanged, 0 skipped')
+
+    def test_autocomplete_sees_loaded_ingredients(self):
+        self.client.get('/ingredients/', {'name': 'сол'})
+        self.load(self.write('ingredients.csv', 'соль,г\n'))
+        response = self.client.get('/ingredients/', {'name': 'сол'})
+        self.assertEqual([item['name'] for item in response.data], ['соль'])
+
+
+class IngredientSnapshotTests(RecipeAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'специя {number}', measurement_unit='г')
+            for number in range(50))
+
+    def get(self, url='/ingredients/snapshot/', **headers):
+        return self.client.get(url, **headers)
+
+    def test_gzip_snapshot_of_catalog(self):
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        catalog = json.loads(gzip.decompress(response.content))
+        self.assertEqual(len(catalog), 51)
+        self.assertEqual(
+            catalog[0],
+            {'id': self.milk.id, 'name': 'молоко', 'measurement_unit': 'мл'})
+        plain = self.get(HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(
+            plain.content, gzip.decompress(response.content))
+
+    def test_hashed_url_is_immutable(self):
+        response = self.get()
+        hashed = response['Content-Location']
+        self.assertIn(response['ETag'].strip('"'), hashed)
+        self.assertEqual(
+            response['Cache-Control'], 'public, max-age=0, must-revalidate')
+        response = self.get(hashed)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(
+            self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_regenerated_when_ingredients_change(self):
+        response = self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name='соль', measurement_unit='г')
+        changed = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(len(json.loads(changed.content)), 52)
+        self.assertEqual(
+            self.get(response['Content-Location']).status_code, 404)
+        with self.assertNumQueries(0):
+            self.get(changed['Content-Location'])
+
+
+class TagRegistryTests(RecipeAPITestCase):
+
+    def test_tags_served_without_queries(self):
+        get_registry()
+        with self.assertNumQueries(0):
+            response = self.client.get('/tags/')
+            detail = self.client.get(f'/tags/{self.dinner.id}/')
+        self.assertEqual(
+            [tag['slug'] for tag in response.data], ['breakfast', 'dinner'])
+        self.assertEqual(detail.data['name'], 'Ужин')
+        self.assertEqual(self.client.get('/tags/0/').status_code, 404)
+
+    def test_reloaded_when_version_changes(self):
+        registry = get_registry()
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Обед', color='#49B64E', slug='lunch')
+        self.assertIsNot(get_registry(), registry)
+        self.assertIn('lunch', get_registry().by_slug)
+        recipe = self.client.get(f'/recipes/{self.recipes[0].id}/').data
+        self.assertEqual(
+            [tag['slug'] for tag in recipe['tags']], ['breakfast', 'dinner'])
+
+    def test_reloaded_when_another_process_bumps_version(self):
+        registry = get_registry()
+        version = get_version('tags')
+        subprocess.run(
+            [sys.executable, '-c',
+             'import django; django.setup(); '
+             'from api.cache import bump_version; bump_version("tags")'],
+            check=True, cwd=os.path.dirname(os.path.dirname(__file__)),
+            env={**os.environ,
+                 'DJANGO_SETTINGS_MODULE': 'foodgram.settings',
+                 'CACHE_LOCATION': self.cache_dir.name})
+        self.assertNotEqual(get_version('tags'), version)
+        self.assertIsNot(get_registry(), registry)
+
+    def test_process_local_cache_is_reported(self):
+        self.assertEqual(check_shared_cache(None), [])
+        local = {'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(CACHES=local):
+            warnings = check_shared_cache(None)
+        self.assertEqual([warning.id for warning in warnings], ['api.W001'])
+
+    def test_unknown_tag_is_rejected(self):
+        response = self.client.post('/recipes/', {
+            'name': 'Суп', 'text': 'Варить', 'cooking_time': 30,
+            'image': IMAGE, 'tags': [0],
+            'ingredients': [{'id': self.milk.id, 'amount': 10}],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('tags', response.data)
+
+
+class ShoppingListTests(RecipeAPITestCase):
+
+    def test_totals_grouped_by_name_and_unit(self):
+        salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+        spoon = Ingredient.objects.create(
+            name='соль', measurement_unit='ч. л.')
+        for recipe in self.recipes[1:3]:
+            IngredientAmount.objects.create(
+                recipe=recipe, ingredient=salt, amount=5)
+        IngredientAmount.objects.create(
+            recipe=self.recipes[2], ingredient=spoon, amount=1)
+        self.user.shopping_list.recipes.add(self.recipes[2])
+        other = User.objects.create_user(
+            username='other', email='other@foodgram.ru', password='pass')
+        ShoppingList.objects.create(user=other).recipes.add(self.recipes[3])
+
+        with self.assertNumQueries(1):
+            rows = list(iter_cart_totals(self.user))
+        self.assertEqual(rows, [
+            {'name': 'молоко', 'measurement_unit': 'мл', 'amount': 400},
+            {'name': 'соль', 'measurement_unit': 'г', 'amount': 10},
+            {'name': 'соль', 'measurement_unit': 'ч. л.', 'amount': 1},
+        ])
+
+    def totals(self, user):
+        return dict(ShoppingCartTotal.objects.filter(
+            user=user).values_list('ingredient_id', 'amount'))
+
+    def test_totals_follow_cart_and_recipe_changes(self):
+        sugar = Ingredient.objects.create(name='сахар', measurement_unit='г')
+        recipe = self.recipes[2]
+        response = self.client.post(f'/recipes/{recipe.id}/shopping_cart/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.totals(self.user), {self.milk.id: 400})
+
+        response = self.client.patch(
+            f'/recipes/{recipe.id}/',
+            {'ingredients': [{'id': self.milk.id, 'amount': 50},
+                             {'id': sugar.id, 'amount': 10}],
+             'tags': [self.breakfast.id]},
+            format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(
+            self.totals(self.user), {self.milk.id: 250, sugar.id: 10})
+
+        response = self.client.delete(
+            f'/recipes/{self.recipes[1].id}/shopping_cart/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            self.totals(self.user), {self.milk.id: 50, sugar.id: 10})
+        response = self.client.patch(
+            f'/recipes/{recipe.id}/',
+            {'ingredients': [{'id': sugar.id, 'amount': 10}],
+             'tags': [self.breakfast.id]},
+            format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.totals(self.user), {sugar.id: 10})
+        recipe.delete()
+        self.assertEqual(self.totals(self.user), {})
+
+    def test_totals_follow_reverse_links_and_row_saves(self):
+        other = User.objects.create_user(
+            username='other', email='other@foodgram.ru', password='pass')
+        other_list = ShoppingList.objects.create(user=other)
+        recipe = self.recipes[3]
+        recipe.shopping_lists.add(other_list, self.user.shopping_list)
+        self.assertEqual(self.totals(other), {self.milk.id: 200})
+        self.assertEqual(self.totals(self.user), {self.milk.id: 400})
+
+        sugar = Ingredient.objects.create(name='сахар', measurement_unit='г')
+        row = recipe.ingredient_amounts.get()
+        row.ingredient = sugar
+        row.save()
+        self.assertEqual(
+            self.totals(self.user), {self.milk.id: 200, sugar.id: 200})
+        recipe.shopping_lists.clear()
+        self.assertEqual(self.totals(other), {})
+        self.assertEqual(self.totals(self.user), {self.milk.id: 200})
+        other_list.recipes.add(recipe)
+        other_list.recipes.clear()
+        self.assertEqual(self.totals(other), {})
+
+    def test_check_cart_totals_rebuilds_drift(self):
+        sugar = Ingredient.objects.create(name='сахар', measurement_unit='г')
+        ShoppingCartTotal.objects.filter(user=self.user).update(amount=1)
+        ShoppingCartTotal.objects.create(
+            user=self.user, ingredient=sugar, amount=3)
+        out = io.StringIO()
+        call_command('check_cart_totals', '--dry-run', stdout=out)
+        self.assertIn(
+            '1 carts checked: 0 missing, 1 wrong, 1 extra rows',
+            out.getvalue())
+        self.assertEqual(
+            self.totals(self.user), {self.milk.id: 1, sugar.id: 3})
+
+        out = io.StringIO()
+        call_command('check_cart_totals', stdout=out)
+        self.assertIn('Totals rebuilt', out.getvalue())
+        self.assertEqual(self.totals(self.user), {self.milk.id: 200})
+        out = io.StringIO()
+        call_command('check_cart_totals', stdout=out)
+        self.assertEqual(
+            out.getvalue(),
+            '1 carts checked: 0 missing, 0 wrong, 0 extra rows\n')
+
+    def export(self, export_format):
+        response = self.client.get(
+            '/recipes/download_shopping_cart/', {'format': export_format})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            response['Content-Disposition'],
+            f'attachment; filename="cook_shopping_cart.{export_format}"')
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_text_exports(self):
+        salt = Ingredient.objects.create(
+            name='соль, крупная', measurement_unit='г')
+        IngredientAmount.objects.create(
+            recipe=self.recipes[1], ingredient=salt, amount=2)
+        self.assertEqual(
+            self.export('txt'), 'молоко: 200 мл\nсоль, крупная: 2 г\n')
+        self.assertEqual(
+            self.export('csv'),
+            'name,measurement_unit,amount\r\nмолоко,мл,200\r\n'
+            '"соль, крупная",г,2\r\n')
+        self.assertEqual(json.loads(self.export('json')), [
+            {'name': 'молоко', 'measurement_unit': 'мл', 'amount': 200},
+            {'name': 'соль, крупная', 'measurement_unit': 'г', 'amount': 2},
+        ])
+
+    def test_empty_cart_exports(self):
+        self.user.shopping_list.recipes.clear()
+        self.assertEqual(json.loads(self.export('json')), [])
+        self.assertEqual(self.export('txt'), '')
+
+
+class ShoppingListPDFTests(RecipeAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        Image.new('RGB', (1240, 1754), 'white').save(
+            os.path.join(self.temp_dir, 'media', 'layer.jpg'))
+
+    def download(self):
+        response = self.client.get('/recipes/download_shopping_cart/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def read(self, response):
+        content = b''.join(response.streaming_content)
+        response.close()
+        return content
+
+    def test_background_is_prepared_once(self):
+        with mock.patch(
+                'api.pdfgen.prepare_background',
+                wraps=pdfgen.prepare_background) as prepare:
+            for _ in range(2):
+                self.assertTrue(self.read(self.download()).startswith(b'%PDF'))
+        prepare.assert_called_once()
+        directory = os.path.join(self.temp_dir, 'pdf')
+        background, = [
+            name for name in os.listdir(directory) if name.endswith('.jpg')]
+        with Image.open(os.path.join(directory, background)) as image:
+            self.assertEqual(image.size, pdfgen.PAGE_SIZE)
+
+    def test_unchanged_cart_is_not_rendered_again(self):
+        with mock.patch.object(
+                pdfgen.ShoppingListRenderer, 'render',
+                autospec=True, side_effect=pdfgen.ShoppingListRenderer.render
+        ) as render:
+            first = self.read(self.download())
+            response = self.download()
+            self.assertEqual(
+                response['Content-Disposition'],
+                'attachment; filename="cook_shopping_cart.pdf"')
+            self.assertEqual(self.read(response), first)
+            self.assertEqual(render.call_count, 1)
+            self.user.shopping_list.recipes.add(self.recipes[2])
+            self.read(self.download())
+            self.assertEqual(render.call_count, 2)
+        self.assertEqual(sum(
+            len(files) for _, _, files in os.walk(
+                os.path.join(self.temp_dir, 'pdf', 'carts'))), 2)
+
+    @override_settings(PDF_ACCEL_REDIRECT_PREFIX='/protected/pdf/')
+    def test_sent_by_nginx(self):
+        response = self.download()
+        redirect = response['X-Accel-Redirect']
+        self.assertRegex(
+            redirect, r'^/protected/pdf/carts/[0-9a-f]{2}/[0-9a-f]{64}\.pdf$')
+        self.assertEqual(response.content, b'')
+        self.assertTrue(os.path.exists(os.path.join(
+            self.temp_dir, 'pdf', redirect[len('/protected/pdf/'):])))
+
+    def export(self):
+        response = self.client.post('/recipes/download_shopping_cart/')
+        return response, response.data['id']
+
+    def test_small_cart_is_exported_inline(self):
+        response, job_id = self.export()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], 'ready')
+        self.assertEqual(response['Location'], response.data['url'])
+        download = self.client.get(response.data['url'])
+        self.assertEqual(download.status_code, 200)
+        self.assertTrue(self.read(download).startswith(b'%PDF'))
+
+    @override_settings(PDF_EXPORT_WORKERS=1, PDF_EXPORT_INLINE_ROWS=0)
+    def test_large_cart_is_exported_in_pool(self):
+        response, job_id = self.export()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        # The pool has one process, so this runs after the render.
+        exports._get_executor().submit(int).result(timeout=60)
+        status = self.client.get(response.data['url'])
+        self.assertEqual(status.status_code, 200)
+        self.assertTrue(self.read(status).startswith(b'%PDF'))
+        self.assertEqual(self.export()[0].status_code, 201)
+
+    def test_export_belongs_to_its_user(self):
+        response, job_id = self.export()
+        other = User.objects.create_user(
+            username='guest', email='guest@foodgram.ru', password='pass')
+        self.client.force_authenticate(other)
+        self.assertEqual(
+            self.client.get(response.data['url']).status_code, 404)
+
+    def test_pending_export_outlives_cache(self):
+        job = ShoppingListExport.objects.create(
+            user=self.user, digest='1' * 64, state=exports.PENDING)
+        cache.clear()
+        url = f'/recipes/download_shopping_cart/{job.digest}/'
+        self.assertEqual(self.client.get(url).status_code, 202)
+        ShoppingListExport.objects.filter(pk=job.pk).update(
+            updated_at=job.updated_at - timedelta(
+                seconds=exports.STATE_TIMEOUT + 1))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data['status'], 'failed')
+
+    def stored_pdfs(self):
+        return sorted(
+            name for _, _, names in os.walk(
+                os.path.join(self.temp_dir, 'pdf', 'carts'))
+            for name in names)
+
+    def test_unused_pdfs_are_pruned(self):
+        response, job_id = self.export()
+        path = pdfgen.cart_path(job_id)
+        week_ago = time.time() - 7 * 24 * 3600
+        os.utime(path, (week_ago, week_ago))
+        self.read(self.download())
+        self.assertGreater(os.path.getmtime(path), week_ago)
+
+        os.utime(path, (week_ago, week_ago))
+        ShoppingListExport.objects.update(
+            updated_at=timezone.now() - timedelta(days=7))
+        self.user.shopping_list.recipes.add(self.recipes[2])
+        self.read(self.download())
+        out = io.StringIO()
+        call_command('prune_pdfs', days=1, stdout=out)
+        self.assertEqual(
+            out.getvalue().strip(), 'Deleted 1 PDFs and 1 export jobs')
+        self.assertEqual(len(self.stored_pdfs()), 1)
+        self.assertNotIn(f'{job_id}.pdf', self.stored_pdfs())
+        self.assertEqual(
+            self.client.get(response.data['url']).status_code, 404)
+
+    def test_unknown_export(self):
+        response = self.client.get(
+            f'/recipes/download_shopping_cart/{"0" * 64}/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_long_cart_spans_pages(self):
+        rows = [{'name': f'соль <{number}>', 'measurement_unit': 'г',
+                 'amount': number} for number in range(40)]
+        content = pdfgen.ShoppingListRenderer().render(rows)
+        self.assertGreater(content.count(b'/Type /Page\n'), 1)
+
+
+@override_settings(REQUEST_PROFILING_SAMPLE_RATE=1.0,
+                   REQUEST_PROFILING_N_PLUS_ONE_THRESHOLD=3)
+class RequestProfilingTests(RecipeAPITestCase):
+
+    def test_server_timing_header(self):
+        with self.assertLogs('api.middleware', 'INFO') as logs:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/recipes/')
+        timing = dict(
+            re.match(r'(\w+);dur=([\d.]+)', metric.strip()).groups()
+            for metric in response['Server-Timing'].split(','))
+        self.assertEqual(
+            sorted(timing), ['db', 'render', 'serializer', 'total'])
+        self.assertIn(
+            f'desc="{len(queries)} queries"', response['Server-Timing'])
+        self.assertGreater(float(timing['serializer']), 0)
+        self.assertLessEqual(
+            float(timing['serializer']) + float(timing['render']),
+            float(timing['total']))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['queries'], len(queries))
+        self.assertGreater(record['serializer_ms'], 0)
+        self.assertEqual(
+            record['view'], 'api.views.RecipeViewSet')
+
+    @override_settings(REQUEST_PROFILING_SAMPLE_RATE=0.5)
+    def test_sampling(self):
+        with mock.patch('api.middleware.random.random', return_value=0.7):
+            self.assertNotIn('Server-Timing', self.client.get('/recipes/'))
+        with mock.patch('api.middleware.random.random', return_value=0.3):
+            with self.assertLogs('api.middleware', 'INFO'):
+                response = self.client.get('/recipes/')
+        self.assertIn('Server-Timing', response)
+
+    def test_serializers_are_not_patched(self):
+        with self.assertLogs('api.middleware', 'INFO'):
+            self.client.get('/recipes/')
+        self.assertIs(
+            serializers.BaseSerializer.__dict__['data'],
+            BASE_SERIALIZER_DATA)
+
+    def test_n_plus_one_names_serializer_field(self):
+        for number in range(4):
+            author = User.objects.create_user(
+                username=f'author{number}',
+                email=f'author{number}@foodgram.ru', password='pass')
+            Subscription.objects.create(
+                subscriber=self.user, subscribed_to=author)
+        with self.assertLogs('api.middleware', 'WARNING') as logs:
+            self.client.get('/users/subscriptions/')
+        output = '\n'.join(logs.output)
+        self.assertIn('n_plus_one', output)
+        self.assertIn('SubscribedUserSerializer.get_recipes', output)
+
+    @override_settings(REQUEST_PROFILING_SAMPLE_RATE=0.0)
+    def test_unsampled_requests_are_untouched(self):
+        self.assertNotIn('Server-Timing', self.client.get('/recipes/'))
+
+
+class BenchmarkCommandTests(RecipeAPITestCase):
+
+    def test_seed_and_bench(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'seed_perf', users=3, recipes=4, tags=2,
+                ingredients_per_recipe=2, favorites_per_user=2,
+                subscriptions_per_user=1, cart_per_user=2,
+                stdout=io.StringIO())
+        images = set(Recipe.objects.filter(
+            author__username__startswith='perf-').values_list(
+                'image', flat=True))
+        self.assertEqual(len(images), 1)
+        image, = images
+        self.assertTrue(default_storage.exists(image))
+        self.assertEqual(
+            StoredFile.objects.get(name=image).references, 4)
+
+        output = os.path.join(self.temp_dir, 'bench.json')
+        call_command(
+            'bench_api', iterations=1, warmup=0, output=output,
+            stdout=io.StringIO())
+        with open(output, encoding='utf-8') as f:
+            scenarios = json.load(f)['scenarios']
+        for name in ('recipe_detail', 'recipe_list_tags',
+                     'ingredient_autocomplete', 'download_shopping_cart'):
+            self.assertEqual(
+                [scenarios[name][mode]['errors'] for mode in ('cold', 'warm')],
+                [0, 0], name)
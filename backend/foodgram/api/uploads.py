@@ -0,0 +1,126 @@
+"""
+Size-bounded recipe image uploads.
+
+Multipart uploads are spooled straight to a temporary file and dropped as
+soon as they pass RECIPE_IMAGE_MAX_BYTES. Base64 data URIs are decoded in
+slices into a temporary file, after their decoded size has been checked
+against the same limit. Either way the image header is read to enforce
+RECIPE_IMAGE_MAX_PIXELS before anything decodes the pixel data.
+"""
+import base64
+import binascii
+import re
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import (
+    SkipFile,
+    TemporaryFileUploadHandler,
+)
+from django.http.multipartparser import (
+    MultiPartParser as DjangoMultiPartParser,
+    MultiPartParserError,
+)
+from PIL import Image
+from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import DataAndFiles, MultiPartParser
+
+DATA_URI_RE = re.compile(r'data:image/(?P<extension>[\w.+-]+);base64,')
+# Base64 characters decoded per step, a multiple of 4.
+DECODE_STEP = 64 * 1024
+
+
+def too_large_error():
+    limit = settings.RECIPE_IMAGE_MAX_BYTES / 1024 / 1024
+    return serializers.ValidationError(
+        f'Image is larger than {limit:.0f} MB')
+
+
+def check_image(file):
+    """Validate size and pixel count from the file size and image header."""
+    if file.size > settings.RECIPE_IMAGE_MAX_BYTES:
+        raise too_large_error()
+    position = file.tell()
+    try:
+        with Image.open(file) as image:
+            width, height = image.size
+    except (OSError, Image.DecompressionBombError):
+        raise serializers.ValidationError('Upload a valid image')
+    finally:
+        file.seek(position)
+    if width * height > settings.RECIPE_IMAGE_MAX_PIXELS:
+        raise serializers.ValidationError(
+            f'Image is {width}x{height}, at most '
+            f'{settings.RECIPE_IMAGE_MAX_PIXELS} pixels are allowed')
+
+
+class DecodedImageFile(TemporaryUploadedFile):
+    """
+    Temporary file for a decoded data URI. Unlike request uploads nothing
+    closes it at the end of the request, so it closes itself once
+    collected (the storage may have moved it away by then).
+    """
+
+    def __del__(self):
+        self.close()
+
+
+def decode_data_uri(data):
+    """Decode a base64 image data URI into a temporary file."""
+    match = DATA_URI_RE.match(data)
+    if match is None:
+        raise serializers.ValidationError('Expected a base64 image data URI')
+    start = match.end()
+    encoded_length = len(data) - start
+    padding = data.count('=', max(start, len(data) - 2))
+    if encoded_length * 3 // 4 - padding > settings.RECIPE_IMAGE_MAX_BYTES:
+        raise too_large_error()
+
+    extension = match.group('extension').lower()
+    file = DecodedImageFile(
+        f'temp.{extension}', f'image/{extension}', 0, None)
+    try:
+        for offset in range(start, len(data), DECODE_STEP):
+            file.write(base64.b64decode(
+                data[offset:offset + DECODE_STEP], validate=True))
+    except (binascii.Error, ValueError):
+        file.close()
+        raise serializers.ValidationError('Invalid base64 image data')
+    file.size = file.tell()
+    file.seek(0)
+    return file
+
+
+class SizeLimitedUploadHandler(TemporaryFileUploadHandler):
+    """Spools files to disk and skips any past RECIPE_IMAGE_MAX_BYTES."""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.RECIPE_IMAGE_MAX_BYTES:
+            self.file.close()
+            raise SkipFile()
+        return super().receive_data_chunk(raw_data, start)
+
+
+class SpooledMultiPartParser(MultiPartParser):
+    """MultiPartParser that only uses SizeLimitedUploadHandler."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context['request']
+        encoding = parser_context.get(
+            'encoding', settings.DEFAULT_CHARSET)
+        meta = request.META.copy()
+        meta['CONTENT_TYPE'] = media_type
+        handlers = [SizeLimitedUploadHandler(request)]
+        try:
+            parser = DjangoMultiPartParser(meta, stream, handlers, encoding)
+            data, files = parser.parse()
+            return DataAndFiles(data, files)
+        except MultiPartParserError as exc:
+            raise ParseError(f'Multipart form parse error - {exc}')
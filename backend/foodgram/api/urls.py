@@ -1,12 +1,16 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework import routers
 from .views import (RecipeViewSet,
                     IngredientViewSet,
                     TagViewSet,
                     FavoriteRecipeView,
+                    IngredientSnapshotView,
+                    RecipeImageView,
+                    RecipeImportView,
                     add_recipe_to_shopping_cart,
+                    download_shopping_cart,
+                    shopping_cart_export,
                     SubscribedToView)
-from .pdfgen import download_shopping_cart_t
 from django.urls import path, include
 from rest_framework_simplejwt.views import (TokenObtainPairView,
                                             TokenRefreshView,
@@ -30,9 +34,24 @@ router.register(r'tags', TagViewSet)
 app_name = 'fgapi'
 urlpatterns = [
     path('recipes/download_shopping_cart/',
-         download_shopping_cart_t,
+         download_shopping_cart,
          name='download_shopping_cart'),
+    re_path(r'^recipes/download_shopping_cart/(?P<job_id>[0-9a-f]{64})/$',
+            shopping_cart_export,
+            name='shopping_cart_export'),
+    path('recipes/import/',
+         RecipeImportView.as_view(),
+         name='recipe_import'),
+    path('ingredients/snapshot/',
+         IngredientSnapshotView.as_view(),
+         name='ingredient_snapshot'),
+    path('ingredients/snapshot/<slug:digest>/',
+         IngredientSnapshotView.as_view(),
+         name='ingredient_snapshot_hashed'),
     path('', include(router.urls)),
+    path('recipes/<int:id>/image/',
+         RecipeImageView.as_view(),
+         name='recipe_image'),
     path('recipes/<int:id>/favorite/',
          FavoriteRecipeView.as_view(),
          name='favorite_recipe'),
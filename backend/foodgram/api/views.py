@@ -1,6 +1,10 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters, generics, permissions, status, viewsets
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.filters import OrderingFilter, SearchFilter
 from rest_framework.generics import RetrieveAPIView
 from rest_framework.pagination import (
@@ -9,6 +13,7 @@ from rest_framework.pagination import (
 )
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
@@ -24,8 +29,19 @@ from core.models import (
     Tag,
     User,
 )
-from .filters import IngredientFilter
-from .paginators import CustomPagination
+from . import autocomplete, exports, snapshot
+from .cache import AnonymousCacheMixin
+from .conditional import ConditionalGetMixin
+from .filters import IngredientFilter, RecipeFilter, RecipeSearchFilter
+from .fuzzy import get_fuzzy_backend, is_fuzzy
+from .importer import RecipeImporter
+from .middleware import ProfiledSerializerMixin
+from .uploads import SpooledMultiPartParser
+from .paginators import CustomPagination, RecipePagination
+from .pdfgen import cart_path, get_renderer, pdf_response
+from .renderers import CSVRenderer, PlainTextRenderer
+from .shopping import EXPORT_FORMATS, iter_cart_totals, stream_export
+from .tags import get_registry
 from .serializers import (
     AuthTokenEmailSerializer,
     CustUserSerializer,
@@ -42,41 +58,27 @@ from .serializers import (
 )
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, AnonymousCacheMixin,
+                    ProfiledSerializerMixin, viewsets.ModelViewSet):
     """Manage recipes in the database"""
     serializer_class = RecipeSerializer
-    queryset = Recipe.objects.all().select_related(
-        'author').prefetch_related(
-        'tags', 'ingredients')
+    # Tags and ingredients are prefetched by RecipeSerializer only for
+    # recipes missing from the fragment cache.
+    queryset = Recipe.objects.all().select_related('author')
     permission_classes = (AllowAny,)
-    filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
-    filterset_fields = ('tags__slug', 'author')
-    search_fields = ('title', 'ingredients__name')
-    pagination_class = PageNumberPagination
+    filter_backends = (DjangoFilterBackend, OrderingFilter, RecipeSearchFilter)
+    filterset_class = RecipeFilter
+    pagination_class = RecipePagination
     ordering = ('id', )
+    conditional_versions = ('recipes',)
+    conditional_per_viewer = True
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        queryset = self.filter_queryset_by_params(queryset, self.request.query_params)
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.with_viewer_state(self.request.user)
         return queryset
 
-    def filter_queryset_by_params(self, queryset, query_params):
-        tags = query_params.getlist('tags')
-
-        if tags:
-            queryset = queryset.filter(tags__slug__in=tags)
-
-        is_favorite = query_params.get('is_favorited', None)
-        is_in_shopping_cart = query_params.get('is_in_shopping_cart', None)
-
-        if is_favorite == '1':
-            queryset = queryset.filter(favoriterecipe__user=self.request.user)
-
-        if is_in_shopping_cart is not None:
-            queryset = queryset.filter(shopping_lists__user=self.request.user)
-
-        return queryset.distinct()
-
     def get_serializer_class(self):
         if self.action == 'list' or self.action == 'retrieve':
             return RecipeSerializer
@@ -86,8 +88,18 @@ class RecipeViewSet(viewsets.ModelViewSet):
         # The request user is set as author automatically.
         serializer.save(author=self.request.user)
 
+    def get_last_modified(self, request):
+        # Viewer flags change without touching updated_at, so only
+        # anonymous detail responses are dated.
+        if self.action != 'retrieve' or request.user.is_authenticated:
+            return None
+        return Recipe.objects.filter(
+            pk=self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        ).values_list('updated_at', flat=True).first()
+
 
-class IngredientViewSet(viewsets.ModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, ProfiledSerializerMixin,
+                        viewsets.ModelViewSet):
     """Manage ingredients in the database"""
     serializer_class = IngredientSerializer
     queryset = Ingredient.objects.all()
@@ -97,16 +109,36 @@ class IngredientViewSet(viewsets.ModelViewSet):
     filterset_class = IngredientFilter
     search_fields = ('name',)
     pagination_class = None
+    conditional_versions = ('ingredients',)
+
+    def list(self, request, *args, **kwargs):
+        # ?name= is answered from the autocomplete index, without queries,
+        # or by trigram similarity with ?fuzzy=1.
+        if not request.query_params.get('name'):
+            return super().list(request, *args, **kwargs)
+        if is_fuzzy(request):
+            return self.conditional_response(request, self.fuzzy_search)
+        return self.conditional_response(request, self.autocomplete)
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(
+                'limit', settings.INGREDIENT_AUTOCOMPLETE_LIMIT))
+        except ValueError:
+            limit = settings.INGREDIENT_AUTOCOMPLETE_LIMIT
+        return max(1, min(limit, settings.INGREDIENT_AUTOCOMPLETE_MAX_LIMIT))
 
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        search_query = self.request.query_params.get('name', None)
-        if search_query:
-            queryset = queryset.filter(name__istartswith=search_query)
-        return queryset
+    def autocomplete(self, request):
+        return Response(autocomplete.search(
+            request.query_params['name'], self.get_limit(request)))
+
+    def fuzzy_search(self, request):
+        return Response(get_fuzzy_backend().ingredients(
+            request.query_params['name'].strip(), self.get_limit(request)))
 
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(ConditionalGetMixin, ProfiledSerializerMixin,
+                 viewsets.ModelViewSet):
     """Manage tags in the database"""
     serializer_class = TagSerializer
     queryset = Tag.objects.all()
@@ -114,6 +146,116 @@ class TagViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
     filterset_fields = ('name', 'slug')
     pagination_class = None
+    conditional_versions = ('tags',)
+
+    # Unfiltered reads are served from the in-memory tag registry.
+    def list(self, request, *args, **kwargs):
+        if request.query_params:
+            return super().list(request, *args, **kwargs)
+        return self.conditional_response(
+            request, lambda request: Response(get_registry().data))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(request, self.registry_retrieve)
+
+    def registry_retrieve(self, request):
+        try:
+            data = get_registry().data_by_id[int(self.kwargs['pk'])]
+        except (KeyError, ValueError):
+            raise Http404
+        return Response(data)
+
+
+class IngredientSnapshotView(APIView):
+    """
+    The whole ingredient catalog as one precompressed JSON document,
+    see api/snapshot.py. The content-hashed URL is cached for good.
+    """
+    permission_classes = (AllowAny,)
+    authentication_classes = ()
+
+    def get(self, request, digest=None):
+        current = snapshot.get_snapshot()
+        if digest is not None and digest != current.digest:
+            return Response(
+                {'detail': 'Снимок устарел'}, status=status.HTTP_404_NOT_FOUND)
+        response = get_conditional_response(request, etag=current.etag)
+        if response is None:
+            encoding, body = current.negotiate(
+                request.META.get('HTTP_ACCEPT_ENCODING', ''))
+            response = HttpResponse(
+                body, content_type='application/json; charset=utf-8')
+            if encoding != 'identity':
+                response['Content-Encoding'] = encoding
+        response['ETag'] = current.etag
+        response['Content-Location'] = reverse(
+            'fgapi:ingredient_snapshot_hashed', args=[current.digest])
+        if digest is None:
+            response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+        else:
+            response['Cache-Control'] = (
+                f'public, max-age={settings.INGREDIENT_SNAPSHOT_MAX_AGE}, '
+                'immutable')
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+class RecipeImportView(APIView):
+    """
+    Import recipes for the request user from an NDJSON request body,
+    see api/importer.py for the line format.
+    """
+    permission_classes = (IsAuthenticated,)
+    error_limit = 1000
+
+    def post(self, request):
+        stream = request.stream
+        lines = iter(stream.readline, b'') if stream is not None else ()
+        created = failed = 0
+        chunks = []
+        for report in RecipeImporter(request.user).run(lines):
+            created += report.created
+            chunk = report.as_dict()
+            # Keep the response bounded however many lines fail.
+            chunk['errors'] = chunk['errors'][:max(
+                0, self.error_limit - failed)]
+            failed += len(report.errors)
+            chunks.append(chunk)
+        return Response(
+            {'created': created, 'failed': failed, 'chunks': chunks},
+            status=status.HTTP_201_CREATED if created
+            else status.HTTP_400_BAD_REQUEST)
+
+
+class RecipeImageView(APIView):
+    """
+    Replace a recipe image with a multipart upload (field "image"), which
+    is spooled to disk instead of being held in memory.
+    """
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (SpooledMultiPartParser,)
+
+    def put(self, request, id):
+        recipe = generics.get_object_or_404(Recipe, id=id)
+        if recipe.author_id != request.user.id:
+            return Response(
+                {"detail": "Изменять рецепт может только автор"},
+                status=status.HTTP_403_FORBIDDEN)
+        if 'image' not in request.FILES:
+            return Response(
+                {"image": ["Нет изображения или оно слишком большое"]},
+                status=status.HTTP_400_BAD_REQUEST)
+        serializer = PostRecipeSerializer(
+            recipe, data={'image': request.FILES['image']}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        recipe = self.get_recipe(id)
+        return Response(
+            RecipeSerializer(recipe, context={'request': request}).data)
+
+    def get_recipe(self, id):
+        return Recipe.objects.with_viewer_state(
+            self.request.user).select_related('author').get(id=id)
 
 
 class FavoriteRecipeView(APIView):
@@ -188,6 +330,73 @@ def add_recipe_to_shopping_cart(request, id):
             {'error': 'Recipe is not in the shopping cart.'},
             status=status.HTTP_400_BAD_REQUEST)
 
+
+@api_view(['POST', 'GET'])
+@renderer_classes(
+    api_settings.DEFAULT_RENDERER_CLASSES + [PlainTextRenderer, CSVRenderer])
+def download_shopping_cart(request):
+    """
+    GET sends the shopping list PDF, rendered unless already stored, or
+    with ?format=txt|csv|json the bare totals, streamed from the query.
+    POST starts an export job (see api/exports.py) and answers with its
+    id and the URL the PDF can be fetched from once it is ready.
+    """
+    if not request.user.is_authenticated:
+        return HttpResponse('Unauthorized', status=401)
+    user = request.user
+    export_format = request.query_params.get('format')
+    if request.method == 'GET' and export_format in EXPORT_FORMATS:
+        _, content_type, extension = EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(
+            stream_export(user, export_format), content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="{user.username}_shopping_cart.'
+            f'{extension}"')
+        return response
+    if request.method == 'GET':
+        path = get_renderer().cached_pdf(iter_cart_totals(user))
+        return pdf_response(path, f"{user.username}_shopping_cart.pdf")
+    try:
+        job_id, state = exports.start(user)
+    except exports.QueueFull:
+        return Response(
+            {'detail': 'Очередь экспорта переполнена, повторите позже'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return export_job_response(request, job_id, state)
+
+
+@api_view(['GET'])
+def shopping_cart_export(request, job_id):
+    """The exported PDF once ready, the job state until then."""
+    if not request.user.is_authenticated:
+        return HttpResponse('Unauthorized', status=401)
+    state = exports.get_state(request.user, job_id)
+    if state is None:
+        return Response(
+            {'detail': 'Экспорт не найден'},
+            status=status.HTTP_404_NOT_FOUND)
+    if state == exports.READY:
+        return pdf_response(
+            cart_path(job_id),
+            f"{request.user.username}_shopping_cart.pdf")
+    return export_job_response(request, job_id, state)
+
+
+def export_job_response(request, job_id, state):
+    codes = {
+        exports.READY: status.HTTP_201_CREATED,
+        exports.PENDING: status.HTTP_202_ACCEPTED,
+        exports.FAILED: status.HTTP_500_INTERNAL_SERVER_ERROR,
+    }
+    url = request.build_absolute_uri(
+        reverse('fgapi:shopping_cart_export', args=[job_id]))
+    response = Response(
+        {'id': job_id, 'status': state, 'url': url}, status=codes[state])
+    if state != exports.FAILED:
+        response['Location'] = url
+    return response
+
+
 # came from users
 
 
@@ -216,7 +425,7 @@ class SubscribedToView(APIView, LimitOffsetPagination):
 
 
 # came from users
-class UserRegistrationView(generics.CreateAPIView):
+class UserRegistrationView(ProfiledSerializerMixin, generics.CreateAPIView):
     serializer_class = UserCreateSerializer
     queryset = User.objects.all()
     permission_classes = [permissions.AllowAny]
@@ -263,7 +472,8 @@ class SetPasswordView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class MyProfileView(generics.RetrieveUpdateAPIView):
+class MyProfileView(ProfiledSerializerMixin,
+                    generics.RetrieveUpdateAPIView):
     serializer_class = UserSerializer
     queryset = User.objects.all()
     permission_classes = [permissions.IsAuthenticated]
@@ -272,13 +482,13 @@ class MyProfileView(generics.RetrieveUpdateAPIView):
         return self.request.user
 
 
-class UserProfileView(RetrieveAPIView):
+class UserProfileView(ProfiledSerializerMixin, RetrieveAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     lookup_field = 'id'
 
 
-class UserListView(generics.ListCreateAPIView):
+class UserListView(ProfiledSerializerMixin, generics.ListCreateAPIView):
     serializer_class = UserSerializer
     permission_classes = [permissions.AllowAny]
 
@@ -347,7 +557,7 @@ class SubscriptionView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class SubscribedToView(ListAPIView):
+class SubscribedToView(ProfiledSerializerMixin, ListAPIView):
     permission_classes = [IsAuthenticated]
     pagination_class = PageNumberPagination
     filter_backends = (
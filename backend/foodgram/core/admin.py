@@ -7,6 +7,7 @@ from django.utils.html import format_html
 from .models import (Recipe, IngredientAmount,
                      Tag, Ingredient, FavoriteRecipe, ShoppingList)
 from .forms import RecipeForm
+from api.images import variant_urls
 
 
 # admin.site.unregister(User)
@@ -72,7 +73,9 @@ class RecipeAdmin(admin.ModelAdmin):
 
     def display_image(self, obj):
         if obj.image:
-            return format_html('<img src="{}" width="50" height="50" />', obj.image.url)
+            thumbnail = variant_urls(obj).get('thumbnail')
+            url = thumbnail['jpeg'] if thumbnail else obj.image.url
+            return format_html('<img src="{}" width="50" height="50" />', url)
         return 'No Image'
     display_image.short_description = 'Image Preview'
 
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.18 on 2026-10-18 02:38
+
+from django.db import migrations
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    # Reruns of the old load_ing copied the whole catalog; point recipes
+    # at the first copy of each ingredient and drop the others.
+    Ingredient = apps.get_model('core', 'Ingredient')
+    IngredientAmount = apps.get_model('core', 'IngredientAmount')
+    first = {}
+    duplicates = {}
+    for pk, name, unit in Ingredient.objects.order_by('id').values_list(
+            'id', 'name', 'measurement_unit'):
+        kept = first.setdefault((name, unit), pk)
+        if kept != pk:
+            duplicates.setdefault(kept, []).append(pk)
+    for kept, pks in duplicates.items():
+        IngredientAmount.objects.filter(ingredient_id__in=pks).update(
+            ingredient_id=kept)
+    Ingredient.objects.filter(
+        id__in=[pk for pks in duplicates.values() for pk in pks]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            merge_duplicate_ingredients, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='ingredient',
+            unique_together={('name', 'measurement_unit')},
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.18 on 2026-10-18 02:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_totals(apps, schema_editor):
+    IngredientAmount = apps.get_model('core', 'IngredientAmount')
+    ShoppingCartTotal = apps.get_model('core', 'ShoppingCartTotal')
+    totals = IngredientAmount.objects.filter(
+        recipe__shopping_lists__isnull=False
+    ).values_list(
+        'recipe__shopping_lists__user', 'ingredient'
+    ).annotate(models.Sum('amount')).order_by()
+    ShoppingCartTotal.objects.bulk_create(
+        (ShoppingCartTotal(user_id=user_id, ingredient_id=ingredient_id,
+                           amount=amount)
+         for user_id, ingredient_id, amount in totals.iterator()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_ingredient_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingCartTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField(verbose_name='Количество')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.ingredient', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cart_totals', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Итог списка покупок',
+                'verbose_name_plural': 'Итоги списков покупок',
+                'unique_together': {('user', 'ingredient')},
+            },
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.18 on 2026-10-18 03:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_shopping_cart_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListExport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=64, verbose_name='Хэш списка')),
+                ('state', models.CharField(choices=[('pending', 'Выполняется'), ('ready', 'Готов'), ('failed', 'Ошибка')], max_length=16, verbose_name='Состояние')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлён')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list_exports', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Экспорт списка покупок',
+                'verbose_name_plural': 'Экспорты списков покупок',
+                'unique_together': {('user', 'digest')},
+            },
+        ),
+    ]
@@ -9,9 +9,11 @@ from django.db import models
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, Group, Permission
 
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Q, Value
 from django.utils.translation import gettext as _
 
+from .storage import get_recipe_image_storage
+
 # Came from users
 
 USER = 'user'
@@ -154,6 +156,7 @@ class Ingredient(models.Model):
         )
 
     class Meta:
+        unique_together = ('name', 'measurement_unit')
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
 
@@ -161,13 +164,37 @@ class Ingredient(models.Model):
         return self.name
 
 
+class RecipeQuerySet(models.QuerySet):
+
+    def with_viewer_state(self, user):
+        """
+        Annotate is_favorited, is_in_shopping_cart and author_is_subscribed
+        for the given user so serializers can read the viewer-specific
+        flags without a query per recipe.
+        """
+        if user is None or not user.is_authenticated:
+            false = Value(False, output_field=models.BooleanField())
+            return self.annotate(
+                is_favorited=false,
+                is_in_shopping_cart=false,
+                author_is_subscribed=false)
+        return self.annotate(
+            is_favorited=Exists(FavoriteRecipe.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingList.objects.filter(
+                user=user, recipes=OuterRef('pk'))),
+            author_is_subscribed=Exists(Subscription.objects.filter(
+                subscriber=user, subscribed_to=OuterRef('author'))))
+
+
 class Recipe(models.Model):
     author = models.ForeignKey(
         User, on_delete=models.CASCADE, verbose_name='Автор')
     name = models.CharField(
         max_length=200, verbose_name='Название')
     image = models.ImageField(
-        upload_to='images/', verbose_name='Изображение')
+        upload_to='images/', storage=get_recipe_image_storage,
+        verbose_name='Изображение')
     text = models.TextField(
         verbose_name='Описание')
     ingredients = models.ManyToManyField(
@@ -180,6 +207,13 @@ class Recipe(models.Model):
         related_name='recipes_with_tag')
     cooking_time = models.IntegerField(
         verbose_name='Время приготовления (мин)')
+    updated_at = models.DateTimeField(
+        auto_now=True, verbose_name='Дата изменения')
+    image_variants = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='Варианты изображения')
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Рецепт'
@@ -189,6 +223,24 @@ class Recipe(models.Model):
         return self.name
 
 
+class StoredFile(models.Model):
+    """
+    Reference count of a file in content-addressed storage, which may be
+    shared by several recipes. Kept up to date by api/media.py.
+    """
+    name = models.CharField(
+        max_length=255, unique=True, verbose_name='Путь')
+    references = models.PositiveIntegerField(
+        default=0, verbose_name='Число ссылок')
+
+    class Meta:
+        verbose_name = 'Файл'
+        verbose_name_plural = 'Файлы'
+
+    def __str__(self):
+        return f'{self.name} ({self.references})'
+
+
 class IngredientAmount(models.Model):
     recipe = models.ForeignKey(
         Recipe,
@@ -249,6 +301,98 @@ class ShoppingList(models.Model):
         return f"Список покупок пользователя {self.user.username}"
 
 
+class ShoppingCartTotal(models.Model):
+    """
+    Amount of an ingredient summed over the recipes in a user's shopping
+    list, kept up to date by api/signals.py.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart_totals',
+        verbose_name='Пользователь')
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Ингредиент')
+    amount = models.PositiveIntegerField(verbose_name='Количество')
+
+    class Meta:
+        verbose_name = 'Итог списка покупок'
+        verbose_name_plural = 'Итоги списков покупок'
+        unique_together = ('user', 'ingredient')
+
+    def __str__(self):
+        return f"{self.user} - {self.ingredient} - {self.amount}"
+
+
+class ShoppingListExport(models.Model):
+    """
+    A user's shopping list PDF export job (api/exports.py), named by the
+    content hash of the cart.
+    """
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATES = (
+        (PENDING, 'Выполняется'),
+        (READY, 'Готов'),
+        (FAILED, 'Ошибка'),
+    )
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_exports',
+        verbose_name='Пользователь')
+    digest = models.CharField(
+        max_length=64, db_index=True, verbose_name='Хэш списка')
+    state = models.CharField(
+        max_length=16, choices=STATES, verbose_name='Состояние')
+    updated_at = models.DateTimeField(
+        auto_now=True, verbose_name='Обновлён')
+
+    class Meta:
+        verbose_name = 'Экспорт списка покупок'
+        verbose_name_plural = 'Экспорты списков покупок'
+        unique_together = ('user', 'digest')
+
+    def __str__(self):
+        return f"{self.user} - {self.digest} - {self.state}"
+
+
+class SearchVectorTextField(models.TextField):
+    """tsvector column on PostgreSQL, plain text everywhere else."""
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'tsvector'
+        return super().db_type(connection)
+
+
+class RecipeSearchDocument(models.Model):
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+        verbose_name='Рецепт')
+    document = models.TextField(
+        blank=True,
+        verbose_name='Поисковый документ')
+    vector = SearchVectorTextField(
+        null=True,
+        editable=False)
+
+    class Meta:
+        verbose_name = 'Поисковый документ рецепта'
+        verbose_name_plural = 'Поисковые документы рецептов'
+
+    def __str__(self):
+        return f"Поисковый документ {self.recipe_id}"
+
+
 class RecipeForm(forms.ModelForm):
     ingredients = models.ManyToManyField(
         Ingredient,
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that names files by the SHA-256 of their content,
+    so identical uploads are stored once. Files are sharded by hash
+    prefix under the upload directory, e.g.
+    images/3f/a2/3fa2...e1.jpg. Files are shared between rows, see
+    core.models.StoredFile for their reference counts.
+    """
+    shard_levels = 2
+    shard_width = 2
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is only known once the content is hashed.
+        return name
+
+    def hashed_name(self, name, digest):
+        directory = posixpath.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        shards = [
+            digest[level * self.shard_width:(level + 1) * self.shard_width]
+            for level in range(self.shard_levels)
+        ]
+        return posixpath.join(directory, *shards, digest + extension)
+
+    def _save(self, name, content):
+        # Hash while spooling into the upload directory, then move the
+        # file into place; a file that already exists has the same bytes.
+        staging = self.path(posixpath.dirname(name))
+        os.makedirs(staging, exist_ok=True)
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=staging, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+            hashed = self.hashed_name(name, digest.hexdigest())
+            full_path = self.path(hashed)
+            if os.path.exists(full_path):
+                os.remove(temp_path)
+                return hashed
+            if self.directory_permissions_mode is not None:
+                old_umask = os.umask(0)
+                try:
+                    os.makedirs(
+                        os.path.dirname(full_path),
+                        self.directory_permissions_mode, exist_ok=True)
+                finally:
+                    os.umask(old_umask)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.replace(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return hashed
+
+
+recipe_image_storage = ContentAddressedStorage()
+
+
+def get_recipe_image_storage():
+    return recipe_image_storage
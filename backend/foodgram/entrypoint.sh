@@ -6,5 +6,7 @@ python manage.py makemigrations api
 python manage.py migrate api
 python manage.py makemigrations
 python manage.py migrate
+python manage.py load_ing
+python manage.py reindex_recipes --missing
 python manage.py collectstatic --noinput
 exec "$@"
\ No newline at end of file
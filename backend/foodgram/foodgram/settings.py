@@ -67,6 +67,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'api.middleware.RequestProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'foodgram.urls'
@@ -126,6 +127,49 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Version stamps (api/cache.py) must be seen by every web worker and by
+# management commands, so the cache has to be shared between processes:
+# files on the host by default, memcached in docker-compose.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION', default=os.path.join(BASE_DIR, 'var', 'cache')),
+    }
+}
+
+# Seconds an anonymous recipe list/detail response stays cached.
+RECIPE_CACHE_TIMEOUT = int(os.getenv('RECIPE_CACHE_TIMEOUT', default=300))
+
+# Seconds a serialized recipe card fragment stays cached.
+RECIPE_FRAGMENT_TIMEOUT = int(
+    os.getenv('RECIPE_FRAGMENT_TIMEOUT', default=60 * 60 * 24))
+
+# Share of requests profiled by api.middleware (0 disables, 1 profiles all).
+REQUEST_PROFILING_SAMPLE_RATE = float(
+    os.getenv('REQUEST_PROFILING_SAMPLE_RATE', default=0.05))
+
+# Repeats of one SQL shape in a request that are logged as an N+1.
+REQUEST_PROFILING_N_PLUS_ONE_THRESHOLD = int(
+    os.getenv('REQUEST_PROFILING_N_PLUS_ONE_THRESHOLD', default=5))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.middleware': {
+            'handlers': ['console'],
+            'level': os.getenv('REQUEST_PROFILING_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
@@ -148,6 +192,64 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Memory-mapped ingredient autocomplete index (api/autocomplete.py), shared
+# by every worker on the host, and the default and largest result count.
+INGREDIENT_INDEX_PATH = os.getenv(
+    'INGREDIENT_INDEX_PATH',
+    default=os.path.join(BASE_DIR, 'var', 'ingredient_index.bin'))
+INGREDIENT_AUTOCOMPLETE_LIMIT = int(
+    os.getenv('INGREDIENT_AUTOCOMPLETE_LIMIT', default=20))
+INGREDIENT_AUTOCOMPLETE_MAX_LIMIT = 100
+
+# Ingredient catalog loaded by `manage.py load_ing` when no file is given.
+INGREDIENTS_DATA_PATH = os.getenv(
+    'INGREDIENTS_DATA_PATH',
+    default=os.path.join(BASE_DIR, 'ingredients.json'))
+
+# Browser cache lifetime of the content-hashed ingredient catalog snapshot
+# (api/snapshot.py); its content never changes.
+INGREDIENT_SNAPSHOT_MAX_AGE = 365 * 24 * 60 * 60
+
+# Lowest trigram similarity returned by ?fuzzy=1 searches (api/fuzzy.py),
+# and how many best recipe matches the SQLite fallback keeps.
+FUZZY_SEARCH_THRESHOLD = float(
+    os.getenv('FUZZY_SEARCH_THRESHOLD', default=0.1))
+FUZZY_SEARCH_MAX_CANDIDATES = 500
+
+# Pre-scaled shopping list PDF background and rendered shopping lists
+# (api/pdfgen.py). With a prefix set, PDFs are sent by nginx from an
+# internal location that maps the prefix to PDF_CACHE_DIR.
+PDF_CACHE_DIR = os.getenv(
+    'PDF_CACHE_DIR', default=os.path.join(BASE_DIR, 'var', 'pdf'))
+PDF_ACCEL_REDIRECT_PREFIX = os.getenv('PDF_ACCEL_REDIRECT_PREFIX', default='')
+# Rendered shopping lists not downloaded for this many days are deleted
+# by the prune_pdfs command, which is meant to run from cron.
+PDF_CACHE_MAX_AGE_DAYS = float(os.getenv('PDF_CACHE_MAX_AGE_DAYS', default=7))
+
+# Processes per web worker rendering shopping list PDF export jobs
+# (api/exports.py), 0 renders inline, how many jobs may wait for them,
+# and the largest cart, in lines, that is still rendered inline.
+PDF_EXPORT_WORKERS = int(os.getenv('PDF_EXPORT_WORKERS', default=2))
+PDF_EXPORT_MAX_PENDING = int(
+    os.getenv('PDF_EXPORT_MAX_PENDING', default=100))
+PDF_EXPORT_INLINE_ROWS = int(os.getenv('PDF_EXPORT_INLINE_ROWS', default=10))
+
+# Largest recipe image upload in bytes and in pixels (api/uploads.py).
+RECIPE_IMAGE_MAX_BYTES = int(
+    os.getenv('RECIPE_IMAGE_MAX_BYTES', default=10 * 1024 * 1024))
+RECIPE_IMAGE_MAX_PIXELS = int(
+    os.getenv('RECIPE_IMAGE_MAX_PIXELS', default=40_000_000))
+
+# Threads generating recipe image variants (api/images.py), 0 runs inline,
+# and how many jobs may wait for them before new ones are dropped.
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', default=2))
+IMAGE_VARIANT_MAX_PENDING = int(
+    os.getenv('IMAGE_VARIANT_MAX_PENDING', default=100))
+
+# Directory that recipe imports (api/importer.py) may read images from.
+IMPORT_IMAGE_ROOT = os.getenv(
+    'IMPORT_IMAGE_ROOT', default=os.path.join(BASE_DIR, 'import'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 